@@ -0,0 +1,155 @@
+"""Admission control check: the queue pauses on low disk, memory or heavy I/O and resumes on its own.
+
+Drives web_server.AdmissionController with faked disk_free, memory_headroom
+and io_pressure readings (no real volume fills up) and asserts that:
+
+  * no more than `limit` units are admitted; a release lets the next one in;
+  * a unit that doesn't fit on its save folder's volume, after the
+    reservations of running units and ADMISSION_DISK_RESERVE, waits. The
+    queue is announced as paused once, and it resumes and announces that
+    once when space comes back;
+  * with units running, a unit waits for memory headroom, and the memory of
+    units started less than ADMISSION_RAMP ago is counted as already used;
+    with nothing running it isn't held back for memory;
+  * the sampling loop lowers the effective limit under I/O pressure or
+    memory starvation and raises it back up to MAX_PARALLEL once units are
+    waiting and the pressure is gone;
+  * /api/settings/parallel turns away limits outside 1..max-parallel-downloads
+    with a 400;
+  * a downloader that hit a full disk failed transiently, so the job is
+    retried behind admission instead of failing.
+
+Exits non-zero on failure.
+
+    python bench/admission.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+MB = 1 << 20
+GB = 1 << 30
+problems = []
+
+def check(label: str, ok: bool, detail=""):
+    print(f"{'ok' if ok else 'FAIL':4s}  {label}")
+    if not ok: problems.append(f"{label}: {detail}")
+
+class Machine:
+    """Resource readings the controller sees; the check turns them up and down."""
+
+    def __init__(self):
+        self.free = 100 * GB
+        self.headroom = 16 * GB
+        self.pressure = 0.0
+
+async def waits(coro, seconds: float = 0.15) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    await asyncio.sleep(seconds)
+    return task
+
+async def slots(ws, album):
+    controller = ws.AdmissionController(2)
+    first, second = await controller.admit(album), await controller.admit(album)
+    third = await waits(controller.admit(album))
+    check("a third unit waits at limit 2", not third.done() and controller.waiting == 1)
+    await controller.release(first)
+    check("a release admits it", await asyncio.wait_for(third, 1) is not None and len(controller.active) == 2)
+    for rid in (second, third.result()): await controller.release(rid)
+
+async def disk(ws, machine, album, announced):
+    controller = ws.AdmissionController(4)
+    need = 10 * ws.TRACK_BYTES["alac"]  # ten unfinished tracks at the fixed estimate
+    machine.free = need * 2 + ws.ADMISSION_DISK_RESERVE + 100 * MB  # room for two albums, not three
+    first, second = await controller.admit(album), await controller.admit(album)
+    announced.clear()
+    third = await waits(controller.admit(album), ws.ADMISSION_INTERVAL * 4)
+    check("a unit that doesn't fit beside two reservations waits", not third.done() and "low disk space" in (controller.paused or ""), controller.paused)
+    check("the pause is announced once", sum("paused" in m for m in announced) == 1, announced)
+    check("status reports the pause and the reservations", controller.status()['paused'] and controller.status()['reserved']['disk'] == 2 * need)
+    machine.free = 100 * GB
+    rid = await asyncio.wait_for(third, 1)
+    check("it starts on its own once space is back", rid is not None and controller.paused is None)
+    check("the resume is announced once", sum("resumed" in m for m in announced) == 1, announced)
+    for rid in (first, second, rid): await controller.release(rid)
+
+async def memory(ws, machine, album):
+    controller = ws.AdmissionController(4)
+    per_unit = 256 * MB  # max-memory-limit
+    machine.headroom = ws.ADMISSION_MEMORY_RESERVE + per_unit + 50 * MB
+    first = await controller.admit(album)
+    second = await waits(controller.admit(album), ws.ADMISSION_INTERVAL * 4)
+    check("a young unit's memory counts as used until ADMISSION_RAMP", not second.done() and "low memory" in (controller.paused or ""), controller.paused)
+    controller.active[first] = controller.active[first]._replace(started=controller.active[first].started - ws.ADMISSION_RAMP)
+    check("once it ramped, the measured headroom alone decides", await asyncio.wait_for(second, 1) is not None)
+    for rid in (first, second.result()): await controller.release(rid)
+    machine.headroom = 0
+    check("with nothing running, low memory doesn't hold a unit back", await asyncio.wait_for(controller.admit(album), 1) is not None)
+    machine.headroom = 16 * GB
+
+async def pressure(ws, machine, album):
+    ws.MAX_PARALLEL = 4
+    controller = ws.ADMISSION = ws.AdmissionController(4)
+    held = [await controller.admit(album) for _ in range(4)]
+    loop = asyncio.create_task(controller.run())
+    low, high = ws.ADMISSION_IO_PRESSURE
+    machine.pressure = high + 10
+    await asyncio.sleep(ws.ADMISSION_INTERVAL * 3.5)
+    check(f"I/O pressure above {high}% shrinks the limit", controller.limit < 4, controller.limit)
+    for rid in held[1:]: await controller.release(rid)
+    await asyncio.sleep(ws.ADMISSION_INTERVAL * 6)
+    check("sustained pressure shrinks it to 1", controller.limit == 1, controller.limit)
+    waiting = [asyncio.create_task(controller.admit(album)) for _ in range(4)]
+    machine.pressure = low / 2
+    await asyncio.sleep(ws.ADMISSION_INTERVAL * 10)
+    check(f"below {low}% with units waiting it climbs back to MAX_PARALLEL", controller.limit == ws.MAX_PARALLEL and sum(t.done() for t in waiting) == 3,
+          (controller.limit, sum(t.done() for t in waiting)))
+    machine.pressure, machine.headroom = 0.0, ws.ADMISSION_MEMORY_RESERVE // 2
+    await asyncio.sleep(ws.ADMISSION_INTERVAL * 3.5)
+    check("memory starvation shrinks it too", controller.limit < ws.MAX_PARALLEL, controller.limit)
+    loop.cancel()
+    for task in waiting: task.cancel()
+    await asyncio.gather(loop, *waiting, return_exceptions=True)
+
+async def settings(ws):
+    ws.SCHEDULER = ws.DownloadScheduler(2)
+    rejected = []
+    for limit in (0, 9, 5):
+        try:
+            await ws.set_parallel_limit(ws.ParallelLimitRequest(limit=limit))
+        except ws.HTTPException as e:
+            rejected.append((limit, e.status_code))
+    check("limits outside 1..max-parallel-downloads get a 400", rejected == [(0, 400), (9, 400)] and ws.MAX_PARALLEL == 5, (rejected, ws.MAX_PARALLEL))
+    ws.load_config = lambda: {"max-parallel-downloads": 4}
+    try:
+        await ws.set_parallel_limit(ws.ParallelLimitRequest(limit=5))
+        check("max-parallel-downloads lowers the ceiling", False, ws.MAX_PARALLEL)
+    except ws.HTTPException as e:
+        check("max-parallel-downloads lowers the ceiling", e.status_code == 400)
+    kind, reason, _ = ws.classify_failure(["write /music/01.m4a: no space left on device"])
+    check("a full disk is a transient failure", (kind, reason) == ("transient", "disk_full"), (kind, reason))
+
+async def main():
+    import web_server as ws
+    machine = Machine()
+    announced = []
+    ws.disk_free = lambda path: machine.free
+    ws.memory_headroom = lambda: machine.headroom
+    ws.io_pressure = lambda: machine.pressure
+    ws.load_config = lambda: {"alac-save-folder": "/bench/ALAC", "max-memory-limit": 256}
+    async def broadcast_log(message): announced.append(message)
+    ws.broadcast_log = broadcast_log
+    ws.ADMISSION_INTERVAL = 0.02
+    album = {"codec": "alac", "total_tracks": 10}
+    await slots(ws, album)
+    await disk(ws, machine, album, announced)
+    await memory(ws, machine, album)
+    await pressure(ws, machine, album)
+    await settings(ws)
+
+if __name__ == "__main__":
+    asyncio.run(main())
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
@@ -0,0 +1,95 @@
+"""Artwork proxy check: host slots and waiters are released on every path.
+
+Drives web_server.ArtworkCache and ArtworkResponse against an
+httpx.MockTransport and asserts that after each of these the mzstatic host
+semaphore is back to HTTP_MAX_PER_HOST and no key is left in `inflight`:
+
+  * a full download (the image lands in the cache),
+  * upstream errors: 404, a non-image body, a transport error and a
+    non-transport exception from send() (InvalidURL),
+  * the request being cancelled while send() is pending,
+  * the client disconnecting before the body is started, and mid-body.
+
+It then repeats the disconnect path more times than there are host slots,
+which used to hang every later artwork request. Exits non-zero on failure.
+
+    python bench/artwork_proxy.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+HOST = "is1-ssl.mzstatic.com"
+
+def upstream(mode: str):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if mode == "hang": await asyncio.sleep(3600)
+        if mode == "transport": raise httpx.ConnectError("refused", request=request)
+        if mode == "invalid": raise httpx.InvalidURL("bad url")
+        if mode == "404": return httpx.Response(404)
+        if mode == "html": return httpx.Response(200, headers={"content-type": "text/html"}, content=b"<html>")
+        return httpx.Response(200, headers={"content-type": "image/jpeg"}, content=b"x" * 200_000)
+    return handler
+
+async def send_that_fails(message):
+    raise OSError("client went away")
+
+async def run(ws, mode: str, consume: str = "all") -> None:
+    ws.HTTP_CLIENT = httpx.AsyncClient(transport=httpx.MockTransport(upstream(mode)))
+    key = f"{mode}-{consume}"
+    url = f"https://{HOST}/image/thumb/{key}/300x300bb.jpg"
+    if mode == "hang":
+        task = asyncio.create_task(ws.ARTWORK.fetch(key, url))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return
+    download = await ws.ARTWORK.fetch(key, url)
+    if download is None: return
+    response = ws.ArtworkResponse(download, media_type="image/jpeg")
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    if consume == "all":
+        sent = []
+        async def send(message): sent.append(message)
+        await response(scope, None, send)
+        assert ws.ARTWORK.lookup(key), "completed download was not cached"
+    elif consume == "none":
+        await asyncio.gather(response(scope, None, send_that_fails), return_exceptions=True)
+    else:
+        chunks = 0
+        async def send(message):
+            nonlocal chunks
+            if message["type"] == "http.response.body":
+                chunks += 1
+                if chunks == 2: raise OSError("client went away")
+        await asyncio.gather(response(scope, None, send), return_exceptions=True)
+
+def check(ws, label: str):
+    slots = ws.HTTP_HOST_SLOTS[HOST]
+    assert slots._value == ws.HTTP_MAX_PER_HOST, f"{label}: host slots leaked ({slots._value}/{ws.HTTP_MAX_PER_HOST} free)"
+    assert not ws.ARTWORK.inflight, f"{label}: waiters left behind: {list(ws.ARTWORK.inflight)}"
+    print(f"ok  {label}")
+
+async def main():
+    import web_server as ws
+    with tempfile.TemporaryDirectory() as root:
+        ws.ARTWORK = ws.ArtworkCache(root, 1 << 20)
+        ws.ARTWORK.open()
+        ws.HTTP_HOST_SLOTS.clear()
+        ws.HTTP_HOST_SLOTS[HOST] = asyncio.Semaphore(ws.HTTP_MAX_PER_HOST)
+        for mode, consume in (("ok", "all"), ("404", "all"), ("html", "all"), ("transport", "all"), ("invalid", "all"),
+                              ("hang", "all"), ("ok", "none"), ("ok", "partial")):
+            await run(ws, mode, consume)
+            check(ws, f"{mode:9s} {consume}")
+        for i in range(ws.HTTP_MAX_PER_HOST + 2):
+            await asyncio.wait_for(run(ws, "ok", f"none{i}"), 5)
+        check(ws, f"{ws.HTTP_MAX_PER_HOST + 2} disconnects before the body")
+        assert not [f for f in os.listdir(root) if f.endswith(".part")], "partial files left on disk"
+
+if __name__ == "__main__":
+    asyncio.run(main())
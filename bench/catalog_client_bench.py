@@ -0,0 +1,140 @@
+"""Catalog client benchmark: per-call `requests` vs. the shared pooled client.
+
+Starts a local stub of music.apple.com / amp-api.music.apple.com, then fires
+the same search workload through the old code path (a fresh `requests.get`
+per call on the default executor) and through web_server.http_get (shared
+httpx client; the search cache and rate limiter in front of it are left out
+so the client itself is measured). Prints requests/sec and latency
+percentiles for both.
+
+The stub counts the connections it accepts. The check fails (exit 1) unless
+every call through the shared client reached the stub and, after warm-up,
+the shared client opened no more connections than it may keep per host,
+so one pooled client is reused across calls.
+
+    python bench/catalog_client_bench.py --requests 2000 --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+FAKE_TOKEN = "eyJhbGciOiJFUzI1NiJ9.eyJleHAiOjQxMDI0NDQ4MDB9.c2ln"
+SEARCH_BODY = json.dumps({"results": {"songs": {"data": [{
+    "id": str(i), "type": "songs",
+    "attributes": {"name": f"Song {i}", "artistName": "Artist", "albumName": "Album",
+                   "url": f"https://music.apple.com/us/album/a/1?i={i}",
+                   "artwork": {"url": "https://is1-ssl.mzstatic.com/image/{w}x{h}bb.jpg"}},
+} for i in range(10)]}}}).encode()
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # avoid 40 ms delayed-ACK stalls on keep-alive
+
+    def setup(self):
+        super().setup()
+        with self.server.connections.get_lock(): self.server.connections.value += 1
+
+    def do_GET(self):
+        with self.server.requests.get_lock(): self.server.requests.value += 1
+        if self.path.endswith("/browse"):
+            body = b'<script src="/assets/index-legacy-bench.js"></script>'
+        elif self.path.startswith("/assets/"):
+            body = f'const t="{FAKE_TOKEN}";'.encode()
+        else:
+            body = SEARCH_BODY
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+def serve_stub(port_queue, connections, requests):
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    server.connections, server.requests = connections, requests
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def start_stub():
+    """Base URL of the stub, and its shared connection and request counters."""
+    # Run the stub in its own process so it doesn't compete with the client for the GIL.
+    port_queue = multiprocessing.Queue()
+    connections, requests = multiprocessing.Value("i", 0), multiprocessing.Value("i", 0)
+    multiprocessing.Process(target=serve_stub, args=(port_queue, connections, requests), daemon=True).start()
+    return f"http://127.0.0.1:{port_queue.get(timeout=10)}", connections, requests
+
+async def run_load(call, total: int, concurrency: int):
+    latencies = []
+    remaining = iter(range(total))
+
+    async def client():
+        for _ in remaining:
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - start, sorted(latencies)
+
+def report(label: str, elapsed: float, latencies):
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    print(f"{label:<28} {len(latencies) / elapsed:9.1f} req/s   p50 {pct(0.50):7.2f} ms   p99 {pct(0.99):7.2f} ms")
+
+async def main(args):
+    import requests
+    import web_server
+
+    base, connections, requests_served = start_stub()
+    web_server.AMP_API_BASE = base
+    web_server.MUSIC_WEB_BASE = base
+    url = f"{base}/v1/catalog/us/search"
+    params = {"term": "bench", "types": "songs,albums,artists,music-videos,playlists", "limit": 10}
+    headers = {"Authorization": f"Bearer {FAKE_TOKEN}", "Origin": "https://music.apple.com"}
+    loop = asyncio.get_running_loop()
+
+    async def before():
+        response = await loop.run_in_executor(None, lambda: requests.get(url, headers=headers, params=params, timeout=20))
+        response.json()
+
+    async def after():
+        response = await web_server.http_get(url, headers=headers, params=params)
+        response.json()
+
+    web_server.HTTP_CLIENT = client = web_server.create_http_client()
+    await run_load(after, args.concurrency * 4, args.concurrency)  # warm up the connection pool
+    opened = connections.value
+    report("before (requests per call)", *await run_load(before, args.requests, args.concurrency))
+    print(f"{'':<28} {connections.value - opened} connections for {args.requests} calls")
+    opened, served = connections.value, requests_served.value
+    report("after (shared client)", *await run_load(after, args.requests, args.concurrency))
+    print(f"{'':<28} {connections.value - opened} connections for {args.requests} calls")
+    await client.aclose()
+
+    cap = min(args.concurrency, web_server.HTTP_MAX_PER_HOST)
+    problems = []
+    if requests_served.value - served != args.requests: problems.append(f"the stub saw {requests_served.value - served} of {args.requests} calls")
+    if web_server.HTTP_CLIENT is not client: problems.append("HTTP_CLIENT was replaced during the run")
+    if connections.value - opened > cap: problems.append(f"the shared client opened {connections.value - opened} connections, more than {cap}")
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
+    print("ok    one pooled client served every call over its warm connections")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,218 @@
+"""amp-api throttling harness: search latency under a bulk enrichment flood.
+
+Runs web_server.catalog_get against a local stub of amp-api (an
+httpx.MockTransport) that serves at most --capacity requests/s and answers
+429 with Retry-After beyond that, optionally going fully down for a while to
+exercise the circuit breaker. A background flood of enrichment calls runs
+alongside a trickle of interactive searches, once through CATALOG_LIMITER
+and once with the limiter bypassed, and reports search latency, failures,
+429s served and the limiter's final state. It asserts that, through the
+limiter:
+
+  * requests never outrun the token bucket: no more than --burst plus
+    --rate per second since any earlier request;
+  * no search fails, and the stub serves no 429s while --rate is under
+    --capacity and there is no outage.
+
+Then it drives a CatalogLimiter directly and asserts that:
+
+  * CATALOG_BREAKER_THRESHOLD 429s in a row open the breaker; interactive
+    calls then fail fast and other lanes wait;
+  * after the cooldown one probe gets through; a failed probe reopens the
+    breaker with a doubled cooldown, a successful one closes it;
+  * cancelling acquire() leaks no tokens, whether the waiter was still
+    queued or had just been granted, and the tokens go to the next waiter.
+
+Exits non-zero on failure.
+
+    python bench/catalog_throttle.py --capacity 8 --enrich 200 --searches 20
+    python bench/catalog_throttle.py --outage 3
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from collections import deque
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+class StubAmpApi:
+    """Sliding-window rate limit like Apple's; optionally 503 for `outage` seconds after `outage_at`."""
+
+    def __init__(self, capacity: int, latency: float, outage: float, outage_at: float):
+        self.capacity = capacity
+        self.latency = latency
+        self.outage = outage
+        self.outage_at = outage_at
+        self.window: deque = deque()
+        self.started = time.monotonic()
+        self.served = {200: 0, 429: 0, 503: 0}
+        self.times = []  # monotonic arrival of every request
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.times.append(time.monotonic())
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        if self.outage and self.outage_at <= now - self.started < self.outage_at + self.outage:
+            return self._reply(503)
+        while self.window and now - self.window[0] > 1.0: self.window.popleft()
+        if len(self.window) >= self.capacity: return self._reply(429, {"Retry-After": "1"})
+        self.window.append(now)
+        return self._reply(200, json={"data": [], "results": {}})
+
+    def _reply(self, status, headers=None, json=None):
+        self.served[status] += 1
+        return httpx.Response(status, headers=headers, json=json)
+
+problems = []
+
+def check(label: str, ok: bool, detail=""):
+    print(f"{'ok' if ok else 'FAIL':4s}  {label}")
+    if not ok: problems.append(f"{label}: {detail}")
+
+class Unlimited:
+    async def acquire(self, lane="bulk", cost=1.0): pass
+    def record(self, status, retry_after=None): pass
+    def status(self): return {"state": "bypassed"}
+
+async def scenario(args, limited: bool):
+    import web_server as ws
+    ws.HTTP_BACKOFF_BASE = args.backoff
+    stub = StubAmpApi(args.capacity, args.latency, args.outage, args.outage_at)
+    ws.HTTP_CLIENT = httpx.AsyncClient(transport=httpx.MockTransport(stub.handler))
+    ws.HTTP_HOST_SLOTS.clear()
+    ws.CATALOG_LIMITER = ws.CatalogLimiter(args.rate, args.burst) if limited else Unlimited()
+
+    async def fake_token(storefront): return "stub-token"
+    ws.get_apple_music_dev_token = fake_token
+
+    async def enrich(i):
+        try: await ws.catalog_get("us", "albums", {"ids": str(i)}, endpoint="enrich")
+        except Exception: pass
+
+    latencies, failures = [], 0
+    async def search(i):
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            response = await ws.catalog_get("us", "search", {"term": f"q{i}"}, endpoint="search")
+            if response is None or response.status_code != 200: failures += 1
+            else: latencies.append(time.perf_counter() - start)
+        except Exception:
+            failures += 1
+
+    started = time.perf_counter()
+    flood = [asyncio.create_task(enrich(i)) for i in range(args.enrich)]
+    searches = []
+    for i in range(args.searches):
+        await asyncio.sleep(args.search_interval)
+        searches.append(asyncio.create_task(search(i)))
+    await asyncio.gather(*searches)
+    search_done = time.perf_counter() - started
+    await asyncio.gather(*flood)
+    total = time.perf_counter() - started
+    await ws.HTTP_CLIENT.aclose()
+    return latencies, failures, stub.served, search_done, total, ws.CATALOG_LIMITER.status(), stub.times
+
+def report(name, result):
+    latencies, failures, served, _, total, status, _ = result
+    p50 = statistics.median(latencies) * 1000 if latencies else float("nan")
+    p95 = sorted(latencies)[int(len(latencies) * 0.95) - 1] * 1000 if latencies else float("nan")
+    print(f"{name:10s} search p50 {p50:8.0f} ms  p95 {p95:8.0f} ms  failed {failures:3d}  "
+          f"stub served {served[200]} ok / {served[429]} x 429 / {served[503]} x 503  all done in {total:.1f}s")
+    print(f"           limiter: {status}")
+
+def paced(times: list, rate: float, burst: int) -> list:
+    """Requests that came sooner than the bucket allows: more than burst + rate * elapsed since an earlier one."""
+    return [(i, j) for i in range(len(times)) for j in range(i + burst, len(times))
+            if j - i + 1 > burst + rate * (times[j] - times[i]) + 1]  # one of slack for timer granularity
+
+async def breaker(ws):
+    ws.CATALOG_BREAKER_COOLDOWN = 0.2
+    limiter = ws.CatalogLimiter(100.0, 10)
+    for _ in range(ws.CATALOG_BREAKER_THRESHOLD - 1): limiter.record(429)
+    closed = limiter.state
+    limiter.record(429)
+    check(f"{ws.CATALOG_BREAKER_THRESHOLD} 429s in a row open the breaker", (closed, limiter.state) == ("closed", "open"), (closed, limiter.state))
+    try:
+        await limiter.acquire("interactive")
+        check("interactive calls fail fast while open", False, "acquire() returned")
+    except ws.CircuitOpenError:
+        check("interactive calls fail fast while open", True)
+    bulk = asyncio.create_task(limiter.acquire("bulk"))
+    await asyncio.sleep(0.1)
+    check("bulk calls wait while open", not bulk.done())
+    await asyncio.wait_for(bulk, 1.0)
+    check("after the cooldown one probe gets through", limiter.state == "half_open", limiter.state)
+    limiter.record(503)
+    check("a failed probe reopens with a doubled cooldown", (limiter.state, limiter.cooldown) == ("open", 0.4), (limiter.state, limiter.cooldown))
+    await asyncio.sleep(0.45)
+    await limiter.acquire("interactive")
+    limiter.record(200)
+    check("a successful probe closes the breaker", (limiter.state, limiter.cooldown) == ("closed", 0.2), (limiter.state, limiter.cooldown))
+
+async def cancellation(ws):
+    limiter = ws.CatalogLimiter(0.01, 4)  # next to no refill during the check
+    await limiter.acquire("interactive", 4)
+    queued = asyncio.create_task(limiter.acquire("interactive", 2))
+    await asyncio.sleep(0.01)
+    queued.cancel()
+    await asyncio.gather(queued, return_exceptions=True)
+    limiter.refund(2)
+    check("a cancelled queued waiter takes no tokens", round(limiter.tokens) == 2, limiter.tokens)
+    await limiter.acquire("interactive", 2)
+    granted = asyncio.create_task(limiter.acquire("interactive", 2))
+    behind = asyncio.create_task(limiter.acquire("interactive", 2))
+    await asyncio.sleep(0.01)
+    limiter.refund(2)  # grants the first waiter...
+    granted.cancel()  # ...which goes away before it runs
+    await asyncio.gather(granted, return_exceptions=True)
+    try: await asyncio.wait_for(behind, 0.5)
+    except asyncio.TimeoutError: pass
+    check("tokens granted to a cancelled waiter go to the next one", behind.done() and not behind.cancelled() and round(limiter.tokens) == 0,
+          (behind.done(), limiter.tokens))
+    limiter = ws.CatalogLimiter(0.01, 4)
+    await limiter.acquire("interactive", 4)
+    hog = asyncio.create_task(limiter.acquire("interactive", 2))
+    await asyncio.sleep(0.01)
+    limiter.refund(2)
+    limiter.tokens = limiter.burst  # refilled while the grant was in flight
+    hog.cancel()
+    await asyncio.gather(hog, return_exceptions=True)
+    check("a cancelled grant never lifts the bucket past its burst", limiter.tokens <= limiter.burst, limiter.tokens)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--capacity", type=int, default=8, help="requests/s the stub serves before answering 429")
+    ap.add_argument("--latency", type=float, default=0.02)
+    ap.add_argument("--rate", type=float, default=6.0, help="limiter rate (keep it under --capacity)")
+    ap.add_argument("--burst", type=int, default=6)
+    ap.add_argument("--enrich", type=int, default=200, help="background enrichment calls fired at once")
+    ap.add_argument("--searches", type=int, default=20)
+    ap.add_argument("--search-interval", type=float, default=0.5)
+    ap.add_argument("--outage", type=float, default=0.0, help="seconds of 503s from the stub")
+    ap.add_argument("--outage-at", type=float, default=2.0)
+    ap.add_argument("--backoff", type=float, default=0.2, help="http_get backoff base, shortened for the run")
+    args = ap.parse_args()
+
+    report("bypassed", asyncio.run(scenario(args, limited=False)))
+    limited = asyncio.run(scenario(args, limited=True))
+    report("limited", limited)
+    _, failures, served, _, _, _, times = limited
+    early = paced(times, args.rate, args.burst)
+    check(f"requests stay within {args.burst} + {args.rate:g}/s", not early, early[:3])
+    if args.rate < args.capacity and not args.outage:
+        check("no search fails and the stub serves no 429s", failures == 0 and served[429] == 0, (failures, served))
+
+    import web_server as ws
+    asyncio.run(breaker(ws))
+    asyncio.run(cancellation(ws))
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
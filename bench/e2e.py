@@ -0,0 +1,254 @@
+"""End-to-end load test: the real server against stub binaries and a fake amp-api.
+
+Starts bench/stubs/amp_api.py and the server (bench/stubs/serve.py, which
+swaps in the stub downloader and wrapper and keeps all state in a temp dir),
+then drives it like a busy UI: clients enqueue --jobs albums through
+/api/download, poll /api/queue the way the queue page does, search through
+/api/search and listen on /ws/logs, until every job has finished. Nothing
+leaves localhost, so it runs in CI.
+
+Reports throughput (jobs/min), p50/p99 latency per endpoint, event-loop lag
+(from amd_event_loop_lag_seconds), server RSS growth across the run, and
+/ws/logs delivery lag (the stub stamps each "Track N of M" line). --json
+writes the same numbers for a CI job to compare against a baseline.
+
+    python bench/e2e.py --jobs 300
+    python bench/e2e.py --jobs 10000 --track-seconds 0.02 --parallel 16 --json e2e.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import websockets
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+STAMP = re.compile(r'@(\d+\.\d+)')
+TERMS = [f"{a} {b}" for a in ("love", "night", "blue", "city", "summer", "gold", "fire", "rain") for b in ("song", "lights", "heart", "road", "dream")]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, q: float) -> float:
+    if not values: return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"): return int(line.split()[1]) * 1024
+    return 0
+
+def parse_metrics(text: str) -> dict:
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+    return samples
+
+def histogram_quantile(before: dict, after: dict, name: str, q: float) -> float:
+    """Upper bucket bound holding the q-th observation made between two scrapes."""
+    bounds = []
+    for key, value in after.items():
+        m = re.fullmatch(rf'{name}_bucket\{{le="([^"]+)"\}}', key)
+        if m: bounds.append((float(m.group(1)), value - before.get(key, 0)))
+    bounds.sort()
+    total = bounds[-1][1] if bounds else 0
+    for bound, count in bounds:
+        if total and count >= q * total: return bound
+    return float("nan")
+
+class Recorder:
+    def __init__(self):
+        self.latency = {}
+        self.errors = {}
+
+    async def timed(self, name: str, request):
+        start = time.perf_counter()
+        try:
+            response = await request
+            if response.status_code >= 400: self.errors[name] = self.errors.get(name, 0) + 1
+            return response
+        except httpx.HTTPError:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        finally:
+            self.latency.setdefault(name, []).append(time.perf_counter() - start)
+
+async def wait_ready(client: httpx.AsyncClient, url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200: return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+async def ws_listener(url: str, lags: list, counts: list, stop: asyncio.Event):
+    async with websockets.connect(url, max_queue=None) as sock:
+        received = 0
+        while not stop.is_set():
+            try:
+                message = await asyncio.wait_for(sock.recv(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            received += 1
+            m = STAMP.search(message)
+            if m: lags.append(time.time() - float(m.group(1)))
+        counts.append(received)
+
+async def drive(args, base: str, pid: int) -> dict:
+    rec = Recorder()
+    limits = httpx.Limits(max_connections=args.enqueue_clients + args.poll_clients + args.search_clients + 8)
+    async with httpx.AsyncClient(base_url=base, timeout=60, limits=limits) as client:
+        await wait_ready(client, "/api/queue?since=0&limit=1")
+        await asyncio.sleep(1.0)  # wrapper probe, token scrape
+        before = parse_metrics((await client.get("/metrics")).text)
+        rss_start = rss_bytes(pid)
+        stop = asyncio.Event()
+        lags, counts = [], []
+        ws_url = base.replace("http", "ws") + "/ws/logs"
+        listeners = [asyncio.create_task(ws_listener(ws_url, lags, counts, stop)) for _ in range(args.ws_clients)]
+
+        async def poller():
+            seq = 0
+            while not stop.is_set():
+                response = await rec.timed("GET /api/queue", client.get("/api/queue", params={"since": seq, "limit": 500}))
+                if response is not None and response.status_code == 200: seq = response.json().get("seq", seq)
+                await asyncio.sleep(args.poll_interval)
+
+        async def searcher(rng: random.Random):
+            while not stop.is_set():
+                await rec.timed("GET /api/search", client.get("/api/search", params={"query": rng.choice(TERMS)}))
+                await asyncio.sleep(args.search_interval)
+
+        next_id = iter(range(1, args.jobs + 1))
+        async def enqueuer():
+            for i in next_id:
+                url = f"https://music.apple.com/us/album/bench-album/{args.id_base + i}"
+                await rec.timed("POST /api/download", client.post("/api/download", json={"url": url, "codec": "alac"}))
+
+        rss_samples = [(0, rss_start)]
+        async def sampler():
+            while not stop.is_set():
+                await asyncio.sleep(1.0)
+                rss_samples.append((time.monotonic() - started, rss_bytes(pid)))
+
+        started = time.monotonic()
+        background = [asyncio.create_task(poller()) for _ in range(args.poll_clients)]
+        background += [asyncio.create_task(searcher(random.Random(i))) for i in range(args.search_clients)]
+        background.append(asyncio.create_task(sampler()))
+        await asyncio.gather(*(enqueuer() for _ in range(args.enqueue_clients)))
+        enqueued = time.monotonic() - started
+
+        done = 0
+        while True:
+            samples = parse_metrics((await client.get("/metrics")).text)
+            done = samples.get('amd_jobs{status="completed"}', 0) + samples.get('amd_jobs{status="failed"}', 0)
+            if done >= args.jobs or time.monotonic() - started > args.timeout: break
+            await asyncio.sleep(0.5)
+        elapsed = time.monotonic() - started
+        after = parse_metrics((await client.get("/metrics")).text)
+        ws_stats = (await client.get("/api/ws/stats")).json()
+        rss_end = rss_bytes(pid)
+        stop.set()
+        await asyncio.gather(*background, *listeners, return_exceptions=True)
+
+    lag_count = after.get("amd_event_loop_lag_seconds_count", 0) - before.get("amd_event_loop_lag_seconds_count", 0)
+    lag_sum = after.get("amd_event_loop_lag_seconds_sum", 0) - before.get("amd_event_loop_lag_seconds_sum", 0)
+    return {
+        "jobs": args.jobs,
+        "finished": int(done),
+        "failed": int(after.get('amd_jobs{status="failed"}', 0)),
+        "seconds": round(elapsed, 2),
+        "enqueue_seconds": round(enqueued, 2),
+        "jobs_per_min": round(done / elapsed * 60, 1) if elapsed else 0,
+        "api": {name: {"p50_ms": round(percentile(v, 0.5) * 1000, 1), "p99_ms": round(percentile(v, 0.99) * 1000, 1),
+                       "count": len(v), "errors": rec.errors.get(name, 0)} for name, v in sorted(rec.latency.items())},
+        "loop_lag": {"mean_ms": round(lag_sum / lag_count * 1000, 2) if lag_count else None,
+                     "p50_le_ms": histogram_quantile(before, after, "amd_event_loop_lag_seconds", 0.5) * 1000,
+                     "p99_le_ms": histogram_quantile(before, after, "amd_event_loop_lag_seconds", 0.99) * 1000},
+        "rss_mb": {"start": round(rss_start / 2**20, 1), "end": round(rss_end / 2**20, 1),
+                   "peak": round(max(r for _, r in rss_samples + [(0, rss_end)]) / 2**20, 1),
+                   "growth_per_1k_jobs": round((rss_end - rss_start) / 2**20 / max(1, done) * 1000, 2)},
+        "ws": {"clients": args.ws_clients, "p50_ms": round(percentile(lags, 0.5) * 1000, 1), "p99_ms": round(percentile(lags, 0.99) * 1000, 1),
+               "stamped_lines": len(lags), "messages_per_client": round(sum(counts) / max(1, len(counts))),
+               "dropped": ws_stats.get("dropped"), "evicted": ws_stats.get("evicted")},
+    }
+
+def report(result: dict):
+    print(f"jobs        {result['finished']}/{result['jobs']} finished ({result['failed']} failed) in {result['seconds']}s "
+          f"-> {result['jobs_per_min']} jobs/min (enqueued in {result['enqueue_seconds']}s)")
+    for name, s in result["api"].items():
+        print(f"{name:20s} p50 {s['p50_ms']:8.1f} ms  p99 {s['p99_ms']:8.1f} ms  n={s['count']}  errors={s['errors']}")
+    lag = result["loop_lag"]
+    print(f"loop lag    mean {lag['mean_ms']} ms  p50 <= {lag['p50_le_ms']:g} ms  p99 <= {lag['p99_le_ms']:g} ms")
+    rss = result["rss_mb"]
+    print(f"server RSS  {rss['start']} -> {rss['end']} MB (peak {rss['peak']} MB, {rss['growth_per_1k_jobs']} MB per 1k jobs)")
+    ws = result["ws"]
+    print(f"/ws/logs    {ws['clients']} clients  delivery p50 {ws['p50_ms']} ms  p99 {ws['p99_ms']} ms  "
+          f"{ws['messages_per_client']} msgs/client  dropped {ws['dropped']}  evicted {ws['evicted']}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--jobs", type=int, default=300)
+    ap.add_argument("--tracks", type=int, default=4, help="tracks per album")
+    ap.add_argument("--track-seconds", type=float, default=0.05, help="stub downloader time per track")
+    ap.add_argument("--steps", type=int, default=10, help="progress ticks per download/decrypt phase")
+    ap.add_argument("--fail-rate", type=float, default=0.0)
+    ap.add_argument("--parallel", type=int, default=8)
+    ap.add_argument("--api-latency", type=float, default=0.05, help="fake amp-api response time")
+    ap.add_argument("--enqueue-clients", type=int, default=10)
+    ap.add_argument("--poll-clients", type=int, default=5)
+    ap.add_argument("--poll-interval", type=float, default=1.0)
+    ap.add_argument("--search-clients", type=int, default=5)
+    ap.add_argument("--search-interval", type=float, default=0.5)
+    ap.add_argument("--ws-clients", type=int, default=50)
+    ap.add_argument("--id-base", type=int, default=1000000, help="first album id; change it to avoid catalog cache hits")
+    ap.add_argument("--timeout", type=float, default=3600)
+    ap.add_argument("--json", help="also write the results here")
+    ap.add_argument("--keep", action="store_true", help="keep the server's temp dir")
+    args = ap.parse_args()
+
+    root = tempfile.mkdtemp(prefix="amd-e2e-")
+    api_port, server_port = free_port(), free_port()
+    env = dict(os.environ, AMD_BENCH_TRACKS=str(args.tracks), AMD_BENCH_TRACK_SECONDS=str(args.track_seconds),
+               AMD_BENCH_STEPS=str(args.steps), AMD_BENCH_FAIL_RATE=str(args.fail_rate))
+    log = open(os.path.join(root, "server.log"), "w")
+    api = subprocess.Popen([sys.executable, os.path.join(BENCH, "stubs", "amp_api.py"), "--port", str(api_port), "--latency", str(args.api_latency)],
+                           env=env, stdout=log, stderr=subprocess.STDOUT)
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH, "stubs", "serve.py"), "--root", root, "--port", str(server_port),
+                               "--api", f"http://127.0.0.1:{api_port}", "--parallel", str(args.parallel),
+                               "--wrapper-ports", f"{free_port()},{free_port()}"],
+                              env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        result = asyncio.run(drive(args, f"http://127.0.0.1:{server_port}", server.pid))
+    finally:
+        server.terminate()
+        api.terminate()
+        for proc in (server, api):
+            try: proc.wait(10)
+            except subprocess.TimeoutExpired: proc.kill()
+        log.close()
+        if args.keep: print(f"state and server log kept in {root}")
+        else: shutil.rmtree(root, ignore_errors=True)
+    report(result)
+    if args.json:
+        with open(args.json, "w") as f: json.dump(result, f, indent=2)
+    if result["finished"] < result["jobs"]: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
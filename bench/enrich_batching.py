@@ -0,0 +1,150 @@
+"""Enrichment batching check against a local fake catalog that counts requests.
+
+Serves /v1/catalog/{storefront}/{type}?ids= from a local HTTP server, points
+web_server.AMP_API_BASE at it and queues album and song jobs from two
+storefronts on a MetadataEnricher. For each N in --counts it asserts that:
+
+  * each storefront and type costs ceil(N / ENRICH_BATCH_LIMIT[type])
+    requests, none with more ids than the limit;
+  * requests across storefronts and types stay within the rate of
+    CATALOG_LIMITER's background lane;
+  * every job gets its title, artist, album and image, and albums their
+    track list as sub_tasks;
+  * queueing the same releases again costs no requests.
+
+Exits non-zero on failure.
+
+    python bench/enrich_batching.py
+    python bench/enrich_batching.py --counts 1,100,101,1000
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+STOREFRONTS = ("us", "gb")
+TRACKS = 3
+RATE = 20.0  # catalog limiter rate for the check, so it doesn't take minutes
+
+class FakeCatalog(ThreadingHTTPServer):
+    """Answers ?ids= lookups with one resource per id and remembers every request."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), CatalogHandler)
+        self.calls = []  # (time, storefront, type, ids)
+
+    def requests(self, storefront: str, type_str: str) -> list:
+        return [ids for _, sf, t, ids in self.calls if (sf, t) == (storefront, type_str)]
+
+class CatalogHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        storefront, type_str = url.path.rstrip("/").split("/")[-2:]
+        ids = parse_qs(url.query)["ids"][0].split(",")
+        self.server.calls.append((time.monotonic(), storefront, type_str, ids))
+        body = json.dumps({"data": [resource(type_str, i) for i in ids]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def resource(type_str: str, id_str: str) -> dict:
+    attributes = {"name": f"Bench {type_str} {id_str}", "artistName": "Bench Artist", "albumName": "Bench Album", "trackNumber": 1,
+                  "artwork": {"url": f"https://is1-ssl.mzstatic.com/image/{id_str}/{{w}}x{{h}}bb.jpg"}}
+    item = {"id": id_str, "type": type_str, "attributes": attributes}
+    if type_str == "albums":
+        item["relationships"] = {"tracks": {"data": [{"id": f"{id_str}{n}", "attributes": {"name": f"Track {n}", "trackNumber": n}}
+                                                      for n in range(1, TRACKS + 1)]}}
+    return item
+
+async def enrich(ws, jobs: list, timeout: float = 30.0):
+    enricher = ws.MetadataEnricher()
+    runner = asyncio.create_task(enricher.run())
+    for job in jobs: enricher.submit(job)
+    deadline = time.monotonic() + timeout
+    while enricher.queue.qsize() and time.monotonic() < deadline: await asyncio.sleep(0.05)
+    await asyncio.sleep(ws.ENRICH_WINDOW * 2)
+    while any(not job.get("title") for job in jobs) and time.monotonic() < deadline: await asyncio.sleep(0.05)
+    runner.cancel()
+    await asyncio.gather(runner, return_exceptions=True)
+
+def missing(job: dict, type_str: str) -> list:
+    fields = [f for f in ("title", "artist", "album", "image") if not job.get(f)]
+    if type_str == "albums" and len(job["sub_tasks"]) != TRACKS: fields.append("sub_tasks")
+    return fields
+
+async def scenario(ws, catalog: FakeCatalog, type_str: str, n: int) -> list:
+    catalog.calls.clear()
+    ws.CATALOG_CACHE = ws.CatalogCache(100_000)
+    # Songs are queued the way the UI links them: the album URL with ?i=<song id>
+    url = "https://music.apple.com/{}/album/bench/{}" if type_str == "albums" else "https://music.apple.com/{}/album/bench/1?i={}"
+    jobs = [ws.JOBS.add({"url": url.format(sf, n * 10 + i), "codec": "alac", "sub_tasks": []}) for sf in STOREFRONTS for i in range(n)]
+    await enrich(ws, jobs)
+    limit = ws.ENRICH_BATCH_LIMIT[type_str]
+    problems = []
+    for sf in STOREFRONTS:
+        sizes = [len(ids) for ids in catalog.requests(sf, type_str)]
+        if len(sizes) != math.ceil(n / limit): problems.append(f"{n} {type_str} in {sf}: {len(sizes)} requests, expected {math.ceil(n / limit)}")
+        if sizes and max(sizes) > limit: problems.append(f"{n} {type_str} in {sf}: {max(sizes)} ids in one request, limit {limit}")
+    # One interval of slack for the first request, which also opens the connection
+    times = [at for at, *_ in catalog.calls]
+    early = [i for i in range(1, len(times)) if times[i] - times[0] < (i - 1) / RATE]
+    if early: problems.append(f"{n} {type_str}: request {early[0] + 1} came {times[early[0]] - times[0]:.3f}s after the first, budget is {RATE:g}/s")
+    bare = [(job["id"], missing(job, type_str)) for job in jobs if missing(job, type_str)]
+    if bare: problems.append(f"{n} {type_str}: {len(bare)} jobs missing metadata, e.g. {bare[0]}")
+    before = len(catalog.calls)
+    await enrich(ws, [ws.JOBS.add({"url": job["url"], "codec": "aac", "sub_tasks": []}) for job in jobs])
+    if len(catalog.calls) != before: problems.append(f"{n} {type_str}: cached releases were fetched again")
+    print(f"{'ok' if not problems else 'FAIL':4s}  {n:5d} {type_str:6s} x {len(STOREFRONTS)} storefronts -> {before} requests (batch limit {limit})")
+    return problems
+
+async def run(args) -> list:
+    import web_server as ws
+    catalog = FakeCatalog()
+    threading.Thread(target=catalog.serve_forever, daemon=True).start()
+    ws.AMP_API_BASE = f"http://127.0.0.1:{catalog.server_address[1]}"
+    ws.HTTP_CLIENT = ws.create_http_client()
+    # One token above the background lane's reserve, so calls go out one per 1 / RATE
+    ws.CATALOG_LIMITER = ws.CatalogLimiter(RATE, ws.CatalogLimiter.RESERVE["background"] + 1)
+    ws.JOBS = ws.JobStore(":memory:")
+    ws.JOBS.open()
+
+    async def fake_token(storefront): return "stub-token"
+    ws.get_apple_music_dev_token = fake_token
+
+    problems = []
+    try:
+        for type_str in ("albums", "songs"):
+            for n in args.counts:
+                problems += await scenario(ws, catalog, type_str, n)
+    finally:
+        await ws.HTTP_CLIENT.aclose()
+        catalog.shutdown()
+    return problems
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--counts", default="1,99,100,101,250,301", help="jobs per storefront and type")
+    args = ap.parse_args()
+    args.counts = [int(x) for x in args.counts.split(",")]
+    problems = asyncio.run(run(args))
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
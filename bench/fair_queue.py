@@ -0,0 +1,134 @@
+"""FairQueue check: priority classes first, then sources take turns.
+
+Queues jobs through the download endpoints and asserts that a song added
+on its own is interactive, an album is album and a batch is bulk, each
+in its submitter's or batch's lane, and that an explicit priority wins.
+Then feeds web_server.FairQueue synthetic work units and asserts that:
+
+  * interactive units go before album units, which go before bulk units,
+    whatever the submission order;
+  * within a class, sources alternate, so a --paste job discography
+    queued first doesn't hold back a 3 job batch queued after it;
+  * within a source, units follow job_order(), then submission order, so
+    the tracks of one job stay in track order and a reordered job moves;
+  * remove() takes out every unit of one job and leaves the others in order;
+  * promote() puts a job's source first in its class's rotation;
+  * order() predicts the job order that get_nowait() then produces;
+  * a worker parked in get() wakes up when a unit is put.
+
+Exits non-zero on failure.
+
+    python bench/fair_queue.py
+    python bench/fair_queue.py --paste 3000
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+ids = itertools.count(1)
+problems = []
+
+def check(label: str, ok: bool, detail=""):
+    print(f"{'ok' if ok else 'FAIL':4s}  {label}")
+    if not ok: problems.append(f"{label}: {detail}")
+
+def job(source: str, priority: str = "bulk", **fields) -> dict:
+    return dict(id=next(ids), source=source, priority=priority, **fields)
+
+def drain(queue) -> list:
+    units = []
+    while (unit := queue.get_nowait()) is not None: units.append(unit)
+    return units
+
+def unit(task: dict, track=None) -> tuple:
+    return (task, track, 0.0, 0)
+
+async def entry_points(ws):
+    ws.load_config = lambda: {}
+    ws.JOBS = ws.JobStore(":memory:")
+    ws.JOBS.open()
+    client = SimpleNamespace(client=SimpleNamespace(host="10.0.0.7"))
+    song = (await ws.add_download(ws.DownloadRequest(url="https://music.apple.com/us/album/a/1?i=11"), client))["task"]
+    album = (await ws.add_download(ws.DownloadRequest(url="https://music.apple.com/us/album/a/2"), client))["task"]
+    urgent = (await ws.add_download(ws.DownloadRequest(url="https://music.apple.com/us/album/a/3", priority="interactive"), client))["task"]
+    batch = await ws.add_download_batch(ws.BatchDownloadRequest(items=[{"url": f"https://music.apple.com/us/song/s/{i}"} for i in range(3)]))
+    got = [(t["priority"], t["source"]) for t in (song, album, urgent)]
+    check("a single song is interactive, an album is album, both in the client's lane",
+          got == [("interactive", "client:10.0.0.7"), ("album", "client:10.0.0.7"), ("interactive", "client:10.0.0.7")], got)
+    batched = {(ws.JOBS.get(i)["priority"], ws.JOBS.get(i)["source"]) for i in batch["ids"]}
+    check("a batch is bulk, in one lane of its own", len(batched) == 1 and next(iter(batched))[0] == "bulk"
+          and next(iter(batched))[1].startswith("batch:"), batched)
+
+def classes(ws, args):
+    queue = ws.FairQueue()
+    jobs = [job("batch:1") for _ in range(args.paste)] + [job("client:a", "album"), job("client:b", "interactive")]
+    for task in jobs: queue.put_nowait(unit(task))
+    got = [u[0]['priority'] for u in drain(queue)]
+    check("interactive, then album, then bulk", got == ["interactive", "album"] + ["bulk"] * args.paste, got[:5])
+    check("qsize back to 0 after draining", queue.qsize() == 0, queue.qsize())
+
+def fair_share(ws, args):
+    queue = ws.FairQueue()
+    paste = [job("batch:paste") for _ in range(args.paste)]
+    small = [job("batch:small") for _ in range(3)]
+    for task in paste + small: queue.put_nowait(unit(task))
+    got = [u[0]['source'] for u in drain(queue)][:6]
+    check("a small batch takes turns with a large paste queued before it", got == ["batch:paste", "batch:small"] * 3, got)
+
+def lane_order(ws):
+    queue = ws.FairQueue()
+    first, second = job("batch:1"), job("batch:1")
+    for track in range(4): queue.put_nowait(unit(first, track))
+    queue.put_nowait(unit(second))
+    got = [(u[0]['id'], u[1]) for u in drain(queue)]
+    check("tracks of one job stay in submission order", got == [(first['id'], t) for t in range(4)] + [(second['id'], None)], got)
+    moved = job("batch:1", order=first['id'] - 1)
+    for task in (first, second, moved): queue.put_nowait(unit(task))
+    got = [u[0]['id'] for u in drain(queue)]
+    check("a job with a lower order jumps ahead in its lane", got == [moved['id'], first['id'], second['id']], got)
+
+def remove_and_promote(ws):
+    queue = ws.FairQueue()
+    a, b, c = job("batch:a"), job("batch:a"), job("batch:c")
+    for task in (a, b, c):
+        for track in range(3): queue.put_nowait(unit(task, track))
+    removed = queue.remove(b['id'])
+    check("remove() returns every unit of the job in order", [(u[0]['id'], u[1]) for u in removed] == [(b['id'], t) for t in range(3)], removed)
+    check("remove() updates qsize", queue.qsize() == 6, queue.qsize())
+    queue.promote(c)
+    predicted = queue.order()
+    got = [u[0]['id'] for u in drain(queue)]
+    check("promote() puts the job's source first", got[0] == c['id'], got)
+    check("order() matches what get_nowait() hands out", predicted == list(dict.fromkeys(got)), (predicted, got))
+    check("removed job is gone", b['id'] not in got, got)
+
+async def wakeup(ws):
+    queue = ws.FairQueue()
+    waiter = asyncio.create_task(queue.get())
+    await asyncio.sleep(0.01)
+    task = job("client:x", "interactive")
+    queue.put_nowait(unit(task))
+    got = await asyncio.wait_for(waiter, 1.0)
+    check("a parked get() wakes up on put", got[0] is task, got)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--paste", type=int, default=300, help="jobs in the large batch")
+    args = ap.parse_args()
+    import web_server as ws
+    asyncio.run(entry_points(ws))
+    classes(ws, args)
+    fair_share(ws, args)
+    lane_order(ws)
+    remove_and_promote(ws)
+    asyncio.run(wakeup(ws))
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Library index benchmark: scan, incremental rescan and re-queue lookups.
+
+Builds a synthetic save folder (artists/albums/tracks of empty .m4a files),
+indexes it with web_server.LibraryIndex and reports the first full scan, a
+rescan with nothing changed, a rescan after one album changed, and how long
+it takes to decide that every album of an artist is already on disk -- the
+work a re-queued artist costs before any downloader is spawned.
+
+    python bench/library_bench.py --artists 500 --albums 10 --tracks 20
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def build(root: str, args):
+    for a in range(args.artists):
+        for b in range(args.albums):
+            folder = os.path.join(root, f"artist-{a}", f"Album {a}-{b}")
+            os.makedirs(folder)
+            for n in range(1, args.tracks + 1):
+                open(os.path.join(folder, f"{n:02d}. Song {n}.m4a"), "w").close()
+
+def album_job(a: int, b: int, tracks: int):
+    return {'url': f"https://music.apple.com/us/album/x/{a}0{b}", 'codec': 'alac', 'album': f"Album {a}-{b}", 'artist': f"artist-{a}",
+            'sub_tasks': [{'id': f"{a}.{b}.{n}", 'title': f"Song {n}", 'track_number': n, 'url': 'u', 'status': 'pending'}
+                          for n in range(1, tracks + 1)]}
+
+def timed(label: str, fn):
+    start = time.perf_counter()
+    result = fn()
+    print(f"{label:28s} {(time.perf_counter() - start) * 1000:9.1f} ms")
+    return result
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--artists", type=int, default=500)
+    ap.add_argument("--albums", type=int, default=10, help="albums per artist")
+    ap.add_argument("--tracks", type=int, default=20, help="tracks per album")
+    args = ap.parse_args()
+
+    import web_server
+    work = tempfile.mkdtemp(prefix="amd-library-bench-")
+    try:
+        library = os.path.join(work, "ALAC")
+        build(library, args)
+        web_server.CONFIG = web_server.ConfigService(os.path.join(work, "config.yaml"))
+        web_server.CONFIG.update({'alac-save-folder': library, 'artist-folder-format': '{UrlArtistName}'})
+        roots = {'alac': library}
+        index = web_server.LibraryIndex(os.path.join(work, "library.db"))
+        index.open()
+        print(f"{args.artists * args.albums * args.tracks:,} files in {args.artists * args.albums:,} albums")
+        timed("full scan", lambda: index.scan(roots))
+        timed("rescan, nothing changed", lambda: index.scan(roots))
+        os.remove(os.path.join(library, "artist-0", "Album 0-0", "01. Song 1.m4a"))
+        timed("rescan, one album changed", lambda: index.scan(roots))
+        jobs = [album_job(1, b, args.tracks) for b in range(args.albums)]
+        missing = timed("re-queue artist (cold)", lambda: [index.missing(job) for job in jobs])
+        timed("re-queue artist (memoized)", lambda: [index.missing(job) for job in jobs])
+        print(f"albums fully present: {sum(1 for m in missing if m == [])}/{len(jobs)}")
+        index.close()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
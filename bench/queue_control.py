@@ -0,0 +1,192 @@
+"""Pause, cancel and resume check: halted jobs stop and stale work units never run.
+
+Two parts, both offline:
+
+In-process, DownloadScheduler runs with fake admission and downloads. While
+its workers hold units of job A (waiting for admission), job A is halted.
+The check asserts that none of A's units run once they get through and that
+job B still runs. It also asserts that the downloader tokens paid for A's
+units go back to CATALOG_LIMITER, as do those of a unit whose worker is
+cancelled while it waits for admission. A unit queued before a halt and
+submitted again afterwards only runs under the new epoch.
+
+Against the server on stub binaries (like e2e.py, --parallel 1, with the
+stub downloader's AMD_BENCH_RUN_LOG), three bulk albums are queued. The
+check then:
+
+  * pauses the running album: its downloader exits within HALT_GRACE, the
+    job shows as paused and the next album starts;
+  * pauses the album still waiting: it stops no process and never starts
+    while paused;
+  * cancels the running album: its downloader exits, the job fails as
+    cancelled and its downloader is not started again;
+  * resumes both paused albums: they run to completion.
+
+Exits non-zero on failure.
+
+    python bench/queue_control.py
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from e2e import BENCH, free_port, wait_ready
+
+sys.path.insert(0, os.path.dirname(BENCH))
+
+problems = []
+
+def check(label: str, ok: bool, detail=""):
+    print(f"{'ok' if ok else 'FAIL':4s}  {label}")
+    if not ok: problems.append(f"{label}: {detail}")
+
+async def epochs():
+    import web_server as ws
+    ws.JOBS = ws.JobStore(":memory:")
+    ws.JOBS.open()
+    ws.CATALOG_LIMITER = limiter = ws.CatalogLimiter(0.01, 20)  # next to no refill during the check
+    gate = asyncio.Event()
+    ran = []
+
+    class Admission:
+        async def admit(self, task, track): await gate.wait()
+        async def release(self, admitted): pass
+
+    class Wrapper:
+        async def acquire(self): return None
+        def release(self, wrapper): pass
+
+    async def download(task, wrapper): ran.append(task['id'])
+    async def track_download(task, track, wrapper): ran.append((task['id'], track))
+    ws.ADMISSION, ws.WRAPPER = Admission(), Wrapper()
+    ws.run_download, ws.run_track_download = download, track_download
+
+    scheduler = ws.SCHEDULER = ws.DownloadScheduler(2)
+    a = ws.JOBS.add({"url": "https://music.apple.com/us/album/a/1", "sub_tasks": []})
+    b = ws.JOBS.add({"url": "https://music.apple.com/us/album/b/2", "sub_tasks": []})
+    for track in range(4): scheduler.submit(a, track)
+    scheduler.submit(b)
+    scheduler.start()
+    await asyncio.sleep(0.05)  # both workers now hold a unit of A, paid for
+    await scheduler.halt(a)
+    gate.set()
+    await asyncio.sleep(0.1)
+    check("halted job's units held by workers never run", not any(isinstance(r, tuple) for r in ran), ran)
+    check("the other job still runs", b['id'] in ran, ran)
+    limiter._refill()
+    check("tokens paid for dropped units are refunded", limiter.tokens >= limiter.burst - ws.DOWNLOADER_API_COST - 0.5, limiter.tokens)
+    stale = (a, 0, time.monotonic(), 0)
+    scheduler.queue.put_nowait(stale)
+    scheduler.submit(a, 1)
+    await asyncio.sleep(0.1)
+    check("a unit from before the halt is dropped, a new one runs", [r for r in ran if isinstance(r, tuple)] == [(a['id'], 1)], ran)
+    gate.clear()
+    limiter._refill()
+    paid = limiter.tokens
+    scheduler.submit(ws.JOBS.add({"url": "https://music.apple.com/us/album/c/3", "sub_tasks": []}))
+    await asyncio.sleep(0.05)  # a worker holds C, paid for, waiting for admission
+    await scheduler.stop()
+    limiter._refill()
+    check("tokens of a unit cancelled while waiting for admission are refunded", limiter.tokens >= paid - 0.5, (paid, limiter.tokens))
+
+def runs(run_log: str) -> list:
+    if not os.path.exists(run_log): return []
+    with open(run_log) as f: return [(kind, int(pid), float(at), url.strip()) for kind, pid, at, url in (line.split(" ", 3) for line in f)]
+
+def running(run_log: str) -> dict:
+    """url -> pid of downloaders started and not yet ended."""
+    live = {}
+    for kind, pid, _, url in runs(run_log):
+        if kind == "start": live[url] = pid
+        elif live.get(url) == pid: del live[url]
+    return live
+
+async def until(predicate, timeout: float, step: float = 0.1):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await predicate(): return True
+        await asyncio.sleep(step)
+    return False
+
+async def server(args, base: str, run_log: str):
+    async with httpx.AsyncClient(base_url=base, timeout=30) as client:
+        await wait_ready(client, "/api/queue?since=0&limit=1")
+        urls = [f"https://music.apple.com/us/album/bench-album/{args.id_base + i}" for i in range(3)]
+        ids = (await client.post("/api/download/batch", json={"items": [{"url": u} for u in urls]})).json()["ids"]
+        jobs = dict(zip(ids, urls))
+
+        async def status(job_id):
+            return next(t for t in (await client.get("/api/queue")).json() if t['id'] == job_id)
+
+        async def started(job_id): return jobs[job_id] in running(run_log)
+        first, second, third = ids
+        check("first album starts", await until(lambda: started(first), 30))
+
+        paused = (await client.post(f"/api/queue/{first}/pause")).json()
+        check("pausing the running album stops its downloader", paused.get("stopped") == 1 and not await started(first), paused)
+        check("paused album shows as paused", (await status(first))['status'] == 'paused')
+        check("next album starts", await until(lambda: started(second), 30))
+
+        waiting = (await client.post(f"/api/queue/{third}/pause")).json()
+        check("pausing a waiting album stops nothing", waiting.get("stopped") == 0, waiting)
+
+        cancelled = (await client.post(f"/api/queue/{second}/cancel")).json()
+        task = await status(second)
+        check("cancelling the running album stops its downloader", cancelled.get("stopped") == 1 and not await started(second), cancelled)
+        check("cancelled album fails as cancelled", task['status'] == 'failed' and task.get('error') == 'cancelled', task.get('status'))
+        await asyncio.sleep(args.track_seconds * 2)
+        check("paused album doesn't start while paused", jobs[third] not in {url for kind, _, _, url in runs(run_log)})
+
+        for job_id in (first, third): (await client.post(f"/api/queue/{job_id}/resume")).raise_for_status()
+        async def finished():
+            return all([(await status(i))['status'] == 'completed' for i in (first, third)])
+        check("resumed albums complete", await until(finished, args.tracks * args.track_seconds * 4 + 30, 0.5))
+        starts = [url for kind, _, _, url in runs(run_log) if kind == "start"]
+        check("cancelled album never restarts", starts.count(jobs[second]) == 1, starts)
+        check("each resumed album ran once more", starts.count(jobs[first]) == 2 and starts.count(jobs[third]) == 1, starts)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--tracks", type=int, default=4, help="tracks per album")
+    ap.add_argument("--track-seconds", type=float, default=1.0, help="stub downloader time per track")
+    ap.add_argument("--id-base", type=int, default=3000000)
+    ap.add_argument("--keep", action="store_true", help="keep the server's temp dir")
+    args = ap.parse_args()
+
+    asyncio.run(epochs())
+
+    root = tempfile.mkdtemp(prefix="amd-queue-")
+    run_log = os.path.join(root, "runs.log")
+    api_port, server_port = free_port(), free_port()
+    env = dict(os.environ, AMD_BENCH_TRACKS=str(args.tracks), AMD_BENCH_TRACK_SECONDS=str(args.track_seconds), AMD_BENCH_RUN_LOG=run_log)
+    log = open(os.path.join(root, "server.log"), "w")
+    api = subprocess.Popen([sys.executable, os.path.join(BENCH, "stubs", "amp_api.py"), "--port", str(api_port), "--latency", "0.01"],
+                           env=env, stdout=log, stderr=subprocess.STDOUT)
+    server_proc = subprocess.Popen([sys.executable, os.path.join(BENCH, "stubs", "serve.py"), "--root", root, "--port", str(server_port),
+                                    "--api", f"http://127.0.0.1:{api_port}", "--parallel", "1",
+                                    "--wrapper-ports", f"{free_port()},{free_port()}"],
+                                   env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        asyncio.run(server(args, f"http://127.0.0.1:{server_port}", run_log))
+    finally:
+        server_proc.terminate()
+        api.terminate()
+        for proc in (server_proc, api):
+            try: proc.wait(10)
+            except subprocess.TimeoutExpired: proc.kill()
+        log.close()
+        if args.keep: print(f"state, run log and server log kept in {root}")
+        else: shutil.rmtree(root, ignore_errors=True)
+
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
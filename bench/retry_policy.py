@@ -0,0 +1,202 @@
+"""Retry policy check: failure classification, backoff, retry budget and re-dispatch.
+
+Runs web_server.classify_failure over downloader output samples and drives
+a RetryController with in-memory jobs, without waiting out real backoffs.
+It asserts that:
+
+  * each sample is classified as the expected permanent or transient
+    reason. The last matching line decides, a vanished wrapper counts as
+    transient and no output at all is transient 'unknown'. Only the
+    downloader's not-available-in-region message is permanent, not any line
+    naming a region or storefront;
+  * permanent failures fail the job at once, with no retry scheduled;
+  * transient failures are retried RETRY_MAX_ATTEMPTS times, each delay
+    within [cap / 2, cap] for cap = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY *
+    2 ** (attempt - 1)). The next failure fails the job;
+  * a burst of failures beyond RETRY_BUDGET_BURST is spread out at
+    RETRY_BUDGET_RATE;
+  * a whole-album job that failed after some tracks landed switches to track
+    mode, and a failed track leaves its job running;
+  * an expired backoff re-dispatches the job or track, and cancel_job()
+    drops pending timers;
+  * on a single slot, with the fake downloader failing one album with a
+    network error, an album queued behind it still completes while the
+    first waits out its backoff holding no slot;
+  * a downloader binary that is missing or not executable fails the job as
+    permanent, with no retry scheduled.
+
+Exits non-zero on failure.
+
+    python bench/retry_policy.py
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+FAKE_DOWNLOADER = """#!{python}
+import sys
+if "flaky" in sys.argv[-1]:
+    print("read tcp 10.0.0.2:5123: connection reset by peer")
+    sys.exit(1)
+print("Completed")
+"""
+
+SAMPLES = [
+    (["Track 3 of 12:", "Failed to get track info: 404 not found"], "permanent", "not_found"),
+    (["This album is not available in your storefront"], "permanent", "unavailable"),
+    (["Track 4 of 9: song is unavailable in your region"], "permanent", "unavailable"),
+    (["Storefront changed, refetching album"], "transient", "unknown"),  # naming a storefront isn't enough
+    (["region lookup failed"], "transient", "unknown"),
+    (["Error: invalid url"], "permanent", "not_found"),
+    (["No ALAC available for this track"], "permanent", "unsupported"),
+    (["401 Unauthorized: check media-user-token"], "permanent", "auth"),
+    (["Get \"https://amp-api.music.apple.com/...\": dial tcp: i/o timeout"], "transient", "network"),
+    (["read tcp 10.0.0.2:5123: connection reset by peer"], "transient", "network"),
+    (["dial tcp 127.0.0.1:10020: connect: connection refused"], "transient", "wrapper"),
+    (["failed to decrypt sample"], "transient", "wrapper"),
+    (["HTTP 429 Too Many Requests"], "transient", "rate_limited"),
+    (["503 Service Unavailable"], "transient", "server_error"),
+    (["404 not found", "connection reset by peer"], "transient", "network"),  # the last line decides
+    (["connection reset by peer", "404 not found"], "permanent", "not_found"),
+    (["panic: something odd"], "transient", "unknown"),
+    ([], "transient", "unknown"),
+]
+
+problems = []
+
+def check(label: str, ok: bool, detail=""):
+    print(f"{'ok' if ok else 'FAIL':4s}  {label}")
+    if not ok: problems.append(f"{label}: {detail}")
+
+def classification(ws):
+    wrong = [(lines, ws.classify_failure(lines)[:2], (kind, reason)) for lines, kind, reason in SAMPLES
+             if ws.classify_failure(lines)[:2] != (kind, reason)]
+    check(f"classify_failure on {len(SAMPLES)} downloader outputs", not wrong, wrong)
+
+    class Restarting:
+        ready = asyncio.Event()
+    check("a wrapper restart with no telling output is transient", ws.classify_failure(["exit status 1"], Restarting())[:2] == ("transient", "wrapper"))
+
+def album(ws, tracks=0, **fields) -> dict:
+    sub_tasks = [{"id": f"t{i}", "url": f"https://music.apple.com/us/album/x/1?i={i}", "track_number": i + 1, "title": f"Song {i}", "status": "pending"}
+                 for i in range(tracks)]
+    return ws.JOBS.add(dict({"url": "https://music.apple.com/us/album/x/1", "codec": "alac", "title": "Bench", "sub_tasks": sub_tasks}, **fields))
+
+async def backoff(ws):
+    ws.RETRY_BUDGET_BURST = 10_000
+    retries = ws.RETRIES = ws.RetryController()
+    task = album(ws)
+    await retries.failed(task, None, "permanent", "not_found", "404 not found")
+    check("permanent failure fails at once", task['status'] == 'failed' and task.get('failure') == 'permanent' and not retries.timers, task['status'])
+
+    task = album(ws)
+    delays, bad = [], []
+    for attempt in range(1, ws.RETRY_MAX_ATTEMPTS + 1):
+        await retries.failed(task, None, "transient", "network", "connection reset")
+        delays.append(task['retry_at'] - time.time())
+        cap = min(ws.RETRY_MAX_DELAY, ws.RETRY_BASE_DELAY * 2 ** (attempt - 1))
+        if not (cap / 2 - 0.1 <= delays[-1] <= cap + 0.1) or task['status'] != 'pending' or task['attempts'] != attempt:
+            bad.append(f"attempt {attempt}: delay {delays[-1]:.1f}s outside [{cap / 2}, {cap}] or job {task['status']}")
+    print(f"      backoff delays: {', '.join(f'{d:.1f}s' for d in delays)}")
+    check("transient failures back off exponentially with jitter", not bad, bad)
+    check("one retry timer per waiting job", list(retries.timers) == [(task['id'], None)], list(retries.timers))
+    retries.cancel(task['id'])  # as if the last retry had fired and run
+    await retries.failed(task, None, "transient", "network", "connection reset")
+    check(f"gives up after {ws.RETRY_MAX_ATTEMPTS} retries", task['status'] == 'failed' and not retries.timers, task['status'])
+
+async def budget(ws):
+    ws.RETRY_BUDGET_BURST, ws.RETRY_BUDGET_RATE = 5, 0.5
+    retries = ws.RETRIES = ws.RetryController()
+    jobs = [album(ws) for _ in range(8)]
+    for task in jobs: await retries.failed(task, None, "transient", "server_error", "503")
+    delays = [task['retry_at'] - time.time() for task in jobs]
+    spread = [d >= (i + 1) / ws.RETRY_BUDGET_RATE - 0.1 for i, d in enumerate(delays[ws.RETRY_BUDGET_BURST:])]
+    check(f"retries past a burst of {ws.RETRY_BUDGET_BURST} are spaced at {ws.RETRY_BUDGET_RATE}/s", all(spread), [round(d, 1) for d in delays])
+    retries.cancel_job(jobs[0]['id'])
+    check("cancel_job() drops the job's timer", (jobs[0]['id'], None) not in retries.timers and len(retries.timers) == 7)
+    for task in jobs: retries.cancel_job(task['id'])
+
+async def tracks(ws):
+    ws.RETRY_BUDGET_BURST = 10_000
+    retries = ws.RETRIES = ws.RetryController()
+    task = album(ws, tracks=4)
+    task['sub_tasks'][0]['status'] = task['sub_tasks'][1]['status'] = 'completed'
+    task['sub_tasks'][2]['status'] = 'downloading'
+    await retries.failed(task, None, "transient", "network", "timeout")
+    check("album failing after some tracks switches to track mode", task.get('track_mode') and [st['status'] for st in task['sub_tasks']] == ['completed', 'completed', 'pending', 'pending'],
+          (task.get('track_mode'), [st['status'] for st in task['sub_tasks']]))
+    retries.cancel_job(task['id'])
+
+    task = album(ws, tracks=3, track_mode=True, status='downloading')
+    await retries.failed(task, 1, "transient", "wrapper", "failed to decrypt")
+    st = task['sub_tasks'][1]
+    check("a failed track waits alone, its job keeps running", task['status'] == 'downloading' and st['status'] == 'pending' and st['attempts'] == 1
+          and list(retries.timers) == [(task['id'], 1)], (task['status'], st))
+
+    submitted, dispatched = [], []
+    ws.SCHEDULER.submit = lambda job, track=None: submitted.append((job['id'], track))
+    ws.dispatch_job = lambda job: dispatched.append(job['id'])
+    ws.RETRY_BASE_DELAY = 0.05
+    whole = album(ws)
+    await retries.failed(whole, None, "transient", "network", "timeout")
+    await retries.failed(task, 1, "transient", "wrapper", "failed to decrypt")
+    await asyncio.sleep(0.3)
+    check("expired backoffs re-dispatch the job and re-submit the track", dispatched == [whole['id']] and submitted == [(task['id'], 1)] and not retries.timers,
+          (dispatched, submitted))
+
+async def outage(ws):
+    ws.RETRY_BUDGET_BURST, ws.RETRY_BASE_DELAY = 10_000, 30.0
+    ws.RETRIES = ws.RetryController()
+    root = tempfile.mkdtemp(prefix="amd-retry-")
+    ws.DOWNLOADER_BIN = os.path.join(root, "apple-music-downloader")
+    with open(ws.DOWNLOADER_BIN, "w") as f: f.write(FAKE_DOWNLOADER.format(python=sys.executable))
+    os.chmod(ws.DOWNLOADER_BIN, 0o755)
+    ws.APP_DIR = root
+    ws.SCHEDULER = ws.DownloadScheduler(1)
+    ws.SCHEDULER.start()
+    flaky = album(ws, url="https://music.apple.com/us/album/flaky/1", status="pending")
+    healthy = album(ws, url="https://music.apple.com/us/album/healthy/2", status="pending")
+    for task in (flaky, healthy): ws.dispatch_job(task)
+    for _ in range(200):
+        if healthy['status'] == 'completed': break
+        await asyncio.sleep(0.02)
+    check("a job waiting on a retry holds no slot", healthy['status'] == 'completed' and flaky['status'] == 'pending'
+          and flaky.get('retry_at', 0) > time.time() and ws.SCHEDULER.slots.active == 0,
+          (flaky['status'], healthy['status'], ws.SCHEDULER.slots.active))
+    ws.RETRIES.cancel_job(flaky['id'])
+    await ws.SCHEDULER.stop()
+    shutil.rmtree(root, ignore_errors=True)
+
+async def spawn(ws):
+    root = tempfile.mkdtemp(prefix="amd-retry-")
+    ws.APP_DIR = root
+    broken = os.path.join(root, "not-executable")
+    with open(broken, "w") as f: f.write("#!/bin/sh\n")
+    for label, path in (("missing", os.path.join(root, "missing")), ("non-executable", broken)):
+        ws.DOWNLOADER_BIN = path
+        task = album(ws, status="pending")
+        await ws.run_download(task)
+        check(f"a {label} downloader binary fails the job as permanent", (task['status'], task.get('failure'), task.get('error')) == ("failed", "permanent", "spawn_failed")
+              and (task['id'], None) not in ws.RETRIES.timers, (task['status'], task.get('failure'), task.get('error')))
+    shutil.rmtree(root, ignore_errors=True)
+
+async def main():
+    import web_server as ws
+    ws.JOBS = ws.JobStore(":memory:")
+    ws.JOBS.open()
+    classification(ws)
+    await backoff(ws)
+    await budget(ws)
+    await outage(ws)
+    await spawn(ws)
+    await tracks(ws)
+
+if __name__ == "__main__":
+    asyncio.run(main())
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
@@ -0,0 +1,167 @@
+"""Scheduler concurrency check: running downloads never exceed the parallel limit.
+
+Runs web_server.DownloadScheduler in-process with DOWNLOADER_BIN pointed at a
+fake apple-music-downloader, and with admission control always letting units
+in, so the scheduler's own slots are all that bounds concurrency. Each fake run appends "start <pid> <time>" to a
+run log as soon as it is up, then blocks until the check releases it by pid,
+and appends "end <pid> <time>" before it exits. Runs only end when the check
+says so, so every resize happens while no downloader is being spawned.
+
+The check queues --jobs albums and walks the limit through --limits. After
+each resize it releases --releases runs, one at a time, and waits for the
+scheduler to settle each time. Concurrency is counted from the fake's own
+start and end timestamps, and the check fails if:
+
+  * a run starts while as many runs as the current limit are running, so
+    after a shrink nothing starts until enough runs have ended;
+  * the pool doesn't fill up to the limit while albums are waiting;
+  * a job is left unfinished.
+
+    python bench/scheduler_concurrency.py
+    python bench/scheduler_concurrency.py --jobs 60 --limits 6,1,8,2,5 --releases 6
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+FAKE_DOWNLOADER = """#!{python}
+import os, sys, time
+pid = os.getpid()
+with open({log!r}, "a") as f: f.write(f"start {{pid}} {{time.time():.6f}}\\n")
+while not os.path.exists(os.path.join({gate!r}, str(pid))): time.sleep(0.005)
+with open({log!r}, "a") as f: f.write(f"end {{pid}} {{time.time():.6f}}\\n")
+print("Completed")
+"""
+
+class RunLog:
+    """The fake downloader's start/end lines, replayed against the limits the check set."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.limits = []  # (time.time() of the resize, limit)
+        self.problems = []
+
+    def events(self) -> list:
+        if not os.path.exists(self.path): return []
+        with open(self.path) as f:
+            return sorted(((kind, int(pid), float(at)) for kind, pid, at in (line.split() for line in f if line.endswith("\n"))),
+                          key=lambda e: e[2])
+
+    def running(self) -> list:
+        pids = []
+        for kind, pid, _ in self.events():
+            if kind == "start": pids.append(pid)
+            else: pids.remove(pid)
+        return pids
+
+    def limit_at(self, at: float) -> int:
+        return [limit for since, limit in self.limits if since <= at][-1]
+
+    def replay(self) -> int:
+        """Check every start against the limit in force; returns the peak concurrency."""
+        running = peak = 0
+        for kind, pid, at in self.events():
+            if kind == "end":
+                running -= 1
+                continue
+            if running >= self.limit_at(at):
+                self.problems.append(f"run {pid} started at {at:.3f} with {running} running, limit {self.limit_at(at)}")
+            running += 1
+            peak = max(peak, running)
+        return peak
+
+async def settle(ws, log: RunLog, expected: int, timeout: float, quiet: float = 0.3) -> bool:
+    """Wait until `expected` runs are up and nothing else starts for `quiet` seconds."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if len(log.running()) >= expected:
+            await asyncio.sleep(quiet)
+            if len(log.running()) == expected: return True
+            if len(log.running()) > expected: break
+        await asyncio.sleep(0.02)
+    log.problems.append(f"expected {expected} runs at limit {ws.SCHEDULER.slots.limit}, found {len(log.running())}")
+    return False
+
+class OpenAdmission:
+    """Stands in for ADMISSION: never holds a unit back for disk, memory or I/O."""
+    async def admit(self, task, track): return None
+    async def release(self, admitted): pass
+
+def target(limit: int, running: int, waiting: int) -> int:
+    """Runs there should be once the scheduler settles: the limit if there is work for it, never fewer than are running."""
+    return max(running, min(limit, running + waiting))
+
+async def drive(ws, args, log: RunLog, gate: str) -> list:
+    ws.JOBS = ws.JobStore(":memory:")
+    ws.JOBS.open()
+    jobs = [ws.JOBS.add({"url": f"https://music.apple.com/us/album/bench/{i + 1}", "codec": "alac", "status": "pending", "sub_tasks": []})
+            for i in range(args.jobs)]
+    ws.SCHEDULER = ws.DownloadScheduler(args.parallel)
+    log.limits.append((0.0, args.parallel))
+    ws.SCHEDULER.start()
+    for job in jobs: ws.SCHEDULER.submit(job)
+    started = lambda: sum(1 for kind, _, _ in log.events() if kind == "start")
+
+    async def release(pid: int):
+        open(os.path.join(gate, str(pid)), "w").close()
+        while pid in log.running(): await asyncio.sleep(0.005)
+
+    await settle(ws, log, target(args.parallel, 0, args.jobs), args.timeout)
+    for limit in args.limits:
+        log.limits.append((time.time(), limit))
+        await ws.SCHEDULER.resize(limit)
+        await settle(ws, log, target(limit, len(log.running()), args.jobs - started()), args.timeout)
+        for _ in range(args.releases):
+            running, waiting = log.running(), args.jobs - started()
+            if not running: break
+            await release(running[0])
+            await settle(ws, log, target(limit, len(running) - 1, waiting), args.timeout)
+        print(f"limit {limit}  running {len(log.running())}  started {started()}/{args.jobs}")
+    deadline = time.monotonic() + args.timeout
+    while any(job["status"] in ("pending", "downloading") for job in jobs) and time.monotonic() < deadline:
+        for pid in log.running(): open(os.path.join(gate, str(pid)), "w").close()
+        await asyncio.sleep(0.05)
+    await ws.SCHEDULER.stop()
+    return jobs
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--jobs", type=int, default=40)
+    ap.add_argument("--parallel", type=int, default=3, help="limit at startup")
+    ap.add_argument("--limits", default="5,2,1,6,3", help="limits to switch to, in order")
+    ap.add_argument("--releases", type=int, default=4, help="runs to let finish at each limit")
+    ap.add_argument("--timeout", type=float, default=10, help="seconds to wait for the scheduler to settle")
+    args = ap.parse_args()
+    args.limits = [int(x) for x in args.limits.split(",")]
+
+    import web_server as ws
+    root = tempfile.mkdtemp(prefix="amd-sched-")
+    gate = os.path.join(root, "gate")
+    os.mkdir(gate)
+    log = RunLog(os.path.join(root, "runs.log"))
+    ws.DOWNLOADER_BIN = os.path.join(root, "apple-music-downloader")
+    with open(ws.DOWNLOADER_BIN, "w") as f: f.write(FAKE_DOWNLOADER.format(python=sys.executable, log=log.path, gate=gate))
+    os.chmod(ws.DOWNLOADER_BIN, 0o755)
+    ws.APP_DIR = root
+    ws.ADMISSION = OpenAdmission()
+    try:
+        jobs = asyncio.run(drive(ws, args, log, gate))
+        peak = log.replay()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    unfinished = [job["id"] for job in jobs if job["status"] != "completed"]
+    if unfinished: log.problems.append(f"{len(unfinished)} jobs not completed: {unfinished[:10]}")
+    print(f"limits {args.parallel} -> {' -> '.join(map(str, args.limits))}  peak concurrency {peak}")
+    for problem in log.problems: print(f"FAIL  {problem}")
+    if log.problems: sys.exit(1)
+    print("ok")
+
+if __name__ == "__main__":
+    main()
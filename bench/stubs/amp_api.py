@@ -0,0 +1,107 @@
+"""Fake amp-api and music.apple.com for offline benchmarks.
+
+Serves just enough for web_server: the browse page and JS bundle the
+developer token is scraped from, catalog search, artists (with views and
+paged view listings) and multi-id albums/songs lookups, all generated
+deterministically from the ids. Albums have AMD_BENCH_TRACKS tracks, the
+same count the stub downloader reports. Every catalog response waits
+--latency seconds.
+
+    python bench/stubs/amp_api.py --port 18081 --latency 0.05
+"""
+import argparse
+import asyncio
+import os
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, PlainTextResponse
+
+TRACKS = int(os.environ.get("AMD_BENCH_TRACKS", 4))
+# {"alg":"ES256"}.{"exp":4102444800}.sig -- expires in 2100
+TOKEN = "eyJhbGciOiJFUzI1NiJ9.eyJleHAiOjQxMDI0NDQ4MDB9.YmVuY2g"
+ARTWORK = "https://is1-ssl.mzstatic.com/image/thumb/Music/bench/{id}/source/{w}x{h}bb.jpg"
+LATENCY = 0.0
+
+app = FastAPI()
+
+def album(sf: str, album_id: str, tracks: bool = False) -> dict:
+    n = int(album_id) if album_id.isdigit() else 0
+    item = {"id": album_id, "type": "albums", "attributes": {
+        "name": f"Bench Album {album_id}", "artistName": f"Bench Artist {n % 500}", "trackCount": TRACKS,
+        "url": f"https://music.apple.com/{sf}/album/bench-album/{album_id}", "releaseDate": "2020-01-01",
+        "artwork": {"url": ARTWORK.format(id=album_id, w="{w}", h="{h}")}}}
+    if tracks:
+        item["relationships"] = {"tracks": {"data": [song(sf, f"{album_id}{i:02d}", album_id, i) for i in range(1, TRACKS + 1)]}}
+    return item
+
+def song(sf: str, song_id: str, album_id: str = "1", number: int = 1) -> dict:
+    return {"id": song_id, "type": "songs", "attributes": {
+        "name": f"Bench Song {number}", "artistName": "Bench Artist", "albumName": f"Bench Album {album_id}",
+        "trackNumber": number, "discNumber": 1, "releaseDate": "2020-01-01",
+        "url": f"https://music.apple.com/{sf}/album/bench-album/{album_id}?i={song_id}",
+        "artwork": {"url": ARTWORK.format(id=album_id, w="{w}", h="{h}")}}}
+
+def artist(sf: str, artist_id: str) -> dict:
+    return {"id": artist_id, "type": "artists", "attributes": {
+        "name": f"Bench Artist {artist_id}", "url": f"https://music.apple.com/{sf}/artist/bench-artist/{artist_id}"}}
+
+def resource(sf: str, type_str: str, item_id: str, tracks: bool = False) -> dict:
+    if type_str == "albums": return album(sf, item_id, tracks)
+    if type_str == "artists": return artist(sf, item_id)
+    item = song(sf, item_id)
+    item["type"] = type_str
+    return item
+
+@app.middleware("http")
+async def latency(request: Request, call_next):
+    if request.url.path.startswith("/v1/"): await asyncio.sleep(LATENCY)
+    return await call_next(request)
+
+@app.get("/{sf}/browse", response_class=HTMLResponse)
+async def browse(sf: str):
+    return '<html><script type="module" src="/assets/index-legacy-bench.js"></script></html>'
+
+@app.get("/assets/{name}", response_class=PlainTextResponse)
+async def bundle(name: str):
+    return f'const config={{token:"{TOKEN}"}};'
+
+@app.get("/v1/catalog/{sf}/search")
+async def search(sf: str, term: str, types: str = "songs,albums", limit: int = 10):
+    seed = sum(map(ord, term))
+    results = {}
+    for type_str in types.split(","):
+        results[type_str] = {"data": [resource(sf, type_str, str(seed * 100 + i)) for i in range(limit)]}
+    return {"results": results}
+
+@app.get("/v1/catalog/{sf}/artists/{artist_id}")
+async def get_artist(sf: str, artist_id: str):
+    base = int(artist_id) * 1000 if artist_id.isdigit() else 0
+    views = {view: {"data": [album(sf, str(base + offset * 100 + i)) for i in range(10)]}
+             for offset, view in enumerate(("full-albums", "singles", "compilations"))}
+    return {"data": [dict(artist(sf, artist_id), views=views)]}
+
+@app.get("/v1/catalog/{sf}/artists/{artist_id}/view/{view}")
+async def artist_view(sf: str, artist_id: str, view: str, limit: int = 100, offset: int = 0):
+    base = int(artist_id) * 1000 if artist_id.isdigit() else 0
+    total = 150 if view == "full-albums" else 20
+    page = [album(sf, str(base + i)) for i in range(offset, min(total, offset + limit))]
+    body = {"data": page}
+    if offset + limit < total: body["next"] = f"/v1/catalog/{sf}/artists/{artist_id}/view/{view}?offset={offset + limit}&limit={limit}"
+    return body
+
+@app.get("/v1/catalog/{sf}/{type_str}")
+async def lookup(sf: str, type_str: str, ids: str = "", include: str = ""):
+    return {"data": [resource(sf, type_str, i, tracks="tracks" in include) for i in ids.split(",") if i]}
+
+def main():
+    global LATENCY
+    import uvicorn
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=18081)
+    ap.add_argument("--latency", type=float, default=0.05)
+    args = ap.parse_args()
+    LATENCY = args.latency
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+if __name__ == "__main__":
+    main()
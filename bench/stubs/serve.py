@@ -0,0 +1,63 @@
+"""Run web_server sandboxed for benchmarks: stub binaries, fake amp-api, temp state.
+
+Every path the server would keep under /app is moved into --root, the
+downloader and wrapper are the stubs next to this file, and amp-api and
+music.apple.com point at a local amp_api.py. Nothing touches the network or
+the real config. The server runs with the repo root as its working directory
+so the UI and static files resolve.
+
+    python bench/stubs/serve.py --root /tmp/amd-bench --port 18080 --api http://127.0.0.1:18081
+"""
+import argparse
+import os
+import sys
+
+STUBS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(os.path.dirname(STUBS))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--root", required=True, help="directory for config, jobs, downloads and wrapper data")
+    ap.add_argument("--port", type=int, default=18080)
+    ap.add_argument("--api", required=True, help="base URL of the fake amp-api")
+    ap.add_argument("--parallel", type=int, default=3)
+    ap.add_argument("--wrapper-ports", default="18020,18021", help="decrypt,m3u8 ports for the stub wrapper")
+    args = ap.parse_args()
+
+    os.chdir(REPO)
+    sys.path.insert(0, REPO)
+    import uvicorn
+    import web_server as ws
+
+    root = os.path.abspath(args.root)
+    config_dir = os.path.join(root, "config")
+    for d in (config_dir, os.path.join(root, "app"), os.path.join(root, "downloads")): os.makedirs(d, exist_ok=True)
+    ws.APP_DIR = os.path.join(root, "app")
+    ws.CONFIG_PATH = os.path.join(config_dir, "config.yaml")
+    ws.CONFIG = ws.ConfigService(ws.CONFIG_PATH)
+    decrypt, m3u8 = args.wrapper_ports.split(",")
+    os.environ["AMD_BENCH_WRAPPER_PORTS"] = args.wrapper_ports
+    ws.CONFIG.update({
+        "alac-save-folder": os.path.join(root, "downloads", "ALAC"),
+        "aac-save-folder": os.path.join(root, "downloads", "AAC"),
+        "atmos-save-folder": os.path.join(root, "downloads", "Atmos"),
+        "decrypt-m3u8-port": f"127.0.0.1:{decrypt}",
+        "get-m3u8-port": f"127.0.0.1:{m3u8}",
+        "storefront": "us",
+    })
+    ws.JOBS.path = os.path.join(config_dir, "jobs.db")
+    ws.LIBRARY.path = os.path.join(config_dir, "library.db")
+    ws.CATALOG_CACHE.path = os.path.join(config_dir, "catalog_cache.db")
+    ws.ARTWORK.path = os.path.join(config_dir, "artwork")
+    ws.WATCHLIST.path = os.path.join(config_dir, "watchlist.db")
+    ws.DEV_TOKENS.path = os.path.join(config_dir, "dev_tokens.json")
+    ws.WRAPPER_DATA = os.path.join(root, "wrapper_data")
+    ws.WRAPPER_BIN = os.path.join(STUBS, "wrapper")
+    ws.DOWNLOADER_BIN = os.path.join(STUBS, "apple-music-downloader")
+    ws.AMP_API_BASE = ws.MUSIC_WEB_BASE = args.api.rstrip("/")
+    ws.MAX_PARALLEL = args.parallel
+    ws.SCHEDULER = ws.DownloadScheduler(args.parallel)
+    uvicorn.run(ws.app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+if __name__ == "__main__":
+    main()
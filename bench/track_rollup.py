@@ -0,0 +1,166 @@
+"""Track-mode check: album tracks run as separate --song units and roll back up into the album.
+
+Runs web_server.DownloadScheduler in-process against a fake
+apple-music-downloader that logs its command line and fails for track ids
+listed in a "fail" directory. It asserts that:
+
+  * finish_track_job() gives the album the right status and progress for
+    every mix of track results;
+  * a track-mode album is queued as one --song unit per track, spread
+    across the pool's slots at the same time;
+  * a failed track fails the album only once its siblings are done, with
+    "1 of N tracks failed";
+  * retrying the album's failed tracks runs only those tracks again and
+    completes the album;
+  * dispatch_job() skips finished tracks, and rolls an album with none left
+    up at once.
+
+Exits non-zero on failure.
+
+    python bench/track_rollup.py
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+FAKE_DOWNLOADER = """#!{python}
+import os, sys, time
+url = sys.argv[-1]
+with open({log!r}, "a") as f: f.write(f"start {{time.time():.6f}} {{' '.join(sys.argv[1:])}}\\n")
+print("Track 1 of 1:")
+print("Bench Song")
+time.sleep({seconds})
+with open({log!r}, "a") as f: f.write(f"end {{time.time():.6f}} {{url}}\\n")
+if os.path.exists(os.path.join({fail!r}, url.rsplit("=", 1)[-1])):
+    print("Failed to get track info: 404 not found")
+    sys.exit(1)
+print("Completed")
+"""
+
+ROLLUPS = [
+    (["completed"] * 4, "completed", "100% Done"),
+    (["completed", "skipped", "skipped", "completed"], "completed", "100% Done"),
+    (["completed", "completed", "pending", "downloading"], "downloading", "Track 2/4 (50%)"),
+    (["completed", "failed", "pending", "pending"], "downloading", "Track 2/4 (50%)"),
+    (["completed", "failed", "skipped", "completed"], "failed", "1 of 4 tracks failed"),
+    (["failed"] * 3, "failed", "3 of 3 tracks failed"),
+]
+
+class Fake:
+    """The fake downloader's files: its run log and the track ids it fails."""
+
+    def __init__(self, root: str):
+        self.log = os.path.join(root, "runs.log")
+        self.fail = os.path.join(root, "fail")
+        os.mkdir(self.fail)
+
+    def runs(self) -> list:
+        """(start, end, command line) per finished run."""
+        if not os.path.exists(self.log): return []
+        starts, runs = {}, []
+        with open(self.log) as f:
+            for kind, at, rest in (line.rstrip("\n").split(" ", 2) for line in f):
+                url = rest.split()[-1]
+                if kind == "start": starts[url] = (float(at), rest)
+                else: runs.append((starts[url][0], float(at), starts[url][1]))
+        return runs
+
+    def clear(self):
+        if os.path.exists(self.log): os.remove(self.log)
+
+def album(ws, tracks: int, statuses=None, **fields) -> dict:
+    statuses = statuses or ["pending"] * tracks
+    sub_tasks = [{"url": f"https://music.apple.com/us/album/bench/9?i={900 + i}", "track_number": i + 1,
+                  "title": f"Song {i + 1}", "status": status} for i, status in enumerate(statuses)]
+    return ws.JOBS.add(dict({"url": "https://music.apple.com/us/album/bench/9", "codec": "alac", "title": "Bench",
+                             "status": "pending", "track_mode": True, "sub_tasks": sub_tasks}, **fields))
+
+async def finished(task: dict, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while task["status"] not in ("completed", "failed") and time.monotonic() < deadline: await asyncio.sleep(0.02)
+
+def peak(runs: list) -> int:
+    edges = sorted([(start, 1) for start, _, _ in runs] + [(end, -1) for _, end, _ in runs])
+    running = top = 0
+    for _, step in edges:
+        running += step
+        top = max(top, running)
+    return top
+
+async def main():
+    import web_server as ws
+    problems = []
+
+    def check(label: str, ok: bool, detail=""):
+        print(f"{'ok' if ok else 'FAIL':4s}  {label}")
+        if not ok: problems.append(f"{label}: {detail}")
+
+    root = tempfile.mkdtemp(prefix="amd-tracks-")
+    fake = Fake(root)
+    ws.DOWNLOADER_BIN = os.path.join(root, "apple-music-downloader")
+    with open(ws.DOWNLOADER_BIN, "w") as f: f.write(FAKE_DOWNLOADER.format(python=sys.executable, log=fake.log, fail=fake.fail, seconds=0.3))
+    os.chmod(ws.DOWNLOADER_BIN, 0o755)
+    ws.APP_DIR = root
+    ws.JOBS = ws.JobStore(":memory:")
+    ws.JOBS.open()
+    ws.SCHEDULER = ws.DownloadScheduler(3)
+    ws.SCHEDULER.start()
+    try:
+        wrong = []
+        for statuses, status, progress in ROLLUPS:
+            task = album(ws, len(statuses), statuses, status="downloading")
+            ws.finish_track_job(task)
+            if (task["status"], task["progress"]) != (status, progress): wrong.append((statuses, task["status"], task["progress"]))
+        check(f"finish_track_job over {len(ROLLUPS)} status combinations", not wrong, wrong)
+
+        task = album(ws, 6)
+        ws.dispatch_job(task)
+        await finished(task)
+        runs = fake.runs()
+        urls = sorted(cmd.split()[-1] for _, _, cmd in runs)
+        check("each track runs once, as a --song unit", urls == sorted(st["url"] for st in task["sub_tasks"]) and all("--song" in cmd for _, _, cmd in runs),
+              [cmd for _, _, cmd in runs])
+        check("tracks share the pool: 3 at a time on 3 slots", peak(runs) == 3, peak(runs))
+        check("an album whose tracks all succeed completes", (task["status"], task["progress"]) == ("completed", "100% Done"), (task["status"], task["progress"]))
+
+        fake.clear()
+        task = album(ws, 4)
+        open(os.path.join(fake.fail, "902"), "w").close()
+        ws.dispatch_job(task)
+        await finished(task)
+        check("a failed track fails the album once its siblings are done",
+              (task["status"], task["progress"]) == ("failed", "1 of 4 tracks failed") and len(fake.runs()) == 4
+              and [st["status"] for st in task["sub_tasks"]] == ["completed", "completed", "failed", "completed"],
+              (task["status"], task["progress"], [st["status"] for st in task["sub_tasks"]]))
+
+        fake.clear()
+        os.remove(os.path.join(fake.fail, "902"))
+        await ws.retry_failed_tracks(task["id"])
+        await finished(task)
+        check("retrying runs only the failed track and completes the album",
+              [cmd.split()[-1] for _, _, cmd in fake.runs()] == [task["sub_tasks"][2]["url"]] and task["status"] == "completed",
+              ([cmd for _, _, cmd in fake.runs()], task["status"]))
+
+        fake.clear()
+        task = album(ws, 4, ["completed", "pending", "skipped", "pending"])
+        ws.dispatch_job(task)
+        await finished(task)
+        check("dispatch_job() skips finished tracks", sorted(cmd.split()[-1] for _, _, cmd in fake.runs()) == [task["sub_tasks"][i]["url"] for i in (1, 3)],
+              [cmd for _, _, cmd in fake.runs()])
+        task = album(ws, 2, ["completed", "skipped"])
+        ws.dispatch_job(task)
+        check("an album with no tracks left rolls up at once", task["status"] == "completed", task["status"])
+    finally:
+        await ws.SCHEDULER.stop()
+        shutil.rmtree(root, ignore_errors=True)
+    return problems
+
+if __name__ == "__main__":
+    problems = asyncio.run(main())
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
@@ -0,0 +1,153 @@
+"""Watchlist check: only new releases are fetched and queued.
+
+Runs web_server.Watchlist against a fake artist-view catalog (ETags, 304s,
+paging by `next`, like amp-api) with the real enqueue path and an in-memory
+job store, and asserts that:
+
+  * the first check walks every page but queues nothing, unless the
+    artist was added with backfill;
+  * a quiet artist costs one conditional request per view, answered with
+    304;
+  * a new release is found on the first page and queued once, in the
+    artist's fair-share lane at bulk priority;
+  * a pre-order isn't queued, and is queued after its release date;
+  * a failed check records nothing, so the next one still finds the
+    release;
+  * releases already queued or already in the library aren't queued again;
+  * what was seen survives reopening the watchlist database.
+
+Exits non-zero on failure.
+
+    python bench/watchlist_sync.py
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+problems = []
+
+def check(label: str, ok: bool, detail=""):
+    print(f"{'ok' if ok else 'FAIL':4s}  {label}")
+    if not ok: problems.append(f"{label}: {detail}")
+
+def day(offset: int) -> str:
+    return time.strftime("%Y-%m-%d", time.localtime(time.time() + offset * 86400))
+
+class FakeResponse:
+    def __init__(self, status_code: int, body=None, etag=None):
+        self.status_code, self.body = status_code, body
+        self.headers = {"etag": etag} if etag else {}
+
+    def json(self): return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400: raise RuntimeError(f"HTTP {self.status_code}")
+
+class FakeArtistViews:
+    """Artist views newest first, paged by `next`, with an ETag over the whole view."""
+
+    def __init__(self):
+        self.views = {"full-albums": [], "singles": []}  # view -> [(id, release date)]
+        self.requests = []  # (view, offset, conditional)
+        self.down = False
+
+    async def catalog_get(self, storefront, path, params=None, endpoint="other", headers=None):
+        view = path.rsplit("/", 1)[1]
+        offset, limit = int((params or {}).get("offset", 0)), int((params or {}).get("limit", 10))
+        self.requests.append((view, offset, bool(headers)))
+        if self.down: raise RuntimeError("amp-api unreachable")
+        releases = sorted(self.views[view], key=lambda r: r[1], reverse=True)
+        etag = f'"{len(releases)}-{releases[0][0] if releases else ""}"'
+        if headers and headers.get("If-None-Match") == etag: return FakeResponse(304)
+        body = {"data": [{"id": rid, "type": "albums", "attributes": {
+            "name": f"Release {rid}", "artistName": "Bench Artist", "trackCount": 10, "releaseDate": date,
+            "url": f"https://music.apple.com/{storefront}/album/release/{rid}"}} for rid, date in releases[offset:offset + limit]]}
+        if offset + limit < len(releases): body["next"] = f"/v1/catalog/{storefront}/{path}?offset={offset + limit}&limit={limit}"
+        return FakeResponse(200, body, etag)
+
+    def take(self) -> list:
+        requests, self.requests = self.requests, []
+        return requests
+
+async def main():
+    import web_server as ws
+    catalog = FakeArtistViews()
+    ws.catalog_get = catalog.catalog_get
+    ws.load_config = lambda: {}
+    ws.JOBS = ws.JobStore(":memory:")
+    ws.JOBS.open()
+    async def broadcast_log(message, key=None): pass
+    ws.broadcast_log = broadcast_log
+    in_library = set()
+    ws.LIBRARY.has_release = lambda item: item['url'].rsplit('/', 1)[1] in in_library
+
+    def queued() -> list:
+        return [t['url'].rsplit('/', 1)[1] for t in ws.JOBS.all()]
+
+    path = os.path.join(tempfile.mkdtemp(prefix="amd-watch-"), "watchlist.db")
+    watchlist = ws.Watchlist(path)
+    watchlist.open()
+    catalog.views["full-albums"] = [(str(100 + i), day(-400 + i)) for i in range(25)]
+    entry = watchlist.add("us", "42", "alac", ["full-albums", "singles"])
+
+    await watchlist.sync(entry)
+    pages = (25 + ws.WATCHLIST_PAGE_SIZE - 1) // ws.WATCHLIST_PAGE_SIZE + 1
+    check("first check walks every page and queues nothing", len(catalog.take()) == pages and not queued() and len(entry['seen']) == 25,
+          (pages, queued(), len(entry['seen'])))
+
+    await watchlist.sync(entry)
+    requests = catalog.take()
+    check("a quiet artist costs one conditional request per view", requests == [("full-albums", 0, True), ("singles", 0, True)], requests)
+
+    catalog.views["full-albums"] += [("900", day(-1)), ("901", day(30))]
+    await watchlist.sync(entry)
+    requests = catalog.take()
+    check("a new release is found on the first page", requests[0] == ("full-albums", 0, True) and len(requests) == 2, requests)
+    check("only the released one is queued", queued() == ["900"], queued())
+    job = ws.JOBS.all()[0]
+    check("in the artist's lane at bulk priority", job['source'] == "watchlist:42" and job['priority'] == "bulk", (job['source'], job['priority']))
+    check("the pre-order isn't recorded as seen", "901" not in entry['seen'] and "full-albums" not in entry['etags'])
+
+    catalog.views["full-albums"] = [r for r in catalog.views["full-albums"] if r[0] != "901"] + [("901", day(-1))]
+    await watchlist.sync(entry)
+    check("the pre-order is queued once it is out", queued() == ["900", "901"], queued())
+
+    catalog.views["full-albums"].append(("902", day(0)))
+    catalog.down = True
+    await watchlist.sync(entry)
+    check("a failed check records the error and nothing else", entry['last_error'] and "902" not in entry['seen'], entry['last_error'])
+    catalog.down = False
+    await watchlist.sync(entry)
+    check("the next check still queues what it missed", queued() == ["900", "901", "902"] and entry['last_error'] is None, queued())
+
+    catalog.views["full-albums"] += [("903", day(0)), ("904", day(0))]
+    ws.enqueue_tasks([{"url": "https://music.apple.com/us/album/release/903", "codec": "alac"}], skip_existing=False, source="client:bench")
+    in_library.add("904")
+    await watchlist.sync(entry)
+    check("releases already queued or in the library aren't queued again", queued() == ["900", "901", "902", "903"], queued())
+
+    other = watchlist.add("us", "77", "alac", ["full-albums"], backfill=True)
+    await watchlist.sync(other)
+    backfilled = len(ws.JOBS.all()) - 4
+    check("backfill queues what is out except what is already queued or in the library", backfilled == 25, backfilled)
+
+    watchlist.close()
+    reopened = ws.Watchlist(path)
+    reopened.open()
+    entry = reopened.entries[("us", "42")]
+    check("seen releases survive a restart", {"900", "901", "902", "903", "904"} <= entry['seen'] and len(entry['seen']) == 30, len(entry['seen']))
+    catalog.take()
+    await reopened.sync(entry)
+    check("and the first check after it is a 304", catalog.take() == [("full-albums", 0, True), ("singles", 0, True)] and len(ws.JOBS.all()) == 29)
+    reopened.close()
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+if __name__ == "__main__":
+    asyncio.run(main())
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
@@ -0,0 +1,129 @@
+"""WebSocket fan-out load test: sequential awaits vs. web_server.Broadcaster.
+
+Simulates hundreds of connected browser tabs (mostly healthy, some slow, some
+half-dead sockets that never complete a send) and pushes a stream of log lines
+through the old broadcast loop (await each client in turn) and through the
+Broadcaster (bounded per-client outbox + writer task). Reports how long the
+producer -- the downloader parsing loop in production -- is blocked, plus the
+broadcaster's delivered/dropped/evicted counters. It asserts that, through the
+Broadcaster:
+
+  * no client's outbox ever holds more than --queue messages;
+  * stuck sockets are evicted and slow ones are not;
+  * healthy clients receive the last line;
+  * the producer is blocked for less than a tenth of the legacy loop's time.
+
+Exits non-zero on failure.
+
+    python bench/ws_load.py --clients 500 --slow 20 --stuck 5 --messages 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+problems = []
+
+def check(label: str, ok: bool, detail=""):
+    print(f"{'ok' if ok else 'FAIL':4s}  {label}")
+    if not ok: problems.append(f"{label}: {detail}")
+
+class FakeSocket:
+    def __init__(self, latency: float, stuck: bool = False, kind: str = "healthy"):
+        self.latency = latency
+        self.stuck = stuck
+        self.kind = kind
+        self.received = 0
+        self.last = None
+
+    async def send_text(self, message: str):
+        if self.stuck: await asyncio.sleep(3600)  # half-open TCP: send never completes
+        await asyncio.sleep(self.latency)
+        self.received += 1
+        self.last = message
+
+    async def close(self):
+        pass
+
+def make_clients(args):
+    clients = [FakeSocket(0) for _ in range(args.clients - args.slow - args.stuck)]
+    clients += [FakeSocket(random.uniform(0.01, 0.05), kind="slow") for _ in range(args.slow)]
+    clients += [FakeSocket(0, stuck=True, kind="stuck") for _ in range(args.stuck)]
+    random.shuffle(clients)
+    return clients
+
+async def legacy(args):
+    clients = make_clients(args)
+    blocked = 0.0
+    for i in range(args.messages):
+        start = time.perf_counter()
+        for client in clients:
+            try:
+                # Bounded here only so the run terminates; the old loop had no timeout at all
+                await asyncio.wait_for(client.send_text(f"line {i}"), args.legacy_timeout)
+            except Exception:
+                pass
+        blocked += time.perf_counter() - start
+        if args.interval: await asyncio.sleep(args.interval)
+    return blocked, sum(c.received for c in clients)
+
+async def broadcaster(args):
+    import web_server
+    web_server.WS_SEND_TIMEOUT = args.send_timeout
+    b = web_server.Broadcaster(max_queue=args.queue)
+    clients = make_clients(args)
+    writers = []
+    for sock in clients:
+        client = web_server.WsClient(sock, {"logs"})
+        b.clients[sock] = client
+        writers.append(asyncio.create_task(b._writer(client)))
+    blocked = 0.0
+    peak = 0
+    for i in range(args.messages):
+        start = time.perf_counter()
+        b.publish("logs", f"line {i}", key="progress" if i % 4 else None)
+        blocked += time.perf_counter() - start
+        peak = max(peak, max((len(c.outbox) for c in b.clients.values()), default=0))
+        await asyncio.sleep(args.interval)
+    await asyncio.sleep(args.send_timeout + 0.5)
+    for w in writers: w.cancel()
+    left = {sock.kind for sock in b.clients}
+    check(f"outboxes stay within {args.queue} messages", peak <= args.queue, peak)
+    check("stuck sockets are evicted, slow ones kept", "stuck" not in left and b.evicted == args.stuck
+          and sum(1 for sock in b.clients if sock.kind == "slow") == args.slow, (b.evicted, left))
+    stale = [sock.last for sock in clients if sock.kind == "healthy" and sock.last != f"line {args.messages - 1}"]
+    check("healthy clients get the last line", not stale, stale[:3])
+    return blocked, sum(c.received for c in clients), b.stats()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--clients", type=int, default=500)
+    ap.add_argument("--slow", type=int, default=20)
+    ap.add_argument("--stuck", type=int, default=5)
+    ap.add_argument("--messages", type=int, default=2000)
+    ap.add_argument("--interval", type=float, default=0.001, help="seconds between produced lines")
+    ap.add_argument("--queue", type=int, default=256)
+    ap.add_argument("--send-timeout", type=float, default=1.0)
+    ap.add_argument("--legacy-timeout", type=float, default=0.05)
+    ap.add_argument("--legacy-messages", type=int, default=20, help="legacy is slow; replay fewer lines")
+    args = ap.parse_args()
+
+    total = args.messages
+    args.messages = args.legacy_messages
+    blocked, received = asyncio.run(legacy(args))
+    legacy_per_line = blocked / args.messages
+    print(f"legacy       producer blocked {legacy_per_line * 1000:9.2f} ms/line  delivered {received}")
+    args.messages = total
+    blocked, received, stats = asyncio.run(broadcaster(args))
+    print(f"broadcaster  producer blocked {blocked * 1000 / args.messages:9.2f} ms/line  delivered {received}")
+    print(f"  dropped {stats['dropped']}  coalesced {stats['coalesced']}  evicted {stats['evicted']}  clients left {stats['clients']}")
+    check("publish() blocks the producer a tenth as long as the legacy loop", blocked / args.messages < legacy_per_line / 10)
+    for problem in problems: print(f"FAIL  {problem}")
+    if problems: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
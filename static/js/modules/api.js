@@ -23,8 +23,52 @@ export async function apiAddToQueue(data) {
     }
 }
 
+export async function apiAddBatch(items) {
+    const res = await fetch('/api/download/batch', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ items })
+    });
+    if (!res.ok) throw new Error(`Failed to add to queue: ${res.statusText}`);
+    return await res.json();
+}
+
+export async function apiDownloadArtist(artistUrl, codec, views) {
+    const match = artistUrl.match(/music\.apple\.com\/([a-z]{2})\/artist\/[^/]+\/(\d+)/);
+    if (!match) throw new Error('Invalid artist URL');
+    const res = await fetch(`/api/artist/${match[2]}/download`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ storefront: match[1], codec, views })
+    });
+    if (!res.ok) throw new Error(`Failed to queue discography: ${res.statusText}`);
+    return await res.json();
+}
+
+export async function apiWatchArtist(artistUrl, codec) {
+    const res = await fetch('/api/watchlist', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ url: artistUrl, codec })
+    });
+    if (!res.ok) {
+        const err = await res.json().catch(() => ({}));
+        throw new Error(err.detail || res.statusText);
+    }
+    return await res.json();
+}
+
+export function selectedCodec() {
+    const codecSelect = document.getElementById('codecSelect');
+    return codecSelect ? codecSelect.value : 'alac';
+}
+
 export async function apiSearch(query) {
     const res = await fetch(`/api/search?query=${encodeURIComponent(query)}`);
+    if (!res.ok) {
+        const err = await res.json().catch(() => ({}));
+        throw new Error(err.detail || res.statusText);
+    }
     return await res.json();
 }
 
@@ -41,11 +85,15 @@ export async function apiClearHistory() {
 export async function updateParallelLimit() {
     const limit = document.getElementById('parallelSelect').value;
     try {
-        await fetch('/api/settings/parallel', {
+        const res = await fetch('/api/settings/parallel', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ limit: parseInt(limit) })
         });
+        if (!res.ok) {
+            const err = await res.json().catch(() => ({}));
+            showMessage('Error', err.detail || 'Failed to update parallel limit.');
+        }
     } catch (e) {
         console.error("Failed to update parallel limit", e);
     }
@@ -1,6 +1,6 @@
 // Main Entry Point
-import { handleSearchOrDownload } from './search.js';
-import { updateQueue, connectLogStream, clearHistory } from './queue.js'; 
+import { handleSearchOrDownload, connectSearchStream, typeahead } from './search.js';
+import { updateQueue, syncQueue, connectLogStream, connectQueueStream, clearHistory } from './queue.js'; 
 import { pollLoginStatus, handleLogin, submit2FA } from './auth.js';
 import { openModal, closeModal, showConfirm, setupModalListeners } from './modals.js';
 import { handleCardClick } from './cards.js';
@@ -51,18 +51,18 @@ window.switchTab = (tabId) => {
     }
 
     if (tabId === 'settings') loadSettings();
-    if (tabId === 'history') updateQueue(); // Refresh queue/history when switching to it
+    if (tabId === 'history') syncQueue(); // Refresh queue/history when switching to it
 };
 
 // Queue Refresh Event
-window.addEventListener('refreshQueue', updateQueue);
+window.addEventListener('refreshQueue', syncQueue);
 
 // Initialization
 document.addEventListener('DOMContentLoaded', () => {
     pollLoginStatus();
     connectLogStream();
-    updateQueue();
-    setInterval(updateQueue, 2000);
+    connectQueueStream();
+    connectSearchStream();
     
     // Setup modal listeners (cancel/ok buttons)
     setupModalListeners();
@@ -72,6 +72,7 @@ document.addEventListener('DOMContentLoaded', () => {
         searchInput.addEventListener('keypress', (e) => {
             if (e.key === 'Enter') handleSearchOrDownload();
         });
+        searchInput.addEventListener('input', (e) => typeahead(e.target.value));
     }
 
     // Tips Rotation
@@ -1,37 +1,108 @@
 import { showConfirm } from './modals.js';
 import { apiClearHistory } from './api.js';
+import { artworkUrl } from './utils.js';
 
 let expandedBatchTasks = new Set();
 
+// Local mirror of the server queue, kept in sync by the /ws/queue change feed.
+const tasks = new Map();
+let lastSeq = 0;
+let renderTimer = null;
+const PAGE_SIZE = 500;
+// Server dispatch classes, highest first (PRIORITY_CLASSES in web_server.py)
+const PRIORITIES = ['interactive', 'album', 'bulk'];
+
+// Full resync: page through the whole queue and rebuild the local mirror.
 export async function updateQueue() {
     try {
-        const res = await fetch('/api/queue?t=' + Date.now());
-        if (!res.ok) return;
-        const queue = await res.json();
-
-        // Segment Tasks
-        const activeTasks = queue.filter(t => t.status === 'downloading');
-        const nextUpTasks = queue.filter(t => t.status === 'pending');
-        const completedTasks = queue.filter(t => t.status === 'completed');
-        const failedTasks = queue.filter(t => t.status === 'failed');
-
-        // Update Badge
-        const badge = document.getElementById('queueCountBadge');
-        if (badge) badge.innerText = nextUpTasks.length;
-
-        // Render Sections
-        renderActiveHeroes(activeTasks);
-        renderNextUpList(nextUpTasks);
-        renderHistoryFailed(failedTasks);
-        renderHistoryCompleted(completedTasks);
-
+        tasks.clear();
+        lastSeq = 0;
+        await syncQueue();
     } catch (e) { console.error("Queue Update Error:", e); }
 }
 
+// Incremental sync: fetch only tasks that changed since the last seen sequence number.
+export async function syncQueue() {
+    try {
+        const since = lastSeq;
+        let offset = 0;
+        let seq = since;
+        while (true) {
+            const res = await fetch(`/api/queue?since=${since}&offset=${offset}&limit=${PAGE_SIZE}&t=${Date.now()}`);
+            if (!res.ok) return;
+            const page = await res.json();
+            if (page.reset) return updateQueue();
+            if (offset === 0) {
+                seq = page.seq;
+                (page.removed || []).forEach(id => tasks.delete(id));
+            }
+            page.tasks.forEach(t => tasks.set(t.id, t));
+            offset += page.tasks.length;
+            if (page.tasks.length === 0 || offset >= page.total) break;
+        }
+        lastSeq = Math.max(lastSeq, seq);
+        scheduleRender();
+    } catch (e) { console.error("Queue Sync Error:", e); }
+}
+
+function applyQueueUpdate(update) {
+    // The server dropped deltas for this client (its send queue overflowed); refetch instead
+    if (update.type === 'resync') return syncQueue();
+    (update.removed || []).forEach(id => tasks.delete(id));
+    (update.changes || []).forEach(delta => {
+        const existing = tasks.get(delta.id);
+        if (!existing) tasks.set(delta.id, delta);
+        else if ((delta.seq || 0) > (existing.seq || 0)) Object.assign(existing, delta);
+    });
+    lastSeq = Math.max(lastSeq, update.seq || 0);
+    scheduleRender();
+}
+
+export function connectQueueStream() {
+    const ws = new WebSocket(`ws://${window.location.host}/ws/queue`);
+    ws.onopen = () => syncQueue();
+    ws.onmessage = (event) => {
+        try { applyQueueUpdate(JSON.parse(event.data)); }
+        catch (e) { console.error("Queue Stream Error:", e); }
+    };
+    ws.onclose = () => setTimeout(connectQueueStream, 2000);
+}
+
+function scheduleRender() {
+    if (renderTimer) return;
+    renderTimer = setTimeout(() => {
+        renderTimer = null;
+        renderQueue();
+    }, 100);
+}
+
+function renderQueue() {
+    const queue = [...tasks.values()].sort((a, b) => a.id - b.id);
+
+    // Segment Tasks
+    const activeTasks = queue.filter(t => t.status === 'downloading');
+    // Waiting jobs by priority class, then their place in line; paused ones last
+    const rank = t => (t.status === 'paused' ? PRIORITIES.length : 0) + Math.max(0, PRIORITIES.indexOf(t.priority || 'album'));
+    const nextUpTasks = queue.filter(t => t.status === 'pending' || t.status === 'paused')
+        .sort((a, b) => rank(a) - rank(b) || (a.order ?? a.id) - (b.order ?? b.id));
+    const completedTasks = queue.filter(t => t.status === 'completed');
+    const failedTasks = queue.filter(t => t.status === 'failed');
+
+    // Update Badge
+    const badge = document.getElementById('queueCountBadge');
+    if (badge) badge.innerText = nextUpTasks.length;
+
+    // Render Sections
+    renderActiveHeroes(activeTasks);
+    renderNextUpList(nextUpTasks);
+    renderHistoryFailed(failedTasks);
+    renderHistoryCompleted(completedTasks);
+}
+
 export async function clearHistory() {
     try {
         const res = await apiClearHistory();
-        if (res.ok) updateQueue();
+        if (res.ok) syncQueue();
         else alert("Failed to clear history");
     } catch (e) { console.error(e); }
 }
@@ -82,7 +153,7 @@ function renderActiveHeroes(tasks) {
         const isExpanded = expandedBatchTasks.has(task.id);
         const listClass = isExpanded ? '' : 'hidden';
         const btnText = isExpanded ? 'HIDE TRACKS' : 'VIEW TRACKS';
-        const albumArt = task.image || "https://music.apple.com/assets/default/album-cover.png";
+        const albumArt = artworkUrl(task.image, 300);
 
         // Sub-tasks HTML
         const subTasksHtml = (task.sub_tasks || []).map(st => {
@@ -135,6 +206,10 @@ function renderActiveHeroes(tasks) {
                             <div class="flex items-center gap-2 mb-1">
                                 <span class="px-2 py-0.5 rounded text-[10px] font-bold bg-pink-500 text-white shadow-[0_0_10px_rgba(236,72,153,0.5)]">BATCH</span>
                                 <span class="px-2 py-0.5 rounded text-[10px] font-bold bg-white/10 text-gray-300 border border-white/10 uppercase">${task.codec || 'ALAC'}</span>
+                                <div class="ml-auto flex gap-2">
+                                    <button onclick="pauseTask(${task.id})" class="px-3 py-1 rounded-lg bg-white/10 hover:bg-white/20 text-[10px] font-bold text-white transition">PAUSE</button>
+                                    <button onclick="cancelTask(${task.id})" class="px-3 py-1 rounded-lg bg-red-500/20 hover:bg-red-500/40 text-[10px] font-bold text-red-300 transition">CANCEL</button>
+                                </div>
                             </div>
                             <h1 class="text-4xl font-bold text-white truncate leading-tight" title="${task.album}">${task.album || task.title}</h1>
                             <p class="text-xl text-gray-300 truncate">${task.artist}</p>
@@ -197,14 +272,22 @@ function renderNextUpList(tasks) {
 
     let html = '';
     tasks.forEach((task, index) => {
+        const paused = task.status === 'paused';
+        const label = paused ? 'PAUSED' : (task.retry_at && task.attempts ? `RETRY ${task.attempts}` : 'PENDING');
         html += `
-        <div class="flex items-center gap-4 p-3 hover:bg-white/5 rounded-lg transition text-sm border-b border-white/5 last:border-0">
+        <div class="flex items-center gap-4 p-3 hover:bg-white/5 rounded-lg transition text-sm border-b border-white/5 last:border-0 group ${paused ? 'opacity-60' : ''}">
             <div class="w-8 text-center text-gray-500 font-mono">${index + 1}</div>
             <div class="flex-1 min-w-0">
                 <div class="text-gray-200 font-medium truncate">${task.title || task.url}</div>
                 <div class="text-xs text-gray-500 truncate">${task.artist || 'Unknown Artist'}</div>
             </div>
-            <div class="text-xs text-gray-500 font-bold tracking-wider uppercase">PENDING</div>
+            <span class="px-2 py-0.5 rounded text-[10px] font-bold bg-white/10 text-gray-400 border border-white/10 uppercase">${task.priority || 'album'}</span>
+            <div class="hidden group-hover:flex gap-1">
+                <button onclick="moveTaskToTop(${task.id})" title="Move to top" class="px-2 py-1 rounded bg-white/10 hover:bg-white/20 text-[10px] font-bold text-white">TOP</button>
+                <button onclick="${paused ? 'resumeTask' : 'pauseTask'}(${task.id})" class="px-2 py-1 rounded bg-white/10 hover:bg-white/20 text-[10px] font-bold text-white">${paused ? 'RESUME' : 'PAUSE'}</button>
+                <button onclick="cancelTask(${task.id})" class="px-2 py-1 rounded bg-red-500/20 hover:bg-red-500/40 text-[10px] font-bold text-red-300">CANCEL</button>
+            </div>
+            <div class="text-xs text-gray-500 font-bold tracking-wider uppercase" title="${task.retry_at ? (task.progress || '') : ''}">${label}</div>
         </div>`;
     });
     container.innerHTML = html;
@@ -224,15 +307,15 @@ function renderHistoryFailed(tasks) {
     container.innerHTML = tasks.map(task => `
         <div class="glass-card rounded-2xl overflow-hidden p-4 flex items-center gap-5 border-red-500/30 bg-red-500/5">
             <div class="w-16 h-16 rounded-lg overflow-hidden bg-black/50 flex-shrink-0 shadow-lg grayscale opacity-70">
-                <img src="${task.image || 'https://music.apple.com/assets/default/album-cover.png'}" class="w-full h-full object-cover">
+                <img src="${artworkUrl(task.image, 128)}" loading="lazy" class="w-full h-full object-cover">
             </div>
             <div class="flex-1 min-w-0">
                 <h3 class="text-lg font-bold text-gray-300 truncate">${task.title}</h3>
-                <p class="text-red-400 text-sm truncate">Download Failed</p>
+                <p class="text-red-400 text-sm truncate">${task.error === 'cancelled' ? 'Cancelled' : 'Download Failed'}</p>
                 <div class="text-[10px] text-red-400/70 mt-1 font-mono truncate">${task.progress || 'Unknown Error'}</div>
             </div>
             <div class="text-right">
-                <button onclick="retryTask('${task.url}')" class="px-4 py-2 rounded-lg bg-white/10 hover:bg-white/20 text-xs font-bold text-white transition flex items-center gap-2">
+                <button onclick="retryTask(${task.id})" class="px-4 py-2 rounded-lg bg-white/10 hover:bg-white/20 text-xs font-bold text-white transition flex items-center gap-2">
                     <svg class="w-3 h-3" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M4 4v5h.582m15.356 2A8.001 8.001 0 004.582 9m0 0H9m11 11v-5h-.581m0 0a8.003 8.003 0 01-15.357-2m15.357 2H15"></path></svg>
                     RETRY
                 </button>
@@ -241,6 +324,16 @@ function renderHistoryFailed(tasks) {
     `).join('');
 }
 
+// Server-side transcode progress, shown next to the codec once a job is done
+function conversionBadge(task) {
+    const conv = task.conversion;
+    if (!conv || !conv.total) return '';
+    const done = conv.converted + conv.skipped + conv.failed;
+    const label = done < conv.total ? `Converting ${done}/${conv.total}` : (conv.failed ? `${conv.failed} failed` : 'Converted');
+    const color = conv.failed ? 'text-red-300' : 'text-purple-300';
+    return `<span class="px-1.5 py-0.5 rounded text-[10px] font-bold bg-white/10 ${color} uppercase" title="${conv.current || ''}">${label} &rarr; ${conv.format}</span>`;
+}
+
 function renderHistoryCompleted(tasks) {
     const container = document.getElementById('historyCompletedContainer');
     if (!container) return;
@@ -264,13 +357,13 @@ function renderHistoryCompleted(tasks) {
             <div class="glass-card rounded-2xl overflow-hidden group">
                 <div class="p-4 flex items-center gap-5 cursor-pointer" onclick="this.nextElementSibling.classList.toggle('hidden')">
                     <div class="w-16 h-16 rounded-lg overflow-hidden bg-black/50 flex-shrink-0 shadow-lg">
-                        <img src="${task.image || 'https://music.apple.com/assets/default/album-cover.png'}" class="w-full h-full object-cover">
+                        <img src="${artworkUrl(task.image, 128)}" loading="lazy" class="w-full h-full object-cover">
                     </div>
                     <div class="flex-1 min-w-0">
                         <h3 class="text-lg font-bold text-white truncate">${task.album || task.title}</h3>
                         <p class="text-gray-400 text-sm truncate">${task.artist}</p>
                         <div class="flex items-center gap-2 mt-1">
-                            <span class="px-1.5 py-0.5 rounded text-[10px] font-bold bg-white/10 text-gray-300 uppercase">${task.codec}</span>
+                            <span class="px-1.5 py-0.5 rounded text-[10px] font-bold bg-white/10 text-gray-300 uppercase">${task.codec}</span>${conversionBadge(task)}
                             <span class="text-[10px] text-gray-500">${trackCount} Tracks</span>
                         </div>
                     </div>
@@ -301,13 +394,13 @@ function renderHistoryCompleted(tasks) {
             return `
             <div class="glass-card rounded-2xl overflow-hidden p-4 flex items-center gap-5">
                 <div class="w-16 h-16 rounded-lg overflow-hidden bg-black/50 flex-shrink-0 shadow-lg">
-                    <img src="${task.image || 'https://music.apple.com/assets/default/album-cover.png'}" class="w-full h-full object-cover">
+                    <img src="${artworkUrl(task.image, 128)}" loading="lazy" class="w-full h-full object-cover">
                 </div>
                 <div class="flex-1 min-w-0">
                     <h3 class="text-lg font-bold text-white truncate">${task.title}</h3>
                     <p class="text-gray-400 text-sm truncate">${task.artist}</p>
                     <div class="flex items-center gap-2 mt-1">
-                        <span class="px-1.5 py-0.5 rounded text-[10px] font-bold bg-white/10 text-gray-300 uppercase">${task.codec}</span>
+                        <span class="px-1.5 py-0.5 rounded text-[10px] font-bold bg-white/10 text-gray-300 uppercase">${task.codec}</span>${conversionBadge(task)}
                         <span class="text-[10px] text-gray-500">Single</span>
                     </div>
                 </div>
@@ -323,24 +416,42 @@ function renderHistoryCompleted(tasks) {
 }
 
 // Global retry function (attached to window for inline onclick)
-window.retryTask = async (url) => {
-    // Logic to retry... basically add to queue again
-    // Use import from api.js if possible, or dispatch event
-    // For simplicity, let's assume we can call the global handler
-    if (window.handleSearchOrDownload) {
-        // Hacky: Put URL in search box and trigger? No, use API directly.
-        // Need to import addToQueue from api.js but this function is global context.
-        // Better: emit event or import in main.js and expose.
-        // For now, just re-add via fetch manually to avoid circular deps or scope issues.
-        try {
-            await fetch('/api/download', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ url: url, codec: 'alac' }) // default codec
-            });
-            updateQueue();
-        } catch(e) { alert(e); }
-    }
+window.retryTask = async (id) => {
+    const task = tasks.get(id);
+    if (!task) return;
+    try {
+        // Re-runs the same job; track-mode jobs only re-run the tracks that failed
+        const res = await fetch(`/api/queue/${id}/retry`, { method: 'POST' });
+        if (!res.ok) {
+            const err = await res.json().catch(() => ({}));
+            alert(err.detail || 'Retry failed');
+        }
+        syncQueue();
+    } catch(e) { alert(e); }
+};
+
+// Queue management: pause/resume/cancel/reorder go through /api/queue/{id}/...
+async function queueAction(id, action, body = null) {
+    try {
+        const res = await fetch(`/api/queue/${id}/${action}`, {
+            method: 'POST',
+            headers: body ? { 'Content-Type': 'application/json' } : {},
+            body: body ? JSON.stringify(body) : null
+        });
+        if (!res.ok) {
+            const err = await res.json().catch(() => ({}));
+            alert(err.detail || `Failed to ${action} job`);
+        }
+        syncQueue();
+    } catch (e) { alert(e); }
+}
+
+window.pauseTask = (id) => queueAction(id, 'pause');
+window.resumeTask = (id) => queueAction(id, 'resume');
+window.moveTaskToTop = (id) => queueAction(id, 'reorder', { position: 'top' });
+window.cancelTask = async (id) => {
+    const task = tasks.get(id);
+    if (await showConfirm(`Cancel "${task?.title || 'this download'}"? Tracks already downloaded are kept.`)) queueAction(id, 'cancel');
 };
 
 export function connectLogStream() {
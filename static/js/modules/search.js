@@ -1,6 +1,7 @@
 // Search & Results Logic
-import { apiSearch, apiResolveArtist, addToQueue } from './api.js';
+import { apiSearch, apiResolveArtist, apiAddBatch, apiDownloadArtist, apiWatchArtist, selectedCodec, addToQueue } from './api.js';
 import { openModal, closeModal } from './modals.js';
+import { artworkUrl, showMessage } from './utils.js';
 
 let selectedArtistItems = new Set();
 let isSelectionMode = false;
@@ -9,6 +10,7 @@ let isSelectionMode = false;
 // To make it accessible for the "toggleArtistItemSelection" helper which might be called from inline (if we used inline),
 // but we are trying to avoid inline. We'll attach to window if necessary or keep it module scoped.
 let currentArtistData = null;
+let currentArtistUrl = null;
 
 export async function handleSearchOrDownload() {
     const input = document.getElementById('searchInput').value;
@@ -20,73 +22,128 @@ export async function handleSearchOrDownload() {
     }
 }
 
-export async function search(query) {
-    const resultsDiv = document.getElementById('searchResults');
-    if (resultsDiv) resultsDiv.innerHTML = '<div class="col-span-full text-center text-gray-400 py-10">Searching...</div>';
-    
-    try {
-        const data = await apiSearch(query);
-        
-        resultsDiv.innerHTML = '';
-        resultsDiv.className = 'flex flex-col gap-10'; // Change grid to column stack
+// Typeahead: one socket per tab. Each query supersedes the previous one server-side,
+// and result groups arrive one by one (cached, provisional from a shorter prefix, final).
+const SEARCH_GROUPS = ['songs', 'albums', 'artists', 'music_videos', 'playlists'];
+let searchSocket = null;
+let typeaheadId = 0;
+let typeaheadGroups = {};
+let typeaheadTimer = null;
 
-        const hasResults = Object.values(data).some(arr => arr.length > 0);
-        if (!hasResults) {
-            resultsDiv.innerHTML = '<div class="text-center text-gray-400 py-10 w-full">No results found</div>';
+export function connectSearchStream() {
+    const ws = new WebSocket(`ws://${window.location.host}/ws/search`);
+    ws.onopen = () => { searchSocket = ws; };
+    ws.onmessage = (event) => {
+        let msg;
+        try { msg = JSON.parse(event.data); } catch (e) { return; }
+        if (msg.id !== typeaheadId) return; // superseded
+        if (msg.error) {
+            const resultsDiv = document.getElementById('searchResults');
+            if (resultsDiv && !Object.keys(typeaheadGroups).length) resultsDiv.innerHTML = `<div class="text-center text-red-400 py-10 w-full">Error: ${msg.error}</div>`;
             return;
         }
+        if (msg.type) typeaheadGroups[msg.type] = msg.items;
+        if (msg.done || msg.type) scheduleTypeaheadRender(!!msg.done);
+    };
+    ws.onclose = () => {
+        searchSocket = null;
+        setTimeout(connectSearchStream, 2000);
+    };
+}
 
-        const createSection = (title, items) => {
-            if (!items || items.length === 0) return;
-            
-            const section = document.createElement('div');
-            section.className = 'flex flex-col gap-4';
-            
-            const header = document.createElement('h3');
-            header.className = 'text-2xl font-bold text-white border-b border-white/10 pb-2';
-            header.textContent = title;
-            section.appendChild(header);
+export function typeahead(query) {
+    query = query.trim();
+    if (query.length < 2 || query.includes('music.apple.com') || !searchSocket) return;
+    typeaheadId += 1;
+    typeaheadGroups = {};
+    searchSocket.send(JSON.stringify({ id: typeaheadId, query }));
+}
 
-            const grid = document.createElement('div');
-            grid.className = 'grid grid-cols-2 md:grid-cols-3 lg:grid-cols-5 gap-6';
-            
-            items.forEach(item => {
-                const card = document.createElement('div');
-                card.className = "glass rounded-xl p-4 hover:bg-white/10 transition cursor-pointer group flex flex-col";
-                card.onclick = () => {
-                    if (item.type === 'artists') openArtistModal(item);
-                    else if (item.type === 'albums') openAlbumModal(item);
-                    else addToQueue(item.url, item.name, item.artist, item.album, item.image);
-                };
-                card.innerHTML = `
-                    <div class="aspect-square rounded-lg overflow-hidden mb-3 relative shadow-lg bg-black/50">
-                        <img src="${item.image}" loading="lazy" class="w-full h-full object-cover group-hover:scale-110 transition duration-500">
-                        <div class="absolute inset-0 bg-black/40 opacity-0 group-hover:opacity-100 transition flex items-center justify-center">
-                            <svg class="w-12 h-12 text-white" fill="currentColor" viewBox="0 0 24 24"><path d="M8 5v14l11-7z"/></svg>
-                        </div>
-                    </div>
-                    <h3 class="font-bold truncate text-white text-sm mb-1" title="${item.name}">${item.name}</h3>
-                    <p class="text-xs text-gray-400 truncate">${item.artist || item.type}</p>
-                    <span class="text-[10px] bg-white/10 px-2 py-0.5 rounded mt-auto self-start text-gray-300 uppercase tracking-wider">${item.type}</span>
-                `;
-                grid.appendChild(card);
-            });
-            section.appendChild(grid);
-            resultsDiv.appendChild(section);
-        };
+function scheduleTypeaheadRender(done) {
+    if (done) clearTimeout(typeaheadTimer);
+    else if (typeaheadTimer) return;
+    typeaheadTimer = setTimeout(() => {
+        typeaheadTimer = null;
+        const data = { top: [] };
+        SEARCH_GROUPS.forEach(group => {
+            data[group] = typeaheadGroups[group] || [];
+            if (data[group].length) data.top.push(data[group][0]);
+        });
+        if (done || data.top.length) renderSearchResults(data);
+    }, done ? 0 : 30);
+}
 
-        createSection('Top Results', data.top);
-        createSection('Songs', data.songs);
-        createSection('Albums', data.albums);
-        createSection('Artists', data.artists);
-        createSection('Playlists', data.playlists);
-        createSection('Music Videos', data.music_videos);
+export async function search(query) {
+    const resultsDiv = document.getElementById('searchResults');
+    if (resultsDiv) resultsDiv.innerHTML = '<div class="col-span-full text-center text-gray-400 py-10">Searching...</div>';
+    typeaheadId += 1; // drop typeahead results still in flight
 
+    try {
+        renderSearchResults(await apiSearch(query));
     } catch (e) {
         resultsDiv.innerHTML = `<div class="text-center text-red-400 py-10 w-full">Error: ${e}</div>`;
     }
 }
 
+function renderSearchResults(data) {
+    const resultsDiv = document.getElementById('searchResults');
+    if (!resultsDiv) return;
+    resultsDiv.innerHTML = '';
+    resultsDiv.className = 'flex flex-col gap-10'; // Change grid to column stack
+
+    const hasResults = Object.values(data).some(arr => arr.length > 0);
+    if (!hasResults) {
+        resultsDiv.innerHTML = '<div class="text-center text-gray-400 py-10 w-full">No results found</div>';
+        return;
+    }
+
+    const createSection = (title, items) => {
+        if (!items || items.length === 0) return;
+        
+        const section = document.createElement('div');
+        section.className = 'flex flex-col gap-4';
+        
+        const header = document.createElement('h3');
+        header.className = 'text-2xl font-bold text-white border-b border-white/10 pb-2';
+        header.textContent = title;
+        section.appendChild(header);
+
+        const grid = document.createElement('div');
+        grid.className = 'grid grid-cols-2 md:grid-cols-3 lg:grid-cols-5 gap-6';
+        
+        items.forEach(item => {
+            const card = document.createElement('div');
+            card.className = "glass rounded-xl p-4 hover:bg-white/10 transition cursor-pointer group flex flex-col";
+            card.onclick = () => {
+                if (item.type === 'artists') openArtistModal(item);
+                else if (item.type === 'albums') openAlbumModal(item);
+                else addToQueue(item.url, item.name, item.artist, item.album, item.image);
+            };
+            card.innerHTML = `
+                <div class="aspect-square rounded-lg overflow-hidden mb-3 relative shadow-lg bg-black/50">
+                    <img src="${artworkUrl(item.image, 300)}" loading="lazy" class="w-full h-full object-cover group-hover:scale-110 transition duration-500">
+                    <div class="absolute inset-0 bg-black/40 opacity-0 group-hover:opacity-100 transition flex items-center justify-center">
+                        <svg class="w-12 h-12 text-white" fill="currentColor" viewBox="0 0 24 24"><path d="M8 5v14l11-7z"/></svg>
+                    </div>
+                </div>
+                <h3 class="font-bold truncate text-white text-sm mb-1" title="${item.name}">${item.name}</h3>
+                <p class="text-xs text-gray-400 truncate">${item.artist || item.type}</p>
+                <span class="text-[10px] bg-white/10 px-2 py-0.5 rounded mt-auto self-start text-gray-300 uppercase tracking-wider">${item.type}</span>
+            `;
+            grid.appendChild(card);
+        });
+        section.appendChild(grid);
+        resultsDiv.appendChild(section);
+    };
+
+    createSection('Top Results', data.top);
+    createSection('Songs', data.songs);
+    createSection('Albums', data.albums);
+    createSection('Artists', data.artists);
+    createSection('Playlists', data.playlists);
+    createSection('Music Videos', data.music_videos);
+}
+
 // --- Artist Modal Logic ---
 
 // Exporting these to window so HTML onclicks can find them (if we use onclick in innerHTML)
@@ -95,6 +152,7 @@ export async function search(query) {
 window.downloadAllArtistItems = downloadAllArtistItems;
 window.downloadSelectedArtistItems = downloadSelectedArtistItems;
 window.toggleSectionSelection = toggleSectionSelection;
+window.watchCurrentArtist = watchCurrentArtist;
 
 
 async function openArtistModal(artistItem) {
@@ -125,6 +183,10 @@ async function openArtistModal(artistItem) {
         const controlsDiv = document.createElement('div');
         controlsDiv.className = 'flex justify-end gap-3 mb-6';
         controlsDiv.innerHTML = `
+            <button onclick="watchCurrentArtist()" title="Check this artist daily and queue new releases" class="px-6 py-2 rounded-lg text-sm bg-white/10 hover:bg-white/20 text-white transition flex items-center gap-2">
+                <svg class="w-4 h-4" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M15 17h5l-1.405-1.405A2.032 2.032 0 0118 14.158V11a6.002 6.002 0 00-4-5.659V5a2 2 0 10-4 0v.341C7.67 6.165 6 8.388 6 11v3.159c0 .538-.214 1.055-.595 1.436L4 17h5m6 0v1a3 3 0 11-6 0v-1m6 0H9"></path></svg>
+                Watch New Releases
+            </button>
             <button onclick="downloadAllArtistItems()" class="btn-primary px-6 py-2 rounded-lg text-sm shadow-lg flex items-center gap-2">
                 <svg class="w-4 h-4" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M4 16v1a3 3 0 003 3h10a3 3 0 003-3v-1m-4-4l-4 4m0 0l-4-4m4 4V4"></path></svg>
                 Download Discography
@@ -133,6 +195,7 @@ async function openArtistModal(artistItem) {
         contentDiv.appendChild(controlsDiv);
 
         currentArtistData = data;
+        currentArtistUrl = artistItem.url;
 
         const createSection = (title, items) => {
             if (!items || items.length === 0) return;
@@ -157,7 +220,7 @@ async function openArtistModal(artistItem) {
                 card.className = "glass rounded-xl p-3 transition-all duration-300 cursor-pointer group flex-shrink-0 w-40 snap-start flex flex-col relative border border-transparent";
                 card.dataset.id = item.url; 
                 
-                const imgUrl = item.image || "https://music.apple.com/assets/default/album-cover.png";                
+                const imgUrl = artworkUrl(item.image, 300);                
                 card.innerHTML = `
                     <div class="absolute top-2 right-2 z-50 selection-trigger p-1 rounded-full">
                         <div class="selection-ring w-6 h-6 rounded-full border-2 border-white/60 bg-black/60 flex items-center justify-center transition-colors hover:border-pink-400 hover:bg-black/80 shadow-lg backdrop-blur-sm">
@@ -280,8 +343,8 @@ function toggleSectionSelection(title) {
     }
 }
 
-function downloadAllArtistItems() {
-    if (!currentArtistData) return;
+async function downloadAllArtistItems() {
+    if (!currentArtistData || !currentArtistUrl) return;
     
     const allItems = [
         ...currentArtistData.albums,
@@ -294,22 +357,39 @@ function downloadAllArtistItems() {
     if (allItems.length === 0) return;
     
     if (confirm(`Add all ${allItems.length} items to queue?`)) {
-        allItems.forEach(item => addToQueue(item.url, item.name, item.artist, item.album, item.image, item.trackNumber, item.trackCount));
+        // The server expands every view (including pages the modal didn't load) and skips releases already queued.
+        try {
+            await apiDownloadArtist(currentArtistUrl, selectedCodec(), ['full-albums', 'singles', 'compilations', 'music-videos']);
+            window.dispatchEvent(new Event('refreshQueue'));
+        } catch (e) { alert(e.message); }
         closeModal('artistModal');
     }
 }
 
-function downloadSelectedArtistItems() {
+// The server checks watched artists in the background and queues only releases that come out from now on
+async function watchCurrentArtist() {
+    if (!currentArtistUrl) return;
+    try {
+        await apiWatchArtist(currentArtistUrl, selectedCodec());
+        showMessage('Watchlist', 'New releases by this artist will be added to the queue automatically.');
+    } catch (e) { alert(e.message); }
+}
+
+async function downloadSelectedArtistItems() {
     if (!currentArtistData || !currentArtistData.selected) return;
     
-    const items = currentArtistData.selected;
-    items.forEach(item => {
+    const codec = selectedCodec();
+    const items = currentArtistData.selected.map(item => {
         // If the item itself is an album/EP/single, its NAME is the album name.
         // If it's a song, it usually has an 'album' property.
         const albumName = (item.type === 'albums' || item.type === 'eps' || item.type === 'singles') ? item.name : item.album;
         
-        addToQueue(item.url, item.name, item.artist, albumName, item.image, item.trackNumber, item.trackCount);
+        return { url: item.url, codec, title: item.name, artist: item.artist, album: albumName, image: item.image, track_number: item.trackNumber, total_tracks: item.trackCount };
     });
+    try {
+        await apiAddBatch(items);
+        window.dispatchEvent(new Event('refreshQueue'));
+    } catch (e) { alert(e.message); }
     
     selectedArtistItems.clear();
     updateArtistSelectionUI();
@@ -253,6 +253,10 @@ export async function loadSettings() {
         form.appendChild(createField('max-memory-limit', config['max-memory-limit'], 'Max Memory Limit (MB)'));
         form.appendChild(createField('limit-max', config['limit-max'], 'Max Download Limit'));
         form.appendChild(createField('parallel-downloads', config['parallel-downloads'], 'Parallel Downloads'));
+        form.appendChild(createField('max-parallel-downloads', config['max-parallel-downloads'] ?? 8, 'Max Parallel Downloads', 'text', [],
+            'Highest value the Parallel selector accepts; the server runs fewer while disk, memory or I/O are short'));
+        form.appendChild(createField('track-level-scheduling', config['track-level-scheduling'] ?? false, 'Track-Level Scheduling', 'boolean', [],
+            'Download album tracks as independent jobs so they share the parallel slots'));
 
         createSection("Audio Quality");
         form.appendChild(createField('preferred-quality', config['preferred-quality'], 'Preferred Quality', 'select', ['ALAC', 'AAC', 'Atmos']));
@@ -283,6 +287,8 @@ export async function loadSettings() {
         form.appendChild(createField('decrypt-m3u8-port', config['decrypt-m3u8-port'], 'Decrypt Port'));
         form.appendChild(createField('get-m3u8-port', config['get-m3u8-port'], 'Get M3U8 Port'));
         form.appendChild(createField('get-m3u8-mode', config['get-m3u8-mode'], 'Get M3U8 Mode'));
+        form.appendChild(createField('wrapper-instances', config['wrapper-instances'] ?? 1, 'Wrapper Instances', 'text', [],
+            'Decryptor daemons to run side by side (ports 10020+i / 20020+i / 30020+i). Takes effect after a restart.'));
         form.appendChild(createField('ffmpeg-path', config['ffmpeg-path'], 'FFmpeg Path'));
 
         const btnDiv = document.createElement('div');
@@ -324,7 +330,8 @@ export async function saveSettings() {
         if (res.ok) {
             showMessage('Settings Saved', 'Your configuration has been updated.');
         } else {
-            showMessage('Error', 'Failed to save settings.');
+            const err = await res.json().catch(() => ({}));
+            showMessage('Error', 'Failed to save settings.' + (err.detail ? '\n' + err.detail : ''));
         }
     } catch (e) {
         showMessage('Error', 'Failed to save settings: ' + e);
@@ -5,6 +5,15 @@ export const state = {
     // Shared state can go here
 };
 
+export const DEFAULT_COVER = 'https://music.apple.com/assets/default/album-cover.png';
+
+// Cover art through the server's artwork cache; the size snaps up to 128, 300 or 600 px server-side
+export function artworkUrl(url, size = 300) {
+    if (!url) return DEFAULT_COVER;
+    if (!url.includes('mzstatic.com')) return url;
+    return `/api/artwork?size=${size}&url=${encodeURIComponent(url)}`;
+}
+
 export function showMessage(title, message) {
     const titleEl = document.getElementById('messageTitle');
     const bodyEl = document.getElementById('messageBody');
@@ -1,18 +1,31 @@
 import os
 import asyncio
-import subprocess
 import logging
-import requests
+import httpx
+import random
 import re
 import time
 import json
 import threading
-from typing import List, Optional, Dict, Any
+import heapq
+import itertools
+import base64
+import hashlib
+import sqlite3
+import shutil
+import shlex
+import socket
+import tempfile
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl
+from typing import List, Optional, Dict, Any, Tuple, Callable, Awaitable, AsyncIterator, NamedTuple, Mapping
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
+from types import MappingProxyType
 from ruamel.yaml import YAML
 
 # Configure Logging
@@ -23,17 +36,86 @@ logger = logging.getLogger(__name__)
 os.umask(0o000)
 
 # Global State
-QUEUE: List[Dict[str, Any]] = []
-LOG_CLIENTS: List[WebSocket] = []
+APP_DIR = "/app"  # the downloader runs here and reads ./config.yaml; relative save folders start here
 CONFIG_PATH = "/app/config/config.yaml"
+JOBS_DB_PATH = "/app/config/jobs.db"
+JOBS_FLUSH_INTERVAL = 1.0
+LOOP_LAG_INTERVAL = 0.5  # event-loop lag sampling period
+QUEUE_FEED_INTERVAL = 0.25
+PROGRESS_INTERVAL = 0.25
+WS_QUEUE_SIZE = 256
+WS_SEND_TIMEOUT = 5.0
+LIBRARY_DB_PATH = "/app/config/library.db"
+LIBRARY_SCAN_INTERVAL = 600
+LIBRARY_SCAN_WORKERS = 8
+LIBRARY_RESCAN_DELAY = 2.0
+LIBRARY_PATCH_LIMIT = 2000  # changed folders above which a rescan rebuilds the lookup tables
+WRAPPER_START_TIMEOUT = 30.0   # seconds for a fresh daemon to open its ports
+WRAPPER_HEALTH_INTERVAL = 5.0
+WRAPPER_HEALTH_FAILURES = 3    # consecutive failed probes before a forced restart
+WRAPPER_BACKOFF_MAX = 60.0
+WRAPPER_DECRYPT_PORT = 10020   # used when config.yaml sets no port; instance i of the pool takes the next free one from port + i
+WRAPPER_M3U8_PORT = 20020
+WRAPPER_ACCOUNT_PORT = 30020
 DOWNLOADER_BIN = "apple-music-downloader"
 WRAPPER_BIN = "./wrapper"
 WRAPPER_DATA = "/app/wrapper_data"
-CACHE_DEV_TOKEN: Optional[str] = None
+DEV_TOKEN_PATH = "/app/config/dev_tokens.json"
+DEV_TOKEN_REFRESH_MARGIN = 3600  # refresh this many seconds before the JWT expires
+DEV_TOKEN_DEFAULT_TTL = 6 * 3600  # used when a token carries no readable exp claim
+DEV_TOKEN_MIN_REFRESH_DELAY = 60  # never re-scrape a storefront's token sooner than this
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+HTTP_HOST_SLOTS: Dict[str, asyncio.Semaphore] = {}
+HTTP_MAX_PER_HOST = 8
+HTTP_RETRIES = 3
+HTTP_BACKOFF_BASE = 0.5
+AMP_API_BASE = "https://amp-api.music.apple.com"
+MUSIC_WEB_BASE = "https://music.apple.com"
+CATALOG_CACHE_PATH = "/app/config/catalog_cache.db"
+CATALOG_CACHE_SIZE = 5000
+CATALOG_CACHE_TTL = {"search": 600, "artists": 3600}
+CATALOG_CACHE_DEFAULT_TTL = 86400
+SEARCH_LIMIT = 10             # results per type
+TYPEAHEAD_MIN_PREFIX = 2      # shortest cached prefix reused for provisional typeahead results
+WATCHLIST_DB_PATH = "/app/config/watchlist.db"
+WATCHLIST_INTERVAL = 86400.0  # each watched artist is checked once per interval
+WATCHLIST_MIN_GAP = 5.0       # seconds between two artists' checks, so a long watchlist never bursts
+WATCHLIST_RETRY = 3600.0      # next attempt after a failed check
+WATCHLIST_PAGE_SIZE = 10      # releases per view page; a check usually stops after the first
+ARTIST_VIEWS = ("full-albums", "singles", "compilations", "music-videos", "live-albums")  # artist views a download or watch may ask for
+ARTWORK_CACHE_PATH = "/app/config/artwork"
+ARTWORK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+ARTWORK_SIZES = (128, 300, 600)  # thumbnail sizes served; requests snap up to the next one
+ARTWORK_HOST_SUFFIX = ".mzstatic.com"
+ENRICH_WINDOW = 0.25  # seconds to gather enqueued tasks into one batch
+ENRICH_BATCH_LIMIT = {"songs": 300, "albums": 100, "music-videos": 100, "playlists": 25}
+CATALOG_RATE = 10.0           # amp-api requests/s shared by search, browsing, enrichment and downloads
+CATALOG_BURST = 20
+CATALOG_MIN_RATE = 0.5        # floor for the rate after repeated 429s
+CATALOG_LANES = {"search": "interactive", "artist": "interactive", "artist_view": "bulk", "enrich": "background", "watchlist": "background"}
+CATALOG_BREAKER_THRESHOLD = 5   # consecutive 429/5xx/transport errors that open the breaker
+CATALOG_BREAKER_COOLDOWN = 5.0  # first open period; doubles while probes keep failing
+CATALOG_BREAKER_MAX_COOLDOWN = 300.0
+TRANSCODE_WORKERS = os.cpu_count() or 2  # ffmpeg processes, independent of download slots
+DOWNLOADER_API_COST = 3       # tokens a downloader run takes for its own amp-api calls
 LOGIN_STATUS = {"status": "idle"}
 LOGIN_PROCESS: Optional[asyncio.subprocess.Process] = None
-WRAPPER_DAEMON_PROCESS: Optional[subprocess.Popen] = None
 MAX_PARALLEL = 3
+PARALLEL_CEILING = 8         # highest parallel limit accepted unless config sets max-parallel-downloads
+ADMISSION_INTERVAL = 5.0     # seconds between resource samples
+ADMISSION_DISK_RESERVE = 1 << 30       # bytes always left free on a save folder's volume
+ADMISSION_MEMORY_RESERVE = 256 << 20   # container memory never handed to new downloaders
+ADMISSION_RAMP = 15.0        # seconds before a new downloader's memory shows up in the cgroup's usage
+ADMISSION_IO_PRESSURE = (10.0, 40.0)   # io PSI "some avg10" %: grow below the first, shrink above the second
+TRACK_BYTES = {"alac": 60 << 20, "atmos": 30 << 20, "aac": 10 << 20}  # per-track estimate until the library has samples
+PRIORITY_CLASSES = ("interactive", "album", "bulk")  # dispatch order; sources within a class take turns
+HALT_GRACE = 5.0             # seconds a paused or cancelled downloader gets after SIGTERM before it is killed
+RETRY_MAX_ATTEMPTS = 4       # automatic retries per job (or per track in track mode)
+RETRY_BASE_DELAY = 10.0      # backoff doubles per attempt, half of it jittered
+RETRY_MAX_DELAY = 600.0
+RETRY_BUDGET_RATE = 0.2      # retries/s shared by all jobs, so an outage can't become a retry storm
+RETRY_BUDGET_BURST = 20
+FAILURE_TAIL_LINES = 20      # downloader output lines kept for failure classification
 
 yaml = YAML()
 yaml.preserve_quotes = True
@@ -41,49 +123,86 @@ yaml.preserve_quotes = True
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup Logic
-    global WRAPPER_DAEMON_PROCESS
+    global HTTP_CLIENT
+    HTTP_CLIENT = create_http_client()
+    DEV_TOKENS.start(load_config().get('storefront', 'us'))
     try:
         if os.path.exists(CONFIG_PATH):
-            dest = "config.yaml"
+            dest = os.path.join(APP_DIR, "config.yaml")
             if not os.path.exists(dest):
                 try:
                     os.symlink(CONFIG_PATH, dest)
-                    logger.info(f"Created symlink for config.yaml in {os.getcwd()}")
+                    logger.info(f"Created symlink for config.yaml in {APP_DIR}")
                 except Exception as e:
                     logger.warning(f"Failed to create config symlink: {e}")
         
-        logger.info("Starting Wrapper Daemon...")
         os.makedirs(f"{WRAPPER_DATA}/data/com.apple.android.music/files", exist_ok=True)
         os.makedirs(f"{WRAPPER_DATA}/user/0/com.apple.android.music/files", exist_ok=True)
-        
-        env = os.environ.copy()
-        env["ANDROID_DATA"] = WRAPPER_DATA
-        env["ANDROID_ROOT"] = f"{WRAPPER_DATA}/system"
-        
-        cmd = [WRAPPER_BIN, "-H", "0.0.0.0"]
-        WRAPPER_DAEMON_PROCESS = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, text=True
-        )
-        logger.info(f"Wrapper Daemon started with PID {WRAPPER_DAEMON_PROCESS.pid}")
-        
-        def log_wrapper(proc):
-            for line in iter(proc.stdout.readline, ''):
-                if line: logger.info(f"[Wrapper Daemon] {line.strip()}")
-        
-        threading.Thread(target=log_wrapper, args=(WRAPPER_DAEMON_PROCESS,), daemon=True).start()
-
+        WRAPPER.configure(min(int(load_config().get('wrapper-instances') or 1), os.cpu_count() or 1))
+        WRAPPER.start()
     except Exception as e:
         logger.error(f"Failed to start Wrapper Daemon: {e}")
 
+    try:
+        JOBS.open()
+    except Exception as e:
+        logger.error(f"Failed to open job store, falling back to memory: {e}")
+        JOBS.path = ":memory:"
+        JOBS.open()
+    flush_task = asyncio.create_task(JOBS.flush_loop())
+    try:
+        CATALOG_CACHE.open()
+    except Exception as e:
+        logger.warning(f"Catalog cache disk tier unavailable, using memory only: {e}")
+    try:
+        ARTWORK.open()
+    except Exception as e:
+        logger.warning(f"Artwork cache unavailable, proxying without it: {e}")
+        ARTWORK.path = None
+    feed_task = asyncio.create_task(queue_feed_loop())
+    lag_task = asyncio.create_task(loop_lag_loop())
+    enrich_task = asyncio.create_task(ENRICHER.run())
+    try:
+        LIBRARY.open()
+    except Exception as e:
+        logger.warning(f"Library index unavailable, starting empty: {e}")
+        LIBRARY.path = ":memory:"
+        LIBRARY.open()
+    library_task = asyncio.create_task(LIBRARY.scan_loop())
+    admission_task = asyncio.create_task(ADMISSION.run())
+    try:
+        WATCHLIST.open()
+    except Exception as e:
+        logger.warning(f"Watchlist unavailable, starting empty: {e}")
+        WATCHLIST.path = ":memory:"
+        WATCHLIST.open()
+    watchlist_task = asyncio.create_task(WATCHLIST.run())
+    SCHEDULER.start()
+    TRANSCODER.start(TRANSCODE_WORKERS)
+    for task in JOBS.with_status('pending'):
+        if not task.get('title') or (task.get('track_mode') and not task.get('sub_tasks')):
+            ENRICHER.submit(task, dispatch=True)  # dispatched once the metadata is known
+        else:
+            dispatch_job(task)
+
     yield 
 
-    if WRAPPER_DAEMON_PROCESS:
-        logger.info("Stopping Wrapper Daemon...")
-        try:
-            WRAPPER_DAEMON_PROCESS.terminate()
-            WRAPPER_DAEMON_PROCESS.wait(timeout=5)
-        except Exception:
-            WRAPPER_DAEMON_PROCESS.kill()
+    await SCHEDULER.stop()
+    await TRANSCODER.stop()
+    DEV_TOKENS.stop()
+    flush_task.cancel()
+    feed_task.cancel()
+    lag_task.cancel()
+    enrich_task.cancel()
+    library_task.cancel()
+    admission_task.cancel()
+    watchlist_task.cancel()
+    JOBS.close()
+    WATCHLIST.close()
+    LIBRARY.close()
+    CATALOG_CACHE.close()
+    await HTTP_CLIENT.aclose()
+    await WRAPPER.stop()
 
 app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -97,6 +216,8 @@ class DownloadRequest(BaseModel):
     image: Optional[str] = None
     track_number: Optional[int] = None
     total_tracks: Optional[int] = None
+    track_mode: Optional[bool] = None  # schedule album tracks as separate --song units
+    priority: Optional[str] = None  # one of PRIORITY_CLASSES; derived from the URL and endpoint if unset
 
 class LoginRequest(BaseModel):
     username: str
@@ -108,30 +229,835 @@ class TwoFARequest(BaseModel):
 class ParallelLimitRequest(BaseModel):
     limit: int
 
-async def broadcast_log(message: str):
-    logger.info(message)
-    for client in LOG_CLIENTS:
+class WatchlistRequest(BaseModel):
+    url: str  # music.apple.com artist URL
+    codec: str = "alac"
+    views: List[str] = ["full-albums", "singles", "compilations"]
+    backfill: bool = False  # also queue the releases that are out already, not just future ones
+
+class QueueReorderRequest(BaseModel):
+    position: Optional[str] = None  # "top" or "bottom"
+    priority: Optional[str] = None
+
+class BatchDownloadRequest(BaseModel):
+    items: List[DownloadRequest]
+    skip_existing: bool = True
+
+class ArtistDownloadRequest(BaseModel):
+    storefront: Optional[str] = None
+    codec: str = "alac"
+    views: List[str] = ["full-albums", "singles", "compilations"]
+
+# --- JOB STORE ---
+
+class JobStore:
+    """Download jobs indexed by id and status, persisted to SQLite (WAL).
+
+    Jobs live in memory as plain dicts; mutations go through update()/touch()
+    so the status and catalog-key indexes stay correct and the row is marked dirty. Dirty rows
+    are written in batches by flush_loop() instead of on every progress line.
+
+    Every mutation also bumps a global sequence number stamped on the task as
+    'seq', and records which fields changed. drain_changes() hands the
+    coalesced deltas to the /ws/queue feed; changes_since() lets reconnecting
+    clients catch up without refetching the whole queue.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs: Dict[int, Dict[str, Any]] = {}
+        self.by_status: Dict[str, set] = defaultdict(set)
+        self.by_key: Dict[str, int] = {}  # job_key() -> latest job id
+        self._dirty: set = set()
+        self._deleted: set = set()
+        self.db: Optional[sqlite3.Connection] = None
+        self.seq = 0
+        self._changes: Dict[int, set] = {}
+        self._removed: List[int] = []
+        self._tombstones: deque = deque(maxlen=10000)  # (seq, id) of removed jobs
+        self._horizon = 0  # removals at or below this seq happened before open() and are unknown
+
+    def open(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, status TEXT NOT NULL, data TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()
+        # Removed jobs take their seq with them, so the high-water mark is kept separately.
+        self.seq = row[0] if row else 0
+        resumed = []
+        for job_id, status, data in self.db.execute("SELECT id, status, data FROM jobs ORDER BY id"):
+            try: task = json.loads(data)
+            except ValueError: continue
+            task['id'] = job_id
+            task['status'] = status
+            if status == 'downloading':
+                # Interrupted by a restart; the downloader skips tracks it already wrote.
+                task['status'] = 'pending'
+                task['progress'] = 'Resuming...'
+                for st in task.get('sub_tasks', []):
+                    if st.get('status') == 'downloading': st['status'] = 'pending'
+                resumed.append(task)
+            self.jobs[job_id] = task
+            self.by_status[task['status']].add(job_id)
+            self.by_key[job_key(task)] = job_id
+            self.seq = max(self.seq, task.get('seq', 0))
+        self._horizon = self.seq
+        for task in resumed: self._bump(task, ('status', 'progress', 'sub_tasks'))
+        logger.info(f"Job store loaded {len(self.jobs)} jobs from {self.path}")
+
+    def close(self):
+        if self.db:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+    def add(self, task: Dict[str, Any]) -> Dict[str, Any]:
+        return self.add_many([task])[0]
+
+    def add_many(self, tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insert tasks in a single transaction: either all of them are stored or none."""
+        with self.db:
+            self.db.execute("BEGIN")
+            for task in tasks:
+                task.setdefault('status', 'pending')
+                # AUTOINCREMENT never reuses ids, even after history is cleared.
+                cur = self.db.execute("INSERT INTO jobs (status, data) VALUES (?, ?)", (task['status'], json.dumps(task)))
+                task['id'] = cur.lastrowid
+        for task in tasks:
+            self.jobs[task['id']] = task
+            self.by_status[task['status']].add(task['id'])
+            self.by_key[job_key(task)] = task['id']
+            self._bump(task, task.keys())
+        return tasks
+
+    def find_existing(self, task: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Return a queued, running or completed job for the same release and codec."""
+        existing = self.jobs.get(self.by_key.get(job_key(task)))
+        if existing and existing['status'] != 'failed': return existing
+        return None
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        return self.jobs.get(job_id)
+
+    def all(self) -> List[Dict[str, Any]]:
+        return list(self.jobs.values())
+
+    def with_status(self, *statuses: str) -> List[Dict[str, Any]]:
+        ids = sorted(i for s in statuses for i in self.by_status.get(s, ()))
+        return [self.jobs[i] for i in ids]
+
+    def count(self, status: str) -> int:
+        return len(self.by_status.get(status, ()))
+
+    def update(self, task: Dict[str, Any], **fields):
+        old_status = task.get('status')
+        task.update(fields)
+        if 'status' in fields and fields['status'] != old_status:
+            self.by_status[old_status].discard(task['id'])
+            self.by_status[task['status']].add(task['id'])
+        self._bump(task, fields)
+
+    def touch(self, task: Dict[str, Any], *fields: str):
+        """Mark a task dirty after mutating nested fields (e.g. sub_tasks) in place."""
+        self._bump(task, fields)
+
+    def _bump(self, task: Dict[str, Any], fields):
+        self.seq += 1
+        task['seq'] = self.seq
+        self._changes.setdefault(task['id'], set()).update(fields)
+        self._dirty.add(task['id'])
+
+    def remove(self, job_ids):
+        for job_id in job_ids:
+            task = self.jobs.pop(job_id, None)
+            if task is None: continue
+            self.by_status[task['status']].discard(job_id)
+            if self.by_key.get(job_key(task)) == job_id: del self.by_key[job_key(task)]
+            self._dirty.discard(job_id)
+            self._deleted.add(job_id)
+            self._changes.pop(job_id, None)
+            self._removed.append(job_id)
+            self.seq += 1
+            self._tombstones.append((self.seq, job_id))
+
+    def drain_changes(self) -> Optional[Dict[str, Any]]:
+        """Return the changed fields of every task touched since the last drain."""
+        if not self._changes and not self._removed: return None
+        changes, self._changes = self._changes, {}
+        removed, self._removed = self._removed, []
+        deltas = []
+        for job_id, fields in changes.items():
+            task = self.jobs.get(job_id)
+            if task is None: continue
+            delta = {k: task.get(k) for k in fields}
+            delta['id'] = job_id
+            delta['seq'] = task['seq']
+            deltas.append(delta)
+        return {"type": "queue", "seq": self.seq, "changes": deltas, "removed": removed}
+
+    def changes_since(self, since: int, offset: int = 0, limit: Optional[int] = None) -> Dict[str, Any]:
+        # The client has to resync from scratch when we can't tell it what was
+        # deleted after `since` (removed before a restart, or the tombstone ring
+        # has overflowed past it), or when `since` is ahead of us because the
+        # seq it saw was never flushed before a crash.
+        overflowed = len(self._tombstones) == self._tombstones.maxlen and since < self._tombstones[0][0]
+        reset = since > 0 and (since > self.seq or since < self._horizon or overflowed)
+        if reset: since = 0
+        changed = [t for t in self.jobs.values() if t.get('seq', 0) > since]
+        page = changed[offset:offset + limit] if limit else changed[offset:]
+        return {
+            "seq": self.seq,
+            "reset": reset,
+            "total": len(changed),
+            "tasks": page,
+            "removed": [i for s, i in self._tombstones if s > since] if since else [],
+        }
+
+    def flush(self):
+        if not self.db or not (self._dirty or self._deleted): return
+        dirty, self._dirty = self._dirty, set()
+        deleted, self._deleted = self._deleted, set()
+        rows = [(t['status'], json.dumps(t), t['id']) for t in (self.jobs.get(i) for i in dirty) if t]
         try:
-            await client.send_text(message)
-        except:
-            pass
+            with self.db:
+                self.db.execute("BEGIN")
+                self.db.executemany("UPDATE jobs SET status = ?, data = ? WHERE id = ?", rows)
+                self.db.executemany("DELETE FROM jobs WHERE id = ?", [(i,) for i in deleted])
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seq', ?)", (self.seq,))
+        except sqlite3.Error as e:
+            logger.error(f"Job store flush failed: {e}")
+            self._dirty |= dirty
+            self._deleted |= deleted
 
-def load_config():
-    try:
-        if os.path.exists("/app/config"):
-            os.chmod("/app/config", 0o777)
-    except:
-        pass
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(JOBS_FLUSH_INTERVAL)
+            self.flush()
+
+def job_key(task: Dict[str, Any]) -> str:
+    ref = parse_catalog_url(task.get('url', ''))
+    # Storefront is left out: the same release id is the same download everywhere.
+    target = f"{ref[1]}/{ref[2]}" if ref else task.get('url', '')
+    return f"{task.get('codec', 'alac')}:{target}"
+
+JOBS = JobStore(JOBS_DB_PATH)
+
+# --- METRICS ---
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels: LabelKey, le: Optional[str] = None) -> str:
+    if le is not None: labels = labels + (("le", le),)
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels) + "}"
+
+class Metric:
+    """A named metric family. `collect`, if given, computes values at scrape time."""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None, collect: Optional[Callable[[], Any]] = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.collect = collect
+        self.values: Dict[LabelKey, float] = defaultdict(float)
+
+    def samples(self) -> List[Tuple[LabelKey, float]]:
+        if self.collect is None:
+            return list(self.values.items())
+        value = self.collect()
+        if isinstance(value, dict):
+            return [(((self.label, str(k)),), v) for k, v in value.items()]
+        return [((), value)]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.samples():
+            lines.append(f"{self.name}{format_labels(labels)} {value:g}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.series: Dict[LabelKey, List[float]] = {}  # labels -> bucket counts + [sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.get(key)
+        if series is None: series = self.series[key] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound: series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, **labels) -> "HistogramTimer":
+        return HistogramTimer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in list(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{format_labels(key, f'{bound:g}')} {count:g}")
+            lines.append(f"{self.name}_bucket{format_labels(key, '+Inf')} {series[-1]:g}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series[-2]:g}")
+            lines.append(f"{self.name}_count{format_labels(key)} {series[-1]:g}")
+        return lines
+
+class HistogramTimer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f"Metric {metric.name} failed to render: {e}")
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+JOB_STATUSES = ('pending', 'paused', 'downloading', 'completed', 'failed')
+METRICS.register(Gauge("amd_jobs", "Jobs in the queue by status.", "status", lambda: {s: JOBS.count(s) for s in JOB_STATUSES}))
+METRICS.register(Gauge("amd_scheduler_backlog", "Work units waiting for a download slot.", collect=lambda: SCHEDULER.queue.qsize()))
+METRICS.register(Gauge("amd_scheduler_backlog_by_priority", "Work units waiting for a download slot, by priority class.", "priority",
+                       lambda: SCHEDULER.queue.sizes()))
+METRICS.register(Gauge("amd_workers_active", "Download slots currently in use.", collect=lambda: SCHEDULER.slots.active))
+METRICS.register(Gauge("amd_workers_max", "Configured parallel download limit (MAX_PARALLEL).", collect=lambda: MAX_PARALLEL))
+METRICS.register(Gauge("amd_enrich_backlog", "Jobs waiting for metadata enrichment.", collect=lambda: ENRICHER.queue.qsize()))
+JOB_SECONDS = METRICS.register(Histogram("amd_job_seconds", "Wall time of whole download runs, by result."))
+JOB_FAILURES = METRICS.register(Counter("amd_job_failures_total", "Failed download runs by classified reason, retried or not.", "reason"))
+JOB_RETRIES = METRICS.register(Counter("amd_job_retries_total", "Automatic retries scheduled, by classified reason.", "reason"))
+JOB_PHASE_SECONDS = METRICS.register(Histogram("amd_job_phase_seconds", "Time spent per pipeline phase: enrich, queue_wait, subprocess, track_download, track_decrypt, transcode."))
+CATALOG_SECONDS = METRICS.register(Histogram("amd_catalog_request_seconds", "Catalog API call latency including token refresh and retries, by endpoint.",
+                                             (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)))
+LOOP_LAG = METRICS.register(Histogram("amd_event_loop_lag_seconds", "How late a periodic event-loop tick wakes up.",
+                                      (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)))
+CATALOG_ERRORS = METRICS.register(Counter("amd_catalog_errors_total", "Catalog API calls that failed or returned an error status, by endpoint."))
+METRICS.register(Counter("amd_catalog_cache_events_total", "Catalog cache hits, misses and evictions.", "event",
+                         lambda: {k: v for k, v in CATALOG_CACHE.stats.items()}))
+METRICS.register(Gauge("amd_catalog_breaker_open", "1 while the amp-api circuit breaker is open or probing.",
+                       collect=lambda: int(CATALOG_LIMITER.state != "closed")))
+METRICS.register(Gauge("amd_catalog_rate", "Current amp-api request rate allowed by the limiter.", collect=lambda: CATALOG_LIMITER.rate))
+METRICS.register(Counter("amd_catalog_throttled_total", "amp-api 429 responses seen by the limiter.", collect=lambda: CATALOG_LIMITER.stats["throttled"]))
+METRICS.register(Gauge("amd_catalog_waiting", "Calls waiting for a limiter token, by lane.", "lane",
+                       lambda: {lane: CATALOG_LIMITER.status()["waiting"].get(lane, 0) for lane in CatalogLimiter.LANES}))
+METRICS.register(Counter("amd_dev_token_refreshes_total", "Developer token refreshes.", collect=lambda: DEV_TOKENS.refresh_count))
+LIBRARY_BYTES = METRICS.register(Gauge("amd_library_bytes", "Bytes on disk per codec save folder, from the library index."))
+WRAPPER_RESTARTS = METRICS.register(Counter("amd_wrapper_restarts_total", "Wrapper daemon restarts."))
+METRICS.register(Gauge("amd_wrapper_outstanding", "Downloads currently routed to each wrapper instance.", "instance",
+                       lambda: {inst.name: inst.outstanding for inst in WRAPPER.instances}))
+METRICS.register(Gauge("amd_wrapper_ready", "Whether each wrapper instance is accepting downloads.", "instance",
+                       lambda: {inst.name: int(inst.ready.is_set()) for inst in WRAPPER.instances}))
+METRICS.register(Gauge("amd_ws_clients", "Connected WebSocket clients.", collect=lambda: len(BROADCASTER.clients)))
+METRICS.register(Counter("amd_ws_dropped_total", "WebSocket messages dropped because a client's queue was full or it was evicted.", "topic",
+                         lambda: dict(BROADCASTER.dropped)))
+
+class TrackPhaseTimer:
+    """Times each track's download and decrypt phases from parsed progress events."""
+    PHASES = {"Downloading": "track_download", "Decrypting": "track_decrypt"}
+
+    def __init__(self):
+        self.phase: Optional[str] = None
+        self.started = 0.0
+
+    def mark(self, phase: Optional[str]):
+        if phase == self.phase: return
+        now = time.monotonic()
+        if self.phase: JOB_PHASE_SECONDS.observe(now - self.started, phase=self.PHASES.get(self.phase, self.phase))
+        self.phase, self.started = phase, now
+
+# --- LIBRARY INDEX ---
+
+AUDIO_EXTENSIONS = {'.m4a', '.mp4', '.flac', '.alac', '.aac', '.mp3', '.opus', '.ogg', '.wav', '.ec3'}
+FORBIDDEN_NAME_CHARS = re.compile(r'[/\\<>:"|?*]')
+TEMPLATE_FIELD = re.compile(r'\{(\w+)\}')
+NUMBER_FIELDS = {'SongNumer', 'TrackNumber', 'DiscNumber'}
+
+def fold_name(name: str) -> str:
+    return re.sub(r'\s+', ' ', FORBIDDEN_NAME_CHARS.sub('_', str(name))).lower()
+
+def normalize_name(name: str) -> str:
+    """Fold a file or folder name the way the downloader sanitizes it, ignoring case."""
+    return fold_name(name).strip(' .')
+
+def name_pattern(template: str, values: Dict[str, Any]) -> Tuple[Optional[str], re.Pattern]:
+    """Compile a downloader naming template against known metadata.
+
+    Fields without a value match anything; track and disc numbers match with
+    or without zero padding. The normalized name is returned as well when it
+    is fully determined, so callers can use a dict lookup instead of a scan.
+    """
+    parts, literal, pos = [], [], 0
+    template = template.strip()
+    for m in TEMPLATE_FIELD.finditer(template):
+        text = fold_name(template[pos:m.start()])
+        parts.append(re.escape(text))
+        value = values.get(m.group(1))
+        if value is None or value == '':
+            parts.append('.*?')
+            literal = None
+        elif m.group(1) in NUMBER_FIELDS:
+            parts.append(f"0*{int(value)}")
+            literal = None
+        else:
+            parts.append(re.escape(normalize_name(value)))
+            if literal is not None: literal += [text, normalize_name(value)]
+        pos = m.end()
+    tail = fold_name(template[pos:])
+    parts.append(re.escape(tail))
+    pattern = re.compile(''.join(parts))
+    return (normalize_name(''.join(literal) + tail) if literal is not None else None), pattern
+
+def library_roots(config) -> Dict[str, str]:
+    """Codec -> absolute save folder; relative folders are relative to APP_DIR like the downloader's."""
+    roots = {}
+    for codec in ('alac', 'atmos', 'aac'):
+        folder = config.get(f'{codec}-save-folder')
+        if folder: roots[codec] = os.path.normpath(os.path.join(APP_DIR, folder))
+    return roots
+
+def library_codec(codec: str) -> str:
+    return 'atmos' if codec == 'ec3' else codec
+
+class LibraryIndex:
+    """What is already on disk under the codec save folders, persisted to SQLite.
+
+    Each directory row holds the directory's mtime and its listing. A rescan
+    stats every directory but only re-lists those whose mtime moved, one tree
+    level at a time across a thread pool, so an unchanged 100k-file library
+    costs one stat per folder. Lookups resolve the album-folder-format and
+    song-file-format templates against a job's catalog metadata and remember
+    which file each (codec, catalog id) matched.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.dirs: Dict[str, Tuple[int, List[str], List[Tuple[str, int]]]] = {}  # path -> (mtime_ns, subdirs, files)
+        self.roots: Dict[str, str] = {}
+        self.albums: Dict[str, Dict[str, List[str]]] = {}  # codec -> normalized folder name -> folders
+        self.files: Dict[str, Dict[str, str]] = {}  # folder -> normalized audio stem -> file name
+        self.known: Dict[Tuple[str, str], str] = {}  # (codec, catalog id) -> file path
+        self.bytes: Dict[str, int] = {}
+        self.counts: Dict[str, int] = {}  # audio files per codec
+        self.stats = {'dirs': 0, 'files': 0, 'relisted': 0, 'scan_seconds': 0.0, 'scanned_at': None,
+                      'skipped_jobs': 0, 'trimmed_tracks': 0}
+        self._wake: Optional[asyncio.Event] = None
+        self._scan_lock = asyncio.Lock()
+
+    def open(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, listing TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tracks (codec TEXT NOT NULL, catalog_id TEXT NOT NULL, path TEXT NOT NULL, PRIMARY KEY (codec, catalog_id))")
+        for path, mtime, listing in self.db.execute("SELECT path, mtime, listing FROM dirs"):
+            try: data = json.loads(listing)
+            except ValueError: continue
+            self.dirs[path] = (mtime, data['d'], [tuple(f) for f in data['f']])
+        self.known = {(codec, cid): path for codec, cid, path in self.db.execute("SELECT codec, catalog_id, path FROM tracks")}
+        self._rebuild(library_roots(load_config()))
+
+    def close(self):
+        if self.db: self.db.close()
+        self.db = None
+
+    def _list_dir(self, path: str):
+        try: mtime = os.stat(path).st_mtime_ns
+        except OSError: return path, None, False
+        entry = self.dirs.get(path)
+        if entry and entry[0] == mtime: return path, entry, False
+        subdirs, files = [], []
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False): subdirs.append(e.name)
+                        elif e.is_file(follow_symlinks=False): files.append((e.name, e.stat(follow_symlinks=False).st_size))
+                    except OSError: pass
+        except OSError: return path, None, False
+        return path, (mtime, subdirs, files), True
+
+    def scan(self, roots: Dict[str, str]) -> Dict:
+        """Bring the index up to date with `roots` (blocking; run it in a thread)."""
+        started = time.monotonic()
+        seen, changed = set(), {}
+        with ThreadPoolExecutor(LIBRARY_SCAN_WORKERS) as pool:
+            level = sorted(set(roots.values()))
+            while level:
+                following = []
+                for path, entry, fresh in pool.map(self._list_dir, level):
+                    if entry is None: continue
+                    seen.add(path)
+                    if fresh: changed[path] = entry
+                    following.extend(os.path.join(path, d) for d in entry[1])
+                level = [p for p in following if p not in seen]
+        prefixes = tuple(r.rstrip(os.sep) + os.sep for r in roots.values())
+        stale = [p for p in self.dirs if p not in seen and (p in roots.values() or p.startswith(prefixes))]
+        with self.lock:
+            previous = {p: self.dirs[p] for p in list(changed) + stale if p in self.dirs}
+            for p in stale: self.dirs.pop(p, None)
+            self.dirs.update(changed)
+            if self.db and (stale or changed):
+                self.db.execute("BEGIN")
+                self.db.executemany("DELETE FROM dirs WHERE path = ?", [(p,) for p in stale])
+                self.db.executemany("INSERT OR REPLACE INTO dirs (path, mtime, listing) VALUES (?, ?, ?)",
+                                    [(p, e[0], json.dumps({'d': e[1], 'f': e[2]})) for p, e in changed.items()])
+                self.db.execute("COMMIT")
+        if roots != self.roots or len(changed) + len(stale) > LIBRARY_PATCH_LIMIT:
+            self._rebuild(roots)
+        else:
+            # Patch copies and swap them in: lookups on the event loop must never see a folder half re-indexed
+            tables = (self.roots, {c: dict(names) for c, names in self.albums.items()}, dict(self.files), dict(self.bytes), dict(self.counts))
+            for p, entry in previous.items(): self._index(tables, p, entry, -1)
+            for p, entry in changed.items(): self._index(tables, p, entry, 1)
+            self._swap(tables)
+        self.stats.update(dirs=len(seen), relisted=len(changed), scan_seconds=round(time.monotonic() - started, 3), scanned_at=time.time())
+        return self.stats
+
+    def _index(self, tables: Tuple, path: str, entry: Tuple, sign: int, codecs: Optional[List[str]] = None):
+        """Add (sign=1) or remove (sign=-1) one folder's listing in (roots, albums, files, bytes, counts) tables."""
+        roots, albums, files, sizes, counts = tables
+        if codecs is None:
+            codecs = [c for c, r in roots.items() if path == r or path.startswith(r.rstrip(os.sep) + os.sep)]
+        audio = {}
+        for name, _ in entry[2]:
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in AUDIO_EXTENSIONS: audio[normalize_name(stem)] = name
+        size = sum(f[1] for f in entry[2])
+        for codec in codecs:
+            sizes[codec] = sizes.get(codec, 0) + sign * size
+            counts[codec] = counts.get(codec, 0) + sign * len(audio)
+            if path == roots[codec]: continue
+            names = albums.setdefault(codec, {})
+            name = normalize_name(os.path.basename(path))
+            # Folder lists can be shared with the live tables, so they are replaced, never mutated
+            folders = names.get(name, [])
+            if sign > 0 and path not in folders: names[name] = folders + [path]
+            elif sign < 0 and path in folders: names[name] = [f for f in folders if f != path]
+        if sign < 0: files.pop(path, None)
+        elif audio: files[path] = audio
+
+    def _rebuild(self, roots: Dict[str, str]):
+        tables = (roots, {c: {} for c in roots}, {}, {c: 0 for c in roots}, {c: 0 for c in roots})
+        for codec, root in roots.items():
+            stack = [root]
+            while stack:
+                path = stack.pop()
+                entry = self.dirs.get(path)
+                if not entry: continue
+                stack.extend(os.path.join(path, d) for d in entry[1])
+                self._index(tables, path, entry, 1, [codec])
+        self._swap(tables)
+
+    def _swap(self, tables: Tuple):
+        files = sum(len(audio) for audio in tables[2].values())
+        with self.lock:
+            self.roots, self.albums, self.files, self.bytes, self.counts = tables
+            self.stats['files'] = files
+
+    def _on_disk(self, path: str) -> bool:
+        stem = normalize_name(os.path.splitext(os.path.basename(path))[0])
+        return self.files.get(os.path.dirname(path), {}).get(stem) == os.path.basename(path)
+
+    def missing(self, task: Dict) -> Optional[List[int]]:
+        """Indices of the job's tracks that are not on disk, or None when the index can't tell.
+
+        Only albums and songs with resolved metadata are answered; a song job
+        counts as a single track.
+        """
+        found = self.locate(task)
+        if found is None: return None
+        return [i for i in range(len(task.get('sub_tasks') or []) or 1) if i not in found]
+
+    def locate(self, task: Dict, indices: Optional[List[int]] = None) -> Optional[Dict[int, str]]:
+        """Files of the job's tracks (all, or `indices`) found on disk, by track index."""
+        ref = parse_catalog_url(task.get('url', ''))
+        if not ref or ref[1] not in ('albums', 'songs') or not task.get('album'): return None
+        codec = library_codec(task.get('codec', 'alac'))
+        albums = self.albums.get(codec)
+        if albums is None: return None
+        if ref[1] == 'albums': tracks = task.get('sub_tasks') or []
+        else: tracks = [{'id': ref[2], 'title': task.get('title'), 'track_number': task.get('track_number')}]
+        if not tracks or not all(t.get('id') and t.get('title') for t in tracks): return None
+        wanted = range(len(tracks)) if indices is None else indices
+        found = {i: path for i in wanted if (path := self.known.get((codec, tracks[i]['id']))) and self._on_disk(path)}
+        unresolved = [i for i in wanted if i not in found]
+        if unresolved:
+            resolved = self._resolve(task, ref, tracks, unresolved, albums)
+            if resolved: self.remember(codec, {tracks[i]['id']: path for i, path in resolved.items()})
+            found.update(resolved)
+        return found
+
+    def has_release(self, task: Dict) -> bool:
+        """Whether an album folder matching the job already holds its track count; needs no track metadata."""
+        ref = parse_catalog_url(task.get('url', ''))
+        if not ref or ref[1] != 'albums' or not task.get('album') or not task.get('total_tracks'): return False
+        albums = self.albums.get(library_codec(task.get('codec', 'alac')))
+        if not albums: return False
+        return any(len(self.files.get(d, ())) >= task['total_tracks'] for d in self._candidates(task, ref, albums, load_config()))
+
+    def _candidates(self, task: Dict, ref: Tuple[str, str, str], albums: Dict[str, List[str]], config) -> List[str]:
+        """Album folders whose names fit the job under the configured folder formats."""
+        release_date = task.get('release_date') or None
+        literal, album_re = name_pattern(config.get('album-folder-format') or '{AlbumName}', {
+            'AlbumId': ref[2] if ref[1] == 'albums' else None, 'AlbumName': task['album'], 'ArtistName': task.get('artist'),
+            'ReleaseDate': release_date, 'ReleaseYear': release_date[:4] if release_date else None})
+        if literal is not None: candidates = albums.get(literal, [])
+        else: candidates = [d for name, dirs in list(albums.items()) if album_re.fullmatch(name) for d in list(dirs)]
+        artist_template = config.get('artist-folder-format') or ''
+        if artist_template and candidates:
+            _, artist_re = name_pattern(artist_template, {'ArtistName': task.get('artist')})
+            candidates = [d for d in candidates if artist_re.fullmatch(normalize_name(os.path.basename(os.path.dirname(d))))]
+        return candidates
+
+    def _resolve(self, task: Dict, ref: Tuple[str, str, str], tracks: List[Dict], wanted: List[int], albums: Dict[str, List[str]]) -> Dict[int, str]:
+        config = load_config()
+        candidates = self._candidates(task, ref, albums, config)
+        if not candidates: return {}
+        song_template = config.get('song-file-format') or '{SongNumer}. {SongName}'
+        patterns = {i: name_pattern(song_template, {
+            'SongId': tracks[i]['id'], 'SongName': tracks[i]['title'], 'SongNumer': tracks[i].get('track_number'),
+            'TrackNumber': tracks[i].get('track_number'), 'DiscNumber': tracks[i].get('disc_number')})[1] for i in wanted}
+        best: Dict[int, str] = {}
+        for folder in candidates:
+            stems = self.files.get(folder)
+            if not stems: continue
+            found = {}
+            for i, pattern in patterns.items():
+                name = next((name for stem, name in stems.items() if pattern.fullmatch(stem)), None)
+                if name: found[i] = os.path.join(folder, name)
+            if len(found) > len(best): best = found
+        return best
+
+    def remember(self, codec: str, matches: Dict[str, str]):
+        with self.lock:
+            for cid, path in matches.items(): self.known[(codec, cid)] = path
+            if self.db:
+                self.db.executemany("INSERT OR REPLACE INTO tracks (codec, catalog_id, path) VALUES (?, ?, ?)",
+                                    [(codec, cid, path) for cid, path in matches.items()])
+
+    def track_bytes(self, codec: str) -> int:
+        """Average bytes per track already in the codec's folder, or a fixed estimate until there are enough files."""
+        files = self.counts.get(codec, 0)
+        if files >= 20: return self.bytes.get(codec, 0) // files
+        return TRACK_BYTES.get(codec, TRACK_BYTES['alac'])
+
+    def request_scan(self):
+        """Ask the scan loop for an early incremental pass, e.g. after a download finished."""
+        if self._wake: self._wake.set()
+
+    async def refresh(self):
+        """Run an incremental scan now; concurrent callers share the lock instead of racing."""
+        async with self._scan_lock:
+            stats = await asyncio.to_thread(self.scan, library_roots(load_config()))
+        for codec, total in self.bytes.items(): LIBRARY_BYTES.set(total, codec=codec)
+        logger.debug(f"Library scan: {stats['dirs']} folders, {stats['relisted']} relisted in {stats['scan_seconds']}s")
+
+    async def scan_loop(self):
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Library scan failed: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), LIBRARY_SCAN_INTERVAL)
+                await asyncio.sleep(LIBRARY_RESCAN_DELAY)  # let a burst of finished tracks land first
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+LIBRARY = LibraryIndex(LIBRARY_DB_PATH)
+METRICS.register(Gauge("amd_library_files", "Audio files known to the library index, per codec folder.", "codec",
+                       lambda: {codec: sum(len(LIBRARY.files.get(d, ())) for dirs in names.values() for d in dirs)
+                                for codec, names in LIBRARY.albums.items()}))
+METRICS.register(Counter("amd_library_skipped_jobs_total", "Jobs completed from the library index without running the downloader.",
+                         collect=lambda: LIBRARY.stats['skipped_jobs']))
+METRICS.register(Counter("amd_library_trimmed_tracks_total", "Album tracks left out of a download because they were already on disk.",
+                         collect=lambda: LIBRARY.stats['trimmed_tracks']))
+
+# --- BROADCAST ---
+
+class WsClient:
+    """A connected socket, its topic subscriptions and its bounded outbox."""
+    def __init__(self, websocket: WebSocket, topics: set):
+        self.websocket = websocket
+        self.topics = topics
+        self.outbox: deque = deque()  # (topic, key, [message])
+        self.keyed: Dict[str, list] = {}  # coalesce key -> pending message cell
+        self.wakeup = asyncio.Event()
+
+class Broadcaster:
+    """Non-blocking fan-out of log, queue and login messages to WebSocket clients.
+
+    publish() never awaits a socket: it appends to each subscriber's bounded
+    outbox and a per-client writer task does the sending. Messages with a
+    coalesce key replace a still-pending message with the same key. A full
+    outbox drops its oldest message, except on RESYNC_TOPICS, where pending
+    messages collapse into one "resync" marker so the client refetches instead
+    of silently missing deltas. Sockets that error or stall past
+    WS_SEND_TIMEOUT are evicted.
+    """
+    TOPICS = {"logs", "queue", "login"}
+    RESYNC_TOPICS = {"queue"}
+
+    def __init__(self, max_queue: int = WS_QUEUE_SIZE):
+        self.max_queue = max_queue
+        self.clients: Dict[WebSocket, WsClient] = {}
+        self.published: Dict[str, int] = defaultdict(int)
+        self.sent: Dict[str, int] = defaultdict(int)
+        self.dropped: Dict[str, int] = defaultdict(int)
+        self.coalesced: Dict[str, int] = defaultdict(int)
+        self.evicted = 0
+
+    def subscribers(self, topic: str) -> int:
+        return sum(1 for c in self.clients.values() if topic in c.topics)
+
+    def publish(self, topic: str, message: str, key: Optional[str] = None):
+        self.published[topic] += 1
+        for client in self.clients.values():
+            if topic in client.topics: self._offer(client, topic, message, key)
+
+    def _offer(self, client: WsClient, topic: str, message: str, key: Optional[str]):
+        cell = client.keyed.get(key) if key else None
+        if cell is not None:
+            cell[0] = message
+            self.coalesced[topic] += 1
+            return
+        if len(client.outbox) >= self.max_queue:
+            if topic in self.RESYNC_TOPICS:
+                self._collapse(client, topic)
+                return
+            old_topic, old_key, old_cell = client.outbox.popleft()
+            if old_key and client.keyed.get(old_key) is old_cell: del client.keyed[old_key]
+            self.dropped[old_topic] += 1
+        cell = [message]
+        client.outbox.append((topic, key, cell))
+        if key: client.keyed[key] = cell
+        client.wakeup.set()
 
-    if os.path.exists(CONFIG_PATH):
+    def _collapse(self, client: WsClient, topic: str):
+        marker = f"{topic}:resync"
+        if marker in client.keyed:
+            self.dropped[topic] += 1
+            return
+        kept = deque()
+        for entry in client.outbox:
+            if entry[0] == topic:
+                self.dropped[topic] += 1
+                if entry[1]: client.keyed.pop(entry[1], None)
+            else: kept.append(entry)
+        cell = [json.dumps({"type": "resync", "topic": topic})]
+        kept.append((topic, marker, cell))
+        client.keyed[marker] = cell
+        client.outbox = kept
+        self.dropped[topic] += 1
+        client.wakeup.set()
+
+    async def serve(self, websocket: WebSocket, topics: set):
+        """Run one WebSocket connection until it disconnects."""
+        await websocket.accept()
+        client = WsClient(websocket, topics & self.TOPICS)
+        self.clients[websocket] = client
+        writer = asyncio.create_task(self._writer(client))
+        try:
+            while True: await websocket.receive_text()
+        except Exception: pass
+        finally:
+            writer.cancel()
+            self.clients.pop(websocket, None)
+
+    async def _writer(self, client: WsClient):
         try:
-            with open(CONFIG_PATH, 'r') as f:
-                return yaml.load(f) or {}
+            while True:
+                while not client.outbox:
+                    client.wakeup.clear()
+                    await client.wakeup.wait()
+                topic, key, cell = client.outbox.popleft()
+                if key and client.keyed.get(key) is cell: del client.keyed[key]
+                await asyncio.wait_for(client.websocket.send_text(cell[0]), WS_SEND_TIMEOUT)
+                self.sent[topic] += 1
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Failed to load config: {e}")
-            return {}
-    
-    default_config = """media-user-token: ""
+            if self.clients.pop(client.websocket, None) is None: return
+            self.evicted += 1
+            for topic, _, _ in client.outbox: self.dropped[topic] += 1
+            client.outbox.clear()
+            logger.warning(f"Evicting WebSocket client: {type(e).__name__}")
+            try: await client.websocket.close()
+            except Exception: pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "clients": len(self.clients),
+            "subscribers": {t: self.subscribers(t) for t in sorted(self.TOPICS)},
+            "published": dict(self.published),
+            "sent": dict(self.sent),
+            "dropped": dict(self.dropped),
+            "coalesced": dict(self.coalesced),
+            "evicted": self.evicted,
+            "backlog": sum(len(c.outbox) for c in self.clients.values()),
+        }
+
+BROADCASTER = Broadcaster()
+
+async def broadcast_log(message: str, key: Optional[str] = None):
+    logger.info(message)
+    BROADCASTER.publish("logs", message, key)
+
+def set_login_status(status: str):
+    LOGIN_STATUS["status"] = status
+    BROADCASTER.publish("login", json.dumps({"type": "login", "status": status}))
+
+# --- CONFIG ---
+
+DEFAULT_CONFIG = """media-user-token: ""
 authorization-token: ""
 language: ""
 lrc-type: "lyrics"
@@ -177,43 +1103,587 @@ convert-extra-args: ""
 convert-warn-lossy-to-lossless: true
 convert-skip-lossy-to-lossless: true
 """
-    try:
-        with open(CONFIG_PATH, 'w') as f:
-            f.write(default_config)
-        with open(CONFIG_PATH, 'r') as f:
-            return yaml.load(f)
-    except Exception as e:
-        logger.error(f"Failed to create default config: {e}")
-        return {}
 
-def save_config(config: Dict):
+# Expected type of every key the UI or the downloader reads. Values arriving as
+# strings from the settings form are coerced; unknown keys are rejected.
+CONFIG_SCHEMA: Dict[str, type] = {
+    'media-user-token': str, 'authorization-token': str, 'language': str, 'storefront': str,
+    'lrc-type': str, 'lrc-format': str, 'embed-lrc': bool, 'save-lrc-file': bool,
+    'save-artist-cover': bool, 'save-animated-artwork': bool, 'emby-animated-artwork': bool,
+    'embed-cover': bool, 'cover-size': str, 'cover-format': str,
+    'alac-save-folder': str, 'atmos-save-folder': str, 'aac-save-folder': str,
+    'max-memory-limit': int, 'decrypt-m3u8-port': str, 'get-m3u8-port': str,
+    'get-m3u8-from-device': bool, 'get-m3u8-mode': str, 'aac-type': str,
+    'alac-max': int, 'atmos-max': int, 'limit-max': int,
+    'album-folder-format': str, 'playlist-folder-format': str, 'song-file-format': str, 'artist-folder-format': str,
+    'explicit-choice': str, 'clean-choice': str, 'apple-master-choice': str,
+    'use-songinfo-for-playlist': bool, 'dl-albumcover-for-playlist': bool,
+    'mv-audio-type': str, 'mv-max': int, 'preferred-quality': str, 'parallel-downloads': int, 'track-level-scheduling': bool,
+    'max-parallel-downloads': int, 'wrapper-instances': int,
+    'convert-after-download': bool, 'convert-format': str, 'convert-keep-original': bool,
+    'convert-skip-if-source-matches': bool, 'ffmpeg-path': str, 'convert-extra-args': str,
+    'convert-warn-lossy-to-lossless': bool, 'convert-skip-lossy-to-lossless': bool,
+}
+
+class ConfigError(ValueError):
+    pass
+
+def validate_config(changes: Dict[str, Any], current: Mapping[str, Any] = MappingProxyType({})) -> Dict[str, Any]:
+    """Check keys and types of a settings update, coercing form strings where unambiguous.
+
+    Keys outside CONFIG_SCHEMA are rejected unless `current` (the config as it
+    is) already has them, so settings a newer downloader reads, or that were
+    added by hand, survive a save from the UI.
+    """
+    clean, errors = {}, []
+    for key, value in changes.items():
+        kind = CONFIG_SCHEMA.get(key)
+        if kind is None:
+            if key in current: clean[key] = value
+            else: errors.append(f"unknown key '{key}'")
+        elif kind is bool:
+            if isinstance(value, str) and value.lower() in ('true', 'false'): value = value.lower() == 'true'
+            if isinstance(value, bool): clean[key] = value
+            else: errors.append(f"'{key}' must be true or false")
+        elif kind is int:
+            if value == '' or value is None: continue  # left blank in the form: keep the current value
+            if isinstance(value, str) and value.strip().lstrip('-').isdigit(): value = int(value)
+            if isinstance(value, int) and not isinstance(value, bool): clean[key] = value
+            else: errors.append(f"'{key}' must be an integer")
+        else:
+            if isinstance(value, (int, float)) and not isinstance(value, bool): value = str(value)
+            if isinstance(value, str): clean[key] = value
+            else: errors.append(f"'{key}' must be a string")
+    if errors: raise ConfigError("; ".join(errors))
+    return clean
+
+class ConfigService:
+    """config.yaml parsed once and re-read only when the file changes.
+
+    Readers get an immutable snapshot; a stat() per read detects edits made
+    outside the app (mtime, size and inode). Writes are serialized through one
+    lock, applied to the round-trip document so comments and quoting survive,
+    and land via temp file + rename so the downloader never sees a partial file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._doc = None
+        self._snapshot: MappingProxyType = MappingProxyType({})
+        self._stamp: Optional[Tuple[int, int, int]] = None
+        self._lock = threading.Lock()
+        self._prepared = False
+
+    def _file_stamp(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _prepare(self):
+        # Done once instead of on every read
+        self._prepared = True
+        try:
+            if os.path.exists(os.path.dirname(self.path)):
+                os.chmod(os.path.dirname(self.path), 0o777)
+        except:
+            pass
+        if not os.path.exists(self.path):
+            try:
+                with open(self.path, 'w') as f:
+                    f.write(DEFAULT_CONFIG)
+            except Exception as e:
+                logger.error(f"Failed to create default config: {e}")
+
+    def _reload(self, stamp: Optional[Tuple[int, int, int]]):
+        try:
+            with open(self.path, 'r') as f:
+                doc = yaml.load(f) or {}
+        except Exception as e:
+            # Keep serving the last good snapshot until the file is fixed
+            logger.error(f"Failed to load config: {e}")
+            self._stamp = stamp
+            return
+        self._doc = doc
+        self._snapshot = MappingProxyType(dict(doc))
+        self._stamp = stamp
+
+    def snapshot(self) -> MappingProxyType:
+        if not self._prepared:
+            with self._lock:
+                if not self._prepared: self._prepare()
+        stamp = self._file_stamp()
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp: self._reload(stamp)
+        return self._snapshot
+
+    def update(self, changes: Dict[str, Any]) -> MappingProxyType:
+        clean = validate_config(changes, self.snapshot())
+        with self._lock:
+            stamp = self._file_stamp()
+            if stamp != self._stamp: self._reload(stamp)
+            doc = self._doc if self._doc is not None else {}
+            doc.update(clean)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                yaml.dump(doc, f)
+            os.replace(tmp_path, self.path)
+            self._doc = doc
+            self._snapshot = MappingProxyType(dict(doc))
+            self._stamp = self._file_stamp()
+        return self._snapshot
+
+CONFIG = ConfigService(CONFIG_PATH)
+
+def load_config() -> MappingProxyType:
+    return CONFIG.snapshot()
+
+# --- CATALOG HTTP ---
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(20.0, connect=5.0),
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+        headers={"Origin": "https://music.apple.com", "Referer": "https://music.apple.com/"},
+        follow_redirects=True,
+    )
+
+async def http_get(url: str, lane: Optional[str] = None, **kwargs) -> httpx.Response:
+    """GET through the shared client with a per-host connection cap and retry.
+
+    Transport errors, 429 and 5xx responses are retried with exponential
+    backoff (honouring Retry-After); anything else is returned to the caller.
+    With a `lane` the request is an amp-api call: every attempt takes a token
+    from CATALOG_LIMITER in that lane and reports its outcome to the breaker.
+    """
+    host = urlsplit(url).netloc
+    slots = HTTP_HOST_SLOTS.setdefault(host, asyncio.Semaphore(HTTP_MAX_PER_HOST))
+    for attempt in range(HTTP_RETRIES + 1):
+        delay = HTTP_BACKOFF_BASE * (2 ** attempt) * (0.5 + random.random())
+        try:
+            if lane: await CATALOG_LIMITER.acquire(lane)
+            async with slots:
+                response = await HTTP_CLIENT.get(url, **kwargs)
+            retry_after = response.headers.get("Retry-After", "")
+            retry_after = float(retry_after) if retry_after.isdigit() else None
+            if lane: CATALOG_LIMITER.record(response.status_code, retry_after)
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            if retry_after: delay = max(delay, retry_after)
+            if attempt == HTTP_RETRIES: return response
+            logger.warning(f"GET {url} returned {response.status_code}, retrying in {delay:.1f}s")
+        except httpx.TransportError as e:
+            if lane: CATALOG_LIMITER.record(None)
+            if attempt == HTTP_RETRIES: raise
+            logger.warning(f"GET {url} failed ({e!r}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+def jwt_expiry(token: str) -> Optional[float]:
     try:
-        with open(CONFIG_PATH, 'w') as f:
-            yaml.dump(config, f)
-    except Exception as e:
-        logger.error(f"Failed to save config: {e}")
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return None
+
+class DevTokenManager:
+    """Developer tokens per storefront, refreshed in the background before they expire.
+
+    Tokens are persisted to DEV_TOKEN_PATH so a restart doesn't have to scrape
+    music.apple.com before the first search. Concurrent callers that need a
+    fresh token all wait on the same in-flight refresh. A scheduled refresh
+    that brings back the token we already had backs off exponentially, since
+    the site keeps serving it until Apple rotates it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tokens: Dict[str, Tuple[str, float]] = {}  # storefront -> (token, expires_at)
+        self.refresh_count = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._backoff: Dict[str, float] = {}  # storefront -> delay after a refresh that returned the same exp
+
+    def start(self, default_storefront: str):
+        try:
+            with open(self.path) as f:
+                self.tokens = {sf: (entry['token'], entry['expires']) for sf, entry in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable developer token cache: {e}")
+        now = time.time()
+        self.tokens = {sf: entry for sf, entry in self.tokens.items() if entry[1] > now}
+        for storefront, (_, expires) in self.tokens.items():
+            self._schedule(storefront, expires)
+        if default_storefront not in self.tokens:
+            asyncio.create_task(self.refresh(default_storefront))
+
+    def stop(self):
+        for timer in self._timers.values(): timer.cancel()
+        self._timers.clear()
+        for task in self._inflight.values(): task.cancel()
+
+    async def get(self, storefront: str) -> Optional[str]:
+        entry = self.tokens.get(storefront)
+        if entry and entry[1] > time.time() + 60:
+            return entry[0]
+        return await self.refresh(storefront)
+
+    def invalidate(self, storefront: str, token: str):
+        """Drop a token the API rejected, unless another caller already replaced it."""
+        entry = self.tokens.get(storefront)
+        if entry and entry[0] == token:
+            del self.tokens[storefront]
+
+    async def refresh(self, storefront: str) -> Optional[str]:
+        task = self._inflight.get(storefront)
+        if task is None:
+            task = asyncio.create_task(self._refresh(storefront))
+            self._inflight[storefront] = task
+            task.add_done_callback(lambda _: self._inflight.pop(storefront, None))
+        return await asyncio.shield(task)
+
+    async def _refresh(self, storefront: str) -> Optional[str]:
+        token = await scrape_dev_token(storefront)
+        if not token: return None
+        expires = jwt_expiry(token) or time.time() + DEV_TOKEN_DEFAULT_TTL
+        previous = self.tokens.get(storefront)
+        if previous and previous[1] == expires:
+            self._backoff[storefront] = min(DEV_TOKEN_REFRESH_MARGIN, 2 * self._backoff.get(storefront, DEV_TOKEN_MIN_REFRESH_DELAY))
+        else:
+            self._backoff.pop(storefront, None)
+        self.tokens[storefront] = (token, expires)
+        self.refresh_count += 1
+        self._schedule(storefront, expires)
+        self._save()
+        logger.info(f"Developer token for {storefront} valid until {time.ctime(expires)}")
+        return token
+
+    def _schedule(self, storefront: str, expires: float):
+        if storefront in self._timers: self._timers[storefront].cancel()
+        # Inside the margin the due time is already past; wait at least the floor instead of refreshing in a loop
+        floor = self._backoff.get(storefront, DEV_TOKEN_MIN_REFRESH_DELAY)
+        delay = max(floor, expires - DEV_TOKEN_REFRESH_MARGIN - time.time())
+        loop = asyncio.get_running_loop()
+        self._timers[storefront] = loop.call_later(delay, lambda: asyncio.create_task(self.refresh(storefront)))
+
+    def _save(self):
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({sf: {"token": t, "expires": e} for sf, (t, e) in self.tokens.items()}, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"Failed to persist developer tokens: {e}")
+
+DEV_TOKENS = DevTokenManager(DEV_TOKEN_PATH)
 
-def get_apple_music_dev_token(storefront: str) -> Optional[str]:
-    global CACHE_DEV_TOKEN
-    if CACHE_DEV_TOKEN:
-        return CACHE_DEV_TOKEN
+async def scrape_dev_token(storefront: str) -> Optional[str]:
     try:
-        logging.info(f"Fetching new developer token for storefront: {storefront}...")
-        homepage_res = requests.get(f'https://music.apple.com/{storefront}/browse', timeout=20)
+        logger.info(f"Fetching new developer token for storefront: {storefront}...")
+        homepage_res = await http_get(f'{MUSIC_WEB_BASE}/{storefront}/browse')
         homepage_res.raise_for_status()
         match = re.search(r'/assets/index-legacy[~-][^/"]+\.js', homepage_res.text)
         if not match: return None
-        js_url = f"https://music.apple.com{match.group(0)}"
-        js_res = requests.get(js_url, timeout=20)
+        js_url = f"{MUSIC_WEB_BASE}{match.group(0)}"
+        js_res = await http_get(js_url)
         js_res.raise_for_status()
         token_match = re.search(r'eyJh[a-zA-Z0-9\._-]+', js_res.text)
         if not token_match: return None
-        CACHE_DEV_TOKEN = token_match.group(0)
-        return CACHE_DEV_TOKEN
+        return token_match.group(0)
     except Exception as e:
-        logging.error(f"Failed to get developer token: {e}")
+        logger.error(f"Failed to get developer token: {e}")
         return None
 
+async def get_apple_music_dev_token(storefront: str) -> Optional[str]:
+    return await DEV_TOKENS.get(storefront)
+
+# --- CATALOG RATE LIMIT ---
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Apple Music API is throttling us, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class CatalogLimiter:
+    """Token bucket shared by every amp-api call, with priority lanes and a circuit breaker.
+
+    Waiters are served by lane (interactive, then bulk, then background) and
+    FIFO within a lane. Lower lanes also leave RESERVE tokens untouched, so a
+    search arriving behind a bulk enqueue goes out at once instead of queueing
+    behind it.
+
+    A 429 halves the rate, which creeps back up with each success. A response
+    carrying Retry-After opens the breaker for that long; CATALOG_BREAKER_THRESHOLD
+    failures in a row open it for the cooldown. While it is open, interactive calls fail fast with
+    CircuitOpenError and the other lanes wait. After the cooldown one probe
+    goes through (half-open): success closes the breaker, failure reopens it
+    with a doubled cooldown.
+    """
+    LANES = ("interactive", "bulk", "background")
+    RESERVE = {"interactive": 0, "bulk": 2, "background": 5}
+    PROBE_TIMEOUT = 30.0
+
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.waiters: List[Tuple[int, int, float, asyncio.Future]] = []  # heap of (lane rank, seq, cost, future)
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.state = "closed"
+        self.failures = 0
+        self.cooldown = CATALOG_BREAKER_COOLDOWN
+        self.open_until = 0.0
+        self.probe_started: Optional[float] = None
+        self._changed = asyncio.Event()
+        self.granted: Dict[str, int] = defaultdict(int)
+        self.stats = {"throttled": 0, "errors": 0, "opened": 0, "rejected": 0}
+
+    async def acquire(self, lane: str = "bulk", cost: float = 1.0):
+        """Wait for `cost` tokens in `lane`; raises CircuitOpenError for interactive calls while open."""
+        while True:
+            now = time.monotonic()
+            if self.state == "open" and now >= self.open_until: self._set_state("half_open")
+            if self.state == "closed": break
+            if self.state == "half_open" and (self.probe_started is None or now - self.probe_started > self.PROBE_TIMEOUT):
+                self.probe_started = now  # this call is the probe
+                break
+            if lane == "interactive":
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(max(1.0, self.open_until - now))
+            self._changed.clear()
+            try: await asyncio.wait_for(self._changed.wait(), max(0.05, self.open_until - now))
+            except asyncio.TimeoutError: pass
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (self.LANES.index(lane), next(self._seq), cost, fut))
+        self._drain()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled(): self.refund(cost)  # granted, but the caller went away
+            raise
+
+    def refund(self, cost: float = 1.0):
+        """Give back tokens granted to a caller that ended up not making its calls."""
+        self._refill()
+        self.tokens = min(self.burst, self.tokens + cost)
+        self._drain()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _drain(self):
+        self._refill()
+        while self.waiters:
+            rank, _, cost, fut = self.waiters[0]
+            if fut.done():
+                heapq.heappop(self.waiters)
+                continue
+            if self.tokens - cost < self.RESERVE[self.LANES[rank]]: break
+            heapq.heappop(self.waiters)
+            self.tokens -= cost
+            self.granted[self.LANES[rank]] += 1
+            fut.set_result(None)
+        if self._timer: self._timer.cancel()
+        self._timer = None
+        if self.waiters:
+            rank, _, cost, _ = self.waiters[0]
+            need = cost + self.RESERVE[self.LANES[rank]] - self.tokens
+            self._timer = asyncio.get_running_loop().call_later(max(0.001, need / self.rate), self._drain)
+
+    def record(self, status: Optional[int], retry_after: Optional[float] = None):
+        """Feed one response status (None for a transport error) to the rate and the breaker."""
+        self.probe_started = None
+        if status is not None and status != 429 and status < 500:
+            self.failures = 0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            if self.state != "closed":
+                logger.info("Apple Music API recovered, closing the circuit breaker")
+                self.cooldown = CATALOG_BREAKER_COOLDOWN
+                self._set_state("closed")
+            return
+        self.failures += 1
+        if status == 429:
+            self.stats["throttled"] += 1
+            self.rate = max(CATALOG_MIN_RATE, self.rate / 2)
+        else:
+            self.stats["errors"] += 1
+        if self.state == "half_open" or retry_after or self.failures >= CATALOG_BREAKER_THRESHOLD: self.trip(retry_after)
+
+    def trip(self, retry_after: Optional[float] = None):
+        if self.state == "half_open": self.cooldown = min(CATALOG_BREAKER_MAX_COOLDOWN, self.cooldown * 2)
+        self.open_until = max(self.open_until, time.monotonic() + (retry_after or self.cooldown))
+        if self.state != "open":
+            self.stats["opened"] += 1
+            logger.warning(f"Apple Music API throttling, pausing catalog calls for {self.open_until - time.monotonic():.0f}s")
+        self._set_state("open")
+
+    def _set_state(self, state: str):
+        self.state = state
+        self._changed.set()
+
+    def status(self) -> Dict:
+        self._refill()
+        waiting = defaultdict(int)
+        for rank, _, _, fut in self.waiters:
+            if not fut.done(): waiting[self.LANES[rank]] += 1
+        return {
+            "state": self.state, "rate": round(self.rate, 2), "max_rate": self.max_rate, "tokens": round(self.tokens, 2),
+            "retry_in": round(max(0.0, self.open_until - time.monotonic()), 1) if self.state == "open" else 0,
+            "cooldown": self.cooldown, "consecutive_failures": self.failures,
+            "waiting": dict(waiting), "granted": dict(self.granted), **self.stats,
+        }
+
+CATALOG_LIMITER = CatalogLimiter(CATALOG_RATE, CATALOG_BURST)
+
+async def catalog_get(storefront: str, path: str, params: Optional[Dict] = None, endpoint: str = "other",
+                      headers: Optional[Dict] = None) -> Optional[httpx.Response]:
+    """GET /v1/catalog/{storefront}/{path}, refreshing the developer token once on 401/403.
+
+    Paced by CATALOG_LIMITER in the endpoint's lane (see CATALOG_LANES);
+    raises CircuitOpenError for interactive calls while the breaker is open.
+    """
+    lane = CATALOG_LANES.get(endpoint, "bulk")
+    with CATALOG_SECONDS.time(endpoint=endpoint):
+        try:
+            token = await get_apple_music_dev_token(storefront)
+            if not token:
+                CATALOG_ERRORS.inc(endpoint=endpoint)
+                return None
+            api_url = f"{AMP_API_BASE}/v1/catalog/{storefront}/{path}"
+            response = await http_get(api_url, lane, params=params, headers={"Authorization": f"Bearer {token}", **(headers or {})})
+            if response.status_code in [401, 403]:
+                DEV_TOKENS.invalidate(storefront, token)
+                token = await get_apple_music_dev_token(storefront)
+                if token:
+                    response = await http_get(api_url, lane, params=params, headers={"Authorization": f"Bearer {token}", **(headers or {})})
+        except Exception:
+            CATALOG_ERRORS.inc(endpoint=endpoint)
+            raise
+    if response.status_code >= 400: CATALOG_ERRORS.inc(endpoint=endpoint)
+    return response
+
+# --- CATALOG CACHE ---
+
+CacheKey = Tuple[str, str, str]  # (storefront, type, id or search term)
+
+class CatalogCache:
+    """Bounded TTL + LRU cache for catalog lookups, with an optional SQLite tier.
+
+    Concurrent get_or_fetch() calls for the same key share one in-flight fetch.
+    Values must be JSON-serialisable and are treated as read-only by callers.
+    """
+
+    def __init__(self, max_entries: int, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries: "OrderedDict[CacheKey, Tuple[float, Any]]" = OrderedDict()
+        self.inflight: Dict[CacheKey, List] = {}  # key -> [fetch task, waiters]
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+        self.db: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        if not self.path: return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL NOT NULL, value TEXT NOT NULL)")
+        self.db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    async def get_or_fetch(self, key: CacheKey, ttl: float, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry and entry[0] > now:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+        entry = self._disk_get(key, now)
+        if entry is not None:
+            self.stats["disk_hits"] += 1
+            self._put_memory(key, *entry)
+            return entry[1]
+        entry = self.inflight.get(key)
+        if entry is None:
+            # The fetch runs as its own task so one caller being cancelled doesn't fail the others.
+            self.stats["misses"] += 1
+            entry = self.inflight[key] = [asyncio.create_task(self._fetch(key, ttl, fetch)), 0]
+            entry[0].add_done_callback(lambda _: self.inflight.pop(key, None) if self.inflight.get(key) is entry else None)
+        else:
+            self.stats["coalesced"] += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not task.done(): task.cancel()
+
+    async def _fetch(self, key: CacheKey, ttl: float, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = await fetch()
+        if value is not None: self.put(key, value, ttl)
+        return value
+
+    def put(self, key: CacheKey, value: Any, ttl: float):
+        expires = time.time() + ttl
+        self._put_memory(key, expires, value)
+        if self.db:
+            try:
+                self.db.execute("INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)",
+                                ("|".join(key), expires, json.dumps(value)))
+            except sqlite3.Error as e:
+                logger.warning(f"Catalog cache write failed: {e}")
+
+    def clear(self):
+        self.entries.clear()
+        if self.db: self.db.execute("DELETE FROM cache")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "entries": len(self.entries), "max_entries": self.max_entries, "disk": self.db is not None}
+
+    def _put_memory(self, key: CacheKey, expires: float, value: Any):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def peek(self, key: CacheKey, disk: bool = True) -> Any:
+        """Return a fresh cached value without fetching, counting it as a hit."""
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry and entry[0] > now:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+        entry = self._disk_get(key, now) if disk else None
+        if entry is not None:
+            self.stats["disk_hits"] += 1
+            self._put_memory(key, *entry)
+            return entry[1]
+        return None
+
+    def _disk_get(self, key: CacheKey, now: float) -> Optional[Tuple[float, Any]]:
+        if not self.db: return None
+        row = self.db.execute("SELECT expires, value FROM cache WHERE key = ?", ("|".join(key),)).fetchone()
+        if not row or row[0] <= now: return None
+        return row[0], json.loads(row[1])
+
+CATALOG_CACHE = CatalogCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_PATH)
+
 def parse_api_item(item: dict, size: int = 600) -> Optional[dict]:
     if not item or not item.get('attributes'): return None
     attrs = item['attributes']
@@ -234,194 +1704,847 @@ def parse_api_item(item: dict, size: int = 600) -> Optional[dict]:
         'hasLyrics': attrs.get('hasLyrics', False)
     }
 
-def api_search(query: str, storefront: str = "us") -> Dict[str, List[Dict]]:
-    token = get_apple_music_dev_token(storefront)
-    if not token: return {}
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Origin": "https://music.apple.com",
-        "Referer": "https://music.apple.com/"
-    }
-    types = "songs,albums,artists,music-videos,playlists"
-    params = {"term": query, "types": types, "limit": 10}
-    api_url = f"https://amp-api.music.apple.com/v1/catalog/{storefront}/search"
-    try:
-        response = requests.get(api_url, headers=headers, params=params, timeout=20)
-        if response.status_code in [401, 403]:
-            global CACHE_DEV_TOKEN
-            CACHE_DEV_TOKEN = None
-            token = get_apple_music_dev_token(storefront)
-            if token:
-                headers["Authorization"] = f"Bearer {token}"
-                response = requests.get(api_url, headers=headers, params=params, timeout=20)
-        response.raise_for_status()
-        data = response.json()
-        grouped_results = {"top": [], "songs": [], "albums": [], "artists": [], "playlists": [], "music_videos": []}
-        if 'results' in data:
-            for cat_key, dict_key in [('songs', 'songs'), ('albums', 'albums'), ('artists', 'artists'), ('music-videos', 'music_videos'), ('playlists', 'playlists')]:
-                items = data['results'].get(cat_key, {}).get('data', [])
-                parsed_items = [p for item in items if (p := parse_api_item(item))]
-                grouped_results[dict_key] = parsed_items
-                if parsed_items: grouped_results["top"].append(parsed_items[0])
-        return grouped_results
-    except Exception as e:
-        logger.error(f"Search failed: {e}")
-        return {}
+SEARCH_TYPES = {"songs": "songs", "albums": "albums", "artists": "artists", "music-videos": "music_videos", "playlists": "playlists"}
 
-# --- ROUTES ---
+def search_term(query: str) -> str:
+    return " ".join(query.lower().split())
 
-@app.get("/", response_class=HTMLResponse)
-async def read_root():
-    response = FileResponse("index.html")
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Pragma"] = "no-cache"
-    response.headers["Expires"] = "0"
-    return response
+def search_key(storefront: str, api_type: str, term: str) -> CacheKey:
+    return (storefront, f"search:{api_type}", term)
 
-@app.get("/api/search")
-async def search(query: str):
-    config = load_config()
-    storefront = config.get('storefront', 'us')
-    loop = asyncio.get_event_loop()
-    results = await loop.run_in_executor(None, api_search, query, storefront)
-    return results
+def search_types(types: Optional[Any]) -> List[str]:
+    """amp-api type names from a comma list or sequence of API or result names; all types when empty."""
+    if isinstance(types, str): types = types.split(",")
+    if not isinstance(types, (list, tuple)): types = ()
+    by_name = {**{v: k for k, v in SEARCH_TYPES.items()}, **{k: k for k in SEARCH_TYPES}}
+    picked = {by_name[t.strip()] for t in types if isinstance(t, str) and t.strip() in by_name}
+    return [t for t in SEARCH_TYPES if t in picked] or list(SEARCH_TYPES)
 
-@app.get("/api/artist")
-async def resolve_artist(url: str):
-    match = re.search(r'music\.apple\.com/([a-z]{2})/artist/[^/]+/(\d+)', url)
-    if not match: raise HTTPException(status_code=400, detail="Invalid URL")
-    storefront, artist_id = match.groups()
-    token = get_apple_music_dev_token(storefront)
-    headers = {"Authorization": f"Bearer {token}", "Origin": "https://music.apple.com"}
-    categorized = {"albums": [], "eps": [], "singles": [], "music_videos": [], "compilations": []}
+def search_matches(item: Dict, words: List[str]) -> bool:
+    text = re.findall(r'\w+', " ".join(filter(None, (item.get('name'), item.get('artist'), item.get('album')))).lower())
+    return all(any(w.startswith(word) for w in text) for word in words)
+
+async def fetch_search(query: str, storefront: str, types: List[str]) -> Dict[str, List[Dict]]:
+    """One amp-api search for `types`; each type's results are cached on their own."""
+    params = {"term": query, "types": ",".join(types), "limit": SEARCH_LIMIT}
+    response = await catalog_get(storefront, "search", params, endpoint="search")
+    if response is None: raise RuntimeError("Developer token unavailable")
+    response.raise_for_status()
+    results = response.json().get('results', {})
+    term = search_term(query)
+    grouped = {}
+    for api_type in types:
+        grouped[api_type] = [p for item in results.get(api_type, {}).get('data', []) if (p := parse_api_item(item))]
+        CATALOG_CACHE.put(search_key(storefront, api_type, term), grouped[api_type], CATALOG_CACHE_TTL["search"])
+    return grouped
+
+class SearchService:
+    """Catalog search with per-type caching, prefix reuse and cancellable typeahead sessions.
+
+    Results are cached per (storefront, type, term), so a caller asking for
+    fewer types reuses what a fuller search fetched. Only the missing types go
+    to amp-api, together in one request. Identical concurrent fetches share
+    that request; it is cancelled (freeing its limiter slot) once nobody is
+    waiting for it any more.
+
+    A typeahead session (/ws/search) runs one query at a time per client: a new
+    keystroke cancels the previous one. Each result group is sent as soon as it
+    is known, in this order: exact cache hits, then provisional results
+    filtered from the cached results of a shorter prefix, then the fetched
+    results.
+    """
+
+    def __init__(self):
+        self.inflight: Dict[Tuple, List] = {}  # (storefront, term, types) -> [task, waiters]
+        self.sessions = 0
+
+    async def search(self, query: str, storefront: str, types: Optional[List[str]] = None) -> Dict[str, List[Dict]]:
+        types = types or list(SEARCH_TYPES)
+        term = search_term(query)
+        found = {t: v for t in types if (v := CATALOG_CACHE.peek(search_key(storefront, t, term))) is not None}
+        missing = [t for t in types if t not in found]
+        if missing:
+            try:
+                found.update(await self.fetch(query, storefront, missing))
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                logger.error(f"Search failed: {e}")
+                return {}
+        return {"top": [found[t][0] for t in types if found[t]], **{SEARCH_TYPES[t]: found[t] for t in types}}
+
+    async def fetch(self, query: str, storefront: str, types: List[str]) -> Dict[str, List[Dict]]:
+        key = (storefront, search_term(query), tuple(types))
+        entry = self.inflight.get(key)
+        if entry is None:
+            entry = self.inflight[key] = [asyncio.create_task(fetch_search(query, storefront, types)), 0]
+            entry[0].add_done_callback(lambda _: self.inflight.pop(key, None) if self.inflight.get(key) is entry else None)
+            SEARCH_EVENTS.inc(event="fetch")
+        else:
+            SEARCH_EVENTS.inc(event="coalesced")
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not task.done():
+                task.cancel()
+                SEARCH_EVENTS.inc(event="cancelled")
+
+    def from_prefix(self, storefront: str, api_type: str, term: str) -> Optional[List[Dict]]:
+        """Results of the longest cached shorter prefix of `term`, narrowed to items still matching it."""
+        words = re.findall(r'\w+', term)
+        for end in range(len(term) - 1, TYPEAHEAD_MIN_PREFIX - 1, -1):
+            items = CATALOG_CACHE.peek(search_key(storefront, api_type, term[:end].strip()), disk=False)
+            if items is not None: return [item for item in items if search_matches(item, words)]
+        return None
+
+    async def serve(self, websocket: WebSocket):
+        """Run a typeahead session: each {"id", "query", "types"} message replaces the one in flight."""
+        await websocket.accept()
+        self.sessions += 1
+        current: Optional[asyncio.Task] = None
+        try:
+            while True:
+                try:
+                    message = json.loads(await websocket.receive_text())
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(message, dict): continue
+                if current and not current.done():
+                    current.cancel()
+                    await asyncio.gather(current, return_exceptions=True)
+                query = str(message.get('query') or '').strip()
+                if query: current = asyncio.create_task(self._typeahead(websocket, message.get('id'), query, search_types(message.get('types'))))
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            self.sessions -= 1
+            if current:
+                current.cancel()
+                await asyncio.gather(current, return_exceptions=True)
+
+    async def _typeahead(self, websocket: WebSocket, request_id: Any, query: str, types: List[str]):
+        storefront = load_config().get('storefront', 'us')
+        term = search_term(query)
+        async def send(**payload): await websocket.send_json({"id": request_id, **payload})
+        try:
+            missing = []
+            for api_type in types:
+                items = CATALOG_CACHE.peek(search_key(storefront, api_type, term))
+                if items is None: missing.append(api_type)
+                else:
+                    SEARCH_EVENTS.inc(event="cache_hit")
+                    await send(type=SEARCH_TYPES[api_type], items=items, final=True)
+            for api_type in missing:
+                items = self.from_prefix(storefront, api_type, term)
+                if items is None: continue
+                SEARCH_EVENTS.inc(event="prefix_hit")
+                await send(type=SEARCH_TYPES[api_type], items=items, final=False)
+            if missing:
+                results = await self.fetch(query, storefront, missing)
+                for api_type in missing: await send(type=SEARCH_TYPES[api_type], items=results[api_type], final=True)
+            await send(done=True)
+        except CircuitOpenError as e:
+            await send(error=str(e), retry_after=e.retry_after)
+        except (asyncio.CancelledError, WebSocketDisconnect):
+            raise
+        except Exception as e:
+            logger.error(f"Typeahead search failed: {e}")
+            await send(error="Search failed")
+
+SEARCH = SearchService()
+SEARCH_EVENTS = METRICS.register(Counter("amd_search_events_total", "Search work by event: cache_hit, prefix_hit, fetch, coalesced, cancelled.", "event"))
+METRICS.register(Gauge("amd_search_sessions", "Open typeahead search sockets.", collect=lambda: SEARCH.sessions))
+
+async def api_search(query: str, storefront: str = "us", types: Optional[List[str]] = None) -> Dict[str, List[Dict]]:
+    return await SEARCH.search(query, storefront, types)
+
+async def fetch_catalog_items(storefront: str, type_str: str, ids: List[str]) -> Dict[str, Dict]:
+    """Raw catalog resources fetched with one ?ids= call (albums include their tracks)."""
+    params = {"ids": ",".join(ids)}
+    if type_str == "albums": params["include"] = "tracks"
+    resp = await catalog_get(storefront, type_str, params, endpoint="enrich")
+    if resp is None: raise RuntimeError("Developer token unavailable")
+    resp.raise_for_status()
+    return {item.get('id'): item for item in resp.json().get('data', [])}
+
+# --- ARTWORK ---
+
+MZSTATIC_SIZE = re.compile(r'/\d+x\d+[a-z]*(?:-\d+)?\.(?:jpe?g|png|webp)$')
+
+def artwork_source(url: str, size: int) -> Optional[str]:
+    """Canonical mzstatic URL for `url` rendered as a `size` px square JPEG, or None if it isn't Apple artwork."""
+    url = url.replace('{w}', str(size)).replace('{h}', str(size)).replace('{c}', 'bb').replace('{f}', 'jpg')
+    parts = urlsplit(url)
+    if parts.scheme != 'https' or not (parts.hostname or '').endswith(ARTWORK_HOST_SUFFIX): return None
+    path, found = MZSTATIC_SIZE.subn(f'/{size}x{size}bb.jpg', parts.path)
+    return f"https://{parts.netloc}{path}" if found else None
+
+def artwork_size(size: int) -> int:
+    return next((s for s in ARTWORK_SIZES if s >= size), ARTWORK_SIZES[-1])
+
+class ArtworkCache:
+    """Resized cover art on disk, capped at `max_bytes` with least-recently-used eviction.
+
+    Files are named after the sha256 of their canonical mzstatic URL. Apple
+    never changes the image behind an artwork URL (its path carries the asset
+    hash), so the name addresses the content: it doubles as a strong ETag and
+    lets browsers cache the response as immutable. A miss streams the upstream
+    body to the first caller while writing it to disk; concurrent misses for
+    the same image wait for that download instead of starting their own.
+    Recency survives restarts through the files' mtimes.
+    """
+
+    def __init__(self, path: Optional[str], max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, int]" = OrderedDict()  # key -> bytes, oldest first
+        self.bytes = 0
+        self.inflight: Dict[str, asyncio.Event] = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "not_modified": 0, "evictions": 0, "errors": 0}
+
+    def open(self):
+        if not self.path: return
+        os.makedirs(self.path, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.part'): os.remove(entry.path)
+            elif entry.name.endswith('.jpg'):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name[:-4], st.st_size))
+        for _, key, size in sorted(found): self._add(key, size)
+
+    def file(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.jpg")
+
+    def lookup(self, key: str) -> Optional[str]:
+        if key not in self.entries: return None
+        self.entries.move_to_end(key)
+        path = self.file(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.bytes -= self.entries.pop(key)
+            return None
+        self.stats["hits"] += 1
+        return path
+
+    def _add(self, key: str, size: int):
+        self.bytes += size - self.entries.pop(key, 0)
+        self.entries[key] = size
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            old, old_size = self.entries.popitem(last=False)
+            self.bytes -= old_size
+            self.stats["evictions"] += 1
+            try: os.remove(self.file(old))
+            except FileNotFoundError: pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes, "disk": self.path is not None}
+
+    async def wait(self, key: str, timeout: float = 30.0):
+        """Wait for another request's download of `key` to finish (successfully or not)."""
+        event = self.inflight.get(key)
+        if not event: return
+        self.stats["coalesced"] += 1
+        try: await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError: pass
+
+    async def fetch(self, key: str, url: str) -> Optional["ArtworkDownload"]:
+        """Start downloading a missing image; returns its body as a stream that also fills the cache.
+
+        None means upstream had no usable image. Waiters on `key` are released either way.
+        """
+        self.stats["misses"] += 1
+        self.inflight[key] = asyncio.Event()
+        slots = HTTP_HOST_SLOTS.setdefault(urlsplit(url).netloc, asyncio.Semaphore(HTTP_MAX_PER_HOST))
+        try:
+            await slots.acquire()
+        except BaseException:
+            self.inflight.pop(key).set()
+            raise
+        response = None
+        try:
+            response = await HTTP_CLIENT.send(HTTP_CLIENT.build_request("GET", url), stream=True)
+        except Exception as e:
+            logger.warning(f"Artwork fetch {url} failed: {e!r}")
+        except BaseException:
+            slots.release()
+            self.inflight.pop(key).set()
+            raise
+        if response is None or response.status_code != 200 or not response.headers.get('content-type', '').startswith('image/'):
+            slots.release()
+            self.stats["errors"] += 1
+            self.inflight.pop(key).set()
+            if response is not None: await response.aclose()
+            return None
+        return ArtworkDownload(self, key, response, slots)
+
+class ArtworkDownload:
+    """One upstream artwork body on its way to a client and the cache.
+
+    close() releases the host slot, the upstream response and the waiters
+    whether or not the body was read to the end, or at all; ArtworkResponse
+    calls it once the response is done, including when the client is gone.
+    """
+
+    def __init__(self, cache: ArtworkCache, key: str, response: httpx.Response, slots: asyncio.Semaphore):
+        self.cache, self.key, self.response, self.slots = cache, key, response, slots
+        self.tmp = os.path.join(cache.path, f"{key}.part") if cache.path else None
+        self.out = None
+        self.size = 0
+        self.complete = False
+        self.closed = False
+
+    async def body(self) -> AsyncIterator[bytes]:
+        if self.tmp: self.out = open(self.tmp, 'wb')
+        async for chunk in self.response.aiter_bytes():
+            if self.out: self.out.write(chunk)
+            self.size += len(chunk)
+            yield chunk
+        self.complete = True
+
+    async def close(self):
+        if self.closed: return
+        self.closed = True
+        # Everything the waiters depend on is released before the first await
+        self.slots.release()
+        try:
+            if self.out:
+                self.out.close()
+                if self.complete:
+                    os.replace(self.tmp, self.cache.file(self.key))
+                    self.cache._add(self.key, self.size)
+                else:
+                    os.remove(self.tmp)
+        finally:
+            self.cache.inflight.pop(self.key).set()
+            await self.response.aclose()
+
+class ArtworkResponse(StreamingResponse):
+    def __init__(self, download: ArtworkDownload, **kwargs):
+        super().__init__(download.body(), **kwargs)
+        self.download = download
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.download.close()
+
+ARTWORK = ArtworkCache(ARTWORK_CACHE_PATH, ARTWORK_CACHE_MAX_BYTES)
+ARTWORK_REQUESTS = METRICS.register(Counter("amd_artwork_requests_total", "Artwork proxy requests, by result: hit, miss, coalesced, not_modified, error.", "result"))
+METRICS.register(Gauge("amd_artwork_cache_bytes", "Bytes of resized artwork on disk.", collect=lambda: ARTWORK.bytes))
+
+# --- ROUTES ---
+
+@app.get("/", response_class=HTMLResponse)
+async def read_root():
+    response = FileResponse("index.html")
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Pragma"] = "no-cache"
+    response.headers["Expires"] = "0"
+    return response
+
+@app.get("/api/search")
+async def search(query: str, types: Optional[str] = None):
+    config = load_config()
+    storefront = config.get('storefront', 'us')
     try:
-        views = "full-albums,singles,compilations,music-videos,featured-albums"
-        api_url = f"https://amp-api.music.apple.com/v1/catalog/{storefront}/artists/{artist_id}?views={views}"
-        response = requests.get(api_url, headers=headers, timeout=20)
-        if response.status_code in [401, 403]:
-             global CACHE_DEV_TOKEN; CACHE_DEV_TOKEN = None
-             token = get_apple_music_dev_token(storefront)
-             headers["Authorization"] = f"Bearer {token}"
-             response = requests.get(api_url, headers=headers, timeout=20)
-        response.raise_for_status()
-        data = response.json()
-        artist_data = data.get('data', [])[0]
-        if not artist_data: return categorized
-        relationships = artist_data.get('views', {})
-        def process_view(view_name, target_list):
-            items = relationships.get(view_name, {}).get('data', [])
-            for item in items:
-                parsed = parse_api_item(item)
-                if parsed: target_list.append(parsed)
-        process_view('full-albums', categorized['albums'])
-        process_view('singles', categorized['singles'])
-        process_view('compilations', categorized['compilations'])
-        process_view('music-videos', categorized['music_videos'])
-        real_singles = []
-        real_eps = []
-        for item in categorized['singles']:
-            if item['name'].lower().endswith(' - ep'): real_eps.append(item)
-            else: real_singles.append(item)
-        categorized['singles'] = real_singles
-        categorized['eps'] = real_eps
-        return categorized
+        return await api_search(query, storefront, search_types(types))
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
+
+@app.get("/api/artwork")
+async def artwork(url: str, request: Request, size: int = 300):
+    size = artwork_size(size)
+    source = artwork_source(url, size)
+    if not source: raise HTTPException(status_code=400, detail="Not an Apple Music artwork URL")
+    key = hashlib.sha256(source.encode()).hexdigest()
+    headers = {"ETag": f'"{key}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        ARTWORK_REQUESTS.inc(result="not_modified")
+        ARTWORK.stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    coalesced = key in ARTWORK.inflight
+    if coalesced: await ARTWORK.wait(key)
+    path = ARTWORK.lookup(key)
+    if path:
+        ARTWORK_REQUESTS.inc(result="coalesced" if coalesced else "hit")
+        return FileResponse(path, media_type="image/jpeg", headers=headers)
+    download = await ARTWORK.fetch(key, source)
+    if download is None:
+        ARTWORK_REQUESTS.inc(result="error")
+        raise HTTPException(status_code=502, detail="Artwork unavailable")
+    ARTWORK_REQUESTS.inc(result="miss")
+    return ArtworkResponse(download, media_type="image/jpeg", headers=headers)
+
+def artist_ref(url: str) -> Tuple[str, str]:
+    """(storefront, artist id) of a music.apple.com artist URL."""
+    match = re.search(r'music\.apple\.com/([a-z]{2})/artist/[^/]+/(\d+)', url)
+    if not match: raise HTTPException(status_code=400, detail="Invalid URL")
+    return match.group(1), match.group(2)
+
+@app.get("/api/artist")
+async def resolve_artist(url: str):
+    storefront, artist_id = artist_ref(url)
+    try:
+        key = (storefront, "artists", artist_id)
+        return await CATALOG_CACHE.get_or_fetch(key, CATALOG_CACHE_TTL["artists"], lambda: fetch_artist(storefront, artist_id))
+    except HTTPException:
+        raise
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def enrich_metadata(task: Dict):
-    try:
-        url = task['url']
-        match = re.search(r'music\.apple\.com/([a-z]{2})/(album|playlist|music-video|station)/([^/]+)/(\d+)', url)
-        if not match: return
-        storefront, type_str, _, id_str = match.groups()
-        song_match = re.search(r'\?i=(\d+)', url)
-        if song_match:
-            id_str = song_match.group(1)
-            type_str = "songs"
-        elif type_str == "album": type_str = "albums"
-        elif type_str == "playlist": type_str = "playlists"
-        elif type_str == "music-video": type_str = "music-videos"
-
-        token = get_apple_music_dev_token(storefront)
-        if not token: return
-        headers = {"Authorization": f"Bearer {token}", "Origin": "https://music.apple.com"}
-        api_url = f"https://amp-api.music.apple.com/v1/catalog/{storefront}/{type_str}/{id_str}"
-        if type_str == "albums": api_url += "?views=tracks"
-
-        loop = asyncio.get_event_loop()
-        resp = await loop.run_in_executor(None, lambda: requests.get(api_url, headers=headers))
-        if resp.status_code == 200:
-            data = resp.json()
-            item = data['data'][0]
+async def fetch_artist(storefront: str, artist_id: str) -> Dict[str, List[Dict]]:
+    categorized = {"albums": [], "eps": [], "singles": [], "music_videos": [], "compilations": []}
+    views = "full-albums,singles,compilations,music-videos,featured-albums"
+    response = await catalog_get(storefront, f"artists/{artist_id}", {"views": views}, endpoint="artist")
+    if response is None: raise HTTPException(status_code=502, detail="Developer token unavailable")
+    response.raise_for_status()
+    data = response.json()
+    artist_data = data.get('data', [])[0]
+    if not artist_data: return categorized
+    relationships = artist_data.get('views', {})
+    def process_view(view_name, target_list):
+        items = relationships.get(view_name, {}).get('data', [])
+        for item in items:
             parsed = parse_api_item(item)
-            if parsed:
-                if not task.get('title') and parsed.get('name'): task['title'] = parsed['name']
-                if not task.get('artist') and parsed.get('artist'): task['artist'] = parsed['artist']
-                if not task.get('album') and parsed.get('album'): task['album'] = parsed['album']
-                if not task.get('image') and parsed.get('image'): task['image'] = parsed['image']
-                if type_str == "albums" and parsed.get('name'):
-                    task['album'] = parsed['name']
-                    task['title'] = parsed['name']
-                    task['sub_tasks'] = []
-                    
-                    tracks_data = []
-                    if 'views' in item and 'tracks' in item['views']:
-                        tracks_data = item['views']['tracks'].get('data', [])
-                    elif 'relationships' in item and 'tracks' in item['relationships']:
-                        tracks_data = item['relationships']['tracks'].get('data', [])
-                        
-                    for t in tracks_data:
-                        t_attrs = t.get('attributes', {})
-                        task['sub_tasks'].append({
-                            'track_number': t_attrs.get('trackNumber'),
-                            'title': t_attrs.get('name'),
-                            'status': 'pending'
-                        })
-                await broadcast_log(f"Metadata resolved: {task.get('artist')} - {task.get('album')} ({len(task['sub_tasks'])} tracks)")
-    except Exception as e:
-        logger.error(f"Metadata enrichment failed: {e}")
+            if parsed: target_list.append(parsed)
+    process_view('full-albums', categorized['albums'])
+    process_view('singles', categorized['singles'])
+    process_view('compilations', categorized['compilations'])
+    process_view('music-videos', categorized['music_videos'])
+    real_singles = []
+    real_eps = []
+    for item in categorized['singles']:
+        if item['name'].lower().endswith(' - ep'): real_eps.append(item)
+        else: real_singles.append(item)
+    categorized['singles'] = real_singles
+    categorized['eps'] = real_eps
+    return categorized
+
+async def fetch_artist_view(storefront: str, artist_id: str, view: str) -> List[Dict]:
+    """All items of one artist view, following `next` links page by page."""
+    items: List[Dict] = []
+    path, params = f"artists/{artist_id}/view/{view}", {"limit": 100}
+    prefix = f"/v1/catalog/{storefront}/"
+    while path:
+        response = await catalog_get(storefront, path, params, endpoint="artist_view")
+        if response is None: raise RuntimeError("Developer token unavailable")
+        response.raise_for_status()
+        data = response.json()
+        items.extend(p for item in data.get('data', []) if (p := parse_api_item(item)))
+        next_url = data.get('next')
+        if not next_url: break
+        parts = urlsplit(next_url)
+        path = parts.path[len(prefix):] if parts.path.startswith(prefix) else None
+        params = dict(parse_qsl(parts.query))
+    return items
+
+def parse_catalog_url(url: str) -> Optional[Tuple[str, str, str]]:
+    """Map a music.apple.com URL to (storefront, catalog type, id)."""
+    match = re.search(r'music\.apple\.com/([a-z]{2})/(album|playlist|music-video|station)/([^/]+)/(\d+)', url)
+    if not match: return None
+    storefront, type_str, _, id_str = match.groups()
+    song_match = re.search(r'\?i=(\d+)', url)
+    if song_match:
+        id_str = song_match.group(1)
+        type_str = "songs"
+    elif type_str == "album": type_str = "albums"
+    elif type_str == "playlist": type_str = "playlists"
+    elif type_str == "music-video": type_str = "music-videos"
+    return storefront, type_str, id_str
+
+async def apply_metadata(task: Dict, item: Dict, type_str: str):
+    parsed = parse_api_item(item)
+    if not parsed: return
+    fields = {}
+    if not task.get('title') and parsed.get('name'): fields['title'] = parsed['name']
+    if not task.get('artist') and parsed.get('artist'): fields['artist'] = parsed['artist']
+    if not task.get('album') and parsed.get('album'): fields['album'] = parsed['album']
+    if not task.get('image') and parsed.get('image'): fields['image'] = parsed['image']
+    if not task.get('track_number') and type_str == "songs" and parsed.get('trackNumber'): fields['track_number'] = parsed['trackNumber']
+    if parsed.get('releaseDate'): fields['release_date'] = parsed['releaseDate']
+    if type_str == "albums" and parsed.get('name'):
+        fields['album'] = parsed['name']
+        fields['title'] = parsed['name']
+        fields['sub_tasks'] = []
+        
+        tracks_data = []
+        if 'views' in item and 'tracks' in item['views']:
+            tracks_data = item['views']['tracks'].get('data', [])
+        elif 'relationships' in item and 'tracks' in item['relationships']:
+            tracks_data = item['relationships']['tracks'].get('data', [])
+            
+        for t in tracks_data:
+            t_attrs = t.get('attributes', {})
+            fields['sub_tasks'].append({
+                'id': t.get('id'),
+                'url': t_attrs.get('url'),
+                'track_number': t_attrs.get('trackNumber'),
+                'disc_number': t_attrs.get('discNumber'),
+                'title': t_attrs.get('name'),
+                'status': 'pending'
+            })
+    JOBS.update(task, **fields)
+    await broadcast_log(f"Metadata resolved: {task.get('artist')} - {task.get('album')} ({len(task['sub_tasks'])} tracks)")
+
+class MetadataEnricher:
+    """Resolves queued tasks' metadata with batched multi-id catalog requests.
+
+    Tasks submitted within ENRICH_WINDOW of each other are grouped by
+    storefront and type; cache hits are applied immediately and the rest are
+    fetched ENRICH_BATCH_LIMIT ids at a time in CATALOG_LIMITER's background lane.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._submitted: Dict[int, float] = {}  # job id -> submit time
+        self._dispatch: set = set()  # job ids to hand to the scheduler once enriched
+
+    def submit(self, task: Dict, dispatch: bool = False):
+        self._submitted[task['id']] = time.monotonic()
+        if dispatch: self._dispatch.add(task['id'])
+        self.queue.put_nowait(task)
+
+    def waiting(self, job_id: int) -> bool:
+        """Whether the job will be dispatched by the enricher once its metadata is resolved."""
+        return job_id in self._dispatch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + ENRICH_WINDOW
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.enrich(batch)
+            except Exception as e:
+                logger.error(f"Metadata enrichment failed: {e}")
+
+    async def enrich(self, tasks: List[Dict]):
+        groups: Dict[Tuple[str, str], Dict[str, List[Dict]]] = defaultdict(lambda: defaultdict(list))
+        for task in tasks:
+            ref = parse_catalog_url(task['url'])
+            if not ref: continue
+            storefront, type_str, id_str = ref
+            item = CATALOG_CACHE.peek(ref)
+            if item: await apply_metadata(task, item, type_str)
+            else: groups[(storefront, type_str)][id_str].append(task)
+        for (storefront, type_str), by_id in groups.items():
+            ids = list(by_id)
+            limit = ENRICH_BATCH_LIMIT.get(type_str, 1)
+            for i in range(0, len(ids), limit):
+                chunk = ids[i:i + limit]
+                try:
+                    items = await fetch_catalog_items(storefront, type_str, chunk)
+                except Exception as e:
+                    logger.error(f"Metadata enrichment failed for {len(chunk)} {type_str}: {e}")
+                    continue
+                for id_str, item in items.items():
+                    CATALOG_CACHE.put((storefront, type_str, id_str), item, CATALOG_CACHE_DEFAULT_TTL)
+                    for task in by_id.get(id_str, []):
+                        await apply_metadata(task, item, type_str)
+        now = time.monotonic()
+        for task in tasks:
+            submitted = self._submitted.pop(task['id'], None)
+            if submitted is not None: JOB_PHASE_SECONDS.observe(now - submitted, phase="enrich")
+        # Jobs wait for their metadata so the library index and track mode can
+        # use it; if enrichment failed they fall back to a whole-URL download.
+        for task in tasks:
+            if task['id'] not in self._dispatch: continue
+            self._dispatch.discard(task['id'])
+            if task['status'] == 'pending': dispatch_job(task)
+
+ENRICHER = MetadataEnricher()
 
 @app.post("/api/settings/parallel")
 async def set_parallel_limit(req: ParallelLimitRequest):
     global MAX_PARALLEL
+    ceiling = int(load_config().get('max-parallel-downloads') or PARALLEL_CEILING)
+    if not 1 <= req.limit <= ceiling: raise HTTPException(status_code=400, detail=f"Parallel limit must be between 1 and {ceiling}")
     MAX_PARALLEL = req.limit
+    await SCHEDULER.resize(MAX_PARALLEL)
+    await ADMISSION.configure(MAX_PARALLEL)
     await broadcast_log(f"Parallel limit set to {MAX_PARALLEL}")
-    asyncio.create_task(process_queue())
     return {"status": "updated", "limit": MAX_PARALLEL}
 
+def trim_from_library(task: Dict) -> bool:
+    """Skip what the library index already has; True if nothing is left to download.
+
+    A fully present job is completed on the spot. A partially present album is
+    switched to track mode with the present tracks marked skipped, so only the
+    missing ones are handed to the downloader.
+    """
+    missing = LIBRARY.missing(task)
+    if missing is None: return False
+    sub_tasks = task.get('sub_tasks') or []
+    if not missing:
+        for st in sub_tasks:
+            if st['status'] == 'pending': st['status'] = 'skipped'
+        JOBS.update(task, status='completed', progress='Already in library', sub_tasks=sub_tasks)
+        LIBRARY.stats['skipped_jobs'] += 1
+        message = f"Already in library: {task.get('artist')} - {task.get('title') or task['url']}"
+        logger.info(message)
+        BROADCASTER.publish("logs", message)
+        return True
+    if len(missing) < len(sub_tasks) and all(st.get('url') for st in sub_tasks):
+        keep = set(missing)
+        trimmed = 0
+        for idx, st in enumerate(sub_tasks):
+            if idx not in keep and st['status'] == 'pending':
+                st['status'] = 'skipped'
+                trimmed += 1
+        LIBRARY.stats['trimmed_tracks'] += trimmed
+        JOBS.update(task, track_mode=True, sub_tasks=sub_tasks, progress=f"{len(sub_tasks) - len(missing)} tracks already in library")
+    return False
+
+def dispatch_job(task: Dict):
+    """Queue a job as one whole-URL unit, or one --song unit per pending track in track mode."""
+    if trim_from_library(task): return
+    sub_tasks = task.get('sub_tasks') or []
+    if task.get('track_mode') and sub_tasks and all(st.get('url') for st in sub_tasks):
+        for idx, st in enumerate(sub_tasks):
+            if st['status'] == 'pending': SCHEDULER.submit(task, idx)
+        if not any(st['status'] == 'pending' for st in sub_tasks): finish_track_job(task)
+    else:
+        SCHEDULER.submit(task)
+
+def default_priority(ref: Optional[Tuple[str, str, str]]) -> str:
+    return 'interactive' if ref and ref[1] in ('songs', 'music-videos') else 'album'
+
+def enqueue_tasks(items: List[Dict], skip_existing: bool, source: str, priority: Optional[str] = None) -> Tuple[List[Dict], List[Dict]]:
+    """Store new jobs atomically and hand them to the enricher and scheduler.
+
+    `source` names the submitter or batch the jobs share a fair-share lane
+    with; `priority` is the class for items that don't set one, derived from
+    the URL if None.
+    """
+    track_default = bool(load_config().get('track-level-scheduling', False))
+    tasks, skipped, seen = [], [], set()
+    for item in items:
+        task = dict(item, status='pending', sub_tasks=[], source=source)
+        ref = parse_catalog_url(task['url'])
+        if task.get('priority') not in PRIORITY_CLASSES: task['priority'] = priority or default_priority(ref)
+        track_mode = task.get('track_mode')
+        task['track_mode'] = bool(track_default if track_mode is None else track_mode) and bool(ref) and ref[1] == "albums"
+        key = job_key(task)
+        if skip_existing and (key in seen or JOBS.find_existing(task)):
+            skipped.append(item)
+            continue
+        seen.add(key)
+        tasks.append(task)
+    JOBS.add_many(tasks)
+    for task in tasks: ENRICHER.submit(task, dispatch=True)
+    return tasks, skipped
+
 @app.post("/api/download")
-async def add_download(req: DownloadRequest):
-    task = req.dict()
-    task['status'] = 'pending'
-    task['id'] = len(QUEUE) + 1
-    task['sub_tasks'] = []
-    QUEUE.append(task)
+async def add_download(req: DownloadRequest, request: Request):
+    # Interactive adds share one lane per client, so one user's clicks can't crowd out another's
+    tasks, _ = enqueue_tasks([req.dict()], skip_existing=False, source=f"client:{request.client.host if request.client else ''}")
     await broadcast_log(f"Added to queue: {req.url}")
-    asyncio.create_task(enrich_metadata(task))
-    asyncio.create_task(process_queue())
-    return {"status": "added", "task": task}
+    return {"status": "added", "task": tasks[0]}
+
+@app.post("/api/download/batch")
+async def add_download_batch(req: BatchDownloadRequest):
+    tasks, skipped = enqueue_tasks([item.dict() for item in req.items], req.skip_existing, source=f"batch:{time.time_ns()}", priority='bulk')
+    await broadcast_log(f"Added {len(tasks)} items to queue ({len(skipped)} already queued or downloaded)")
+    return {"status": "added", "added": len(tasks), "skipped": len(skipped), "ids": [t['id'] for t in tasks]}
+
+def release_item(item: Dict, codec: str) -> Dict:
+    """Job fields for one parsed artist-view release."""
+    return {
+        'url': item['url'],
+        'codec': codec,
+        'title': item['name'],
+        'artist': item['artist'],
+        'album': item['name'] if item['type'] == 'albums' else item['album'],
+        'image': item['image'],
+        'track_number': None,
+        'total_tracks': item['trackCount'],
+        'release_date': item.get('releaseDate'),
+    }
+
+@app.post("/api/artist/{artist_id}/download")
+async def download_artist(artist_id: str, req: ArtistDownloadRequest):
+    bad = [v for v in req.views if v not in ARTIST_VIEWS]
+    if bad: raise HTTPException(status_code=400, detail=f"Unknown artist views: {', '.join(bad)}")
+    storefront = req.storefront or load_config().get('storefront', 'us')
+    try:
+        views = await asyncio.gather(*(fetch_artist_view(storefront, artist_id, v) for v in req.views))
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Failed to expand artist: {e}")
+    items = [release_item(item, req.codec) for view in views for item in view if item.get('url')]
+    tasks, skipped = enqueue_tasks(items, skip_existing=True, source=f"artist:{artist_id}", priority='bulk')
+    await broadcast_log(f"Artist {artist_id}: queued {len(tasks)} releases, skipped {len(skipped)} already queued or downloaded")
+    return {"status": "added", "added": len(tasks), "skipped": len(skipped), "ids": [t['id'] for t in tasks]}
+
+@app.get("/api/watchlist")
+async def get_watchlist():
+    return WATCHLIST.status()
+
+@app.post("/api/watchlist")
+async def watch_artist(req: WatchlistRequest):
+    """Watch an artist for new releases; the first check runs right away and only records what is already out."""
+    storefront, artist_id = artist_ref(req.url)
+    bad = [v for v in req.views if v not in ARTIST_VIEWS]
+    if bad: raise HTTPException(status_code=400, detail=f"Unknown artist views: {', '.join(bad)}")
+    entry = WATCHLIST.add(storefront, artist_id, req.codec, req.views, req.backfill)
+    return {"status": "watching", "artist": WATCHLIST.describe(entry)}
+
+@app.post("/api/watchlist/{storefront}/{artist_id}/remove")
+async def unwatch_artist(storefront: str, artist_id: str):
+    if not WATCHLIST.remove(storefront, artist_id): raise HTTPException(status_code=404, detail="Artist is not watched")
+    return {"status": "removed"}
+
+@app.post("/api/watchlist/{storefront}/{artist_id}/check")
+async def check_watched_artist(storefront: str, artist_id: str):
+    if not WATCHLIST.request_check(storefront, artist_id): raise HTTPException(status_code=404, detail="Artist is not watched")
+    return {"status": "scheduled"}
 
 @app.get("/api/queue")
-async def get_queue():
-    return QUEUE
+async def get_queue(since: Optional[int] = None, offset: int = 0, limit: Optional[int] = None):
+    if since is None and limit is None:
+        return JOBS.all()
+    return JOBS.changes_since(since or 0, offset, limit)
+
+@app.post("/api/queue/{job_id}/retry")
+async def retry_job(job_id: int):
+    """Re-run a failed job now with a fresh retry allowance; track-mode jobs re-run only failed tracks."""
+    task = JOBS.get(job_id)
+    if not task: raise HTTPException(status_code=404, detail="Job not found")
+    if task['status'] != 'failed': raise HTTPException(status_code=400, detail="Only failed jobs can be retried")
+    RETRIES.cancel_job(job_id)
+    failed = [st for st in task.get('sub_tasks', []) if st['status'] == 'failed']
+    for st in failed: st.update(status='pending', attempts=0, error=None)
+    progress = f"Retrying {len(failed)} tracks" if task.get('track_mode') else "Queued for retry"
+    JOBS.update(task, status='pending', progress=progress, attempts=0, error=None, failure=None, retry_at=None, sub_tasks=task.get('sub_tasks', []))
+    if not ENRICHER.waiting(job_id): dispatch_job(task)
+    return {"status": "retrying", "tracks": len(failed)}
+
+@app.post("/api/queue/{job_id}/tracks/retry")
+async def retry_failed_tracks(job_id: int):
+    task = JOBS.get(job_id)
+    if not task: raise HTTPException(status_code=404, detail="Job not found")
+    if not task.get('track_mode'): raise HTTPException(status_code=400, detail="Job is not in track mode")
+    return await retry_job(job_id)
+
+def queued_job(job_id: int) -> Dict:
+    task = JOBS.get(job_id)
+    if not task: raise HTTPException(status_code=404, detail="Job not found")
+    return task
+
+@app.get("/api/queue/order")
+async def queue_order():
+    """Ids of queued jobs in the order they will start, then paused ones."""
+    return {"order": SCHEDULER.queue.order(), "paused": [t['id'] for t in JOBS.with_status('paused')]}
+
+@app.post("/api/queue/{job_id}/pause")
+async def pause_job(job_id: int):
+    """Hold a queued or running job; a running downloader is stopped and its finished tracks are kept."""
+    task = queued_job(job_id)
+    if task['status'] not in ('pending', 'downloading'): raise HTTPException(status_code=400, detail="Only queued or running jobs can be paused")
+    JOBS.update(task, status='paused', progress='Paused', retry_at=None)
+    stopped = await SCHEDULER.halt(task)
+    await broadcast_log(f"Paused: {task.get('title') or task['url']}")
+    return {"status": "paused", "stopped": stopped}
+
+@app.post("/api/queue/{job_id}/resume")
+async def resume_job(job_id: int):
+    task = queued_job(job_id)
+    if task['status'] != 'paused': raise HTTPException(status_code=400, detail="Job is not paused")
+    JOBS.update(task, status='pending', progress='Queued')
+    if not ENRICHER.waiting(job_id): dispatch_job(task)  # otherwise dispatched once its metadata is in
+    await broadcast_log(f"Resumed: {task.get('title') or task['url']}")
+    return {"status": "resumed"}
+
+@app.post("/api/queue/{job_id}/cancel")
+async def cancel_job(job_id: int):
+    """Stop a queued, paused or running job for good; it moves to the failed list, where it can still be retried."""
+    task = queued_job(job_id)
+    if task['status'] not in ('pending', 'paused', 'downloading'): raise HTTPException(status_code=400, detail="Job is already finished")
+    JOBS.update(task, status='failed', error='cancelled', failure='cancelled', progress='Cancelled', retry_at=None)
+    stopped = await SCHEDULER.halt(task)
+    for st in task.get('sub_tasks') or []:
+        if st['status'] == 'downloading': st['status'] = 'pending'
+    JOBS.touch(task, 'sub_tasks')
+    await broadcast_log(f"Cancelled: {task.get('title') or task['url']}")
+    return {"status": "cancelled", "stopped": stopped}
+
+@app.post("/api/queue/{job_id}/reorder")
+async def reorder_job(job_id: int, req: QueueReorderRequest):
+    """Move a waiting job to the top or bottom of its lane and/or into another priority class."""
+    task = queued_job(job_id)
+    if task['status'] not in ('pending', 'paused'): raise HTTPException(status_code=400, detail="Only waiting jobs can be reordered")
+    if req.position not in (None, 'top', 'bottom'): raise HTTPException(status_code=400, detail="position must be 'top' or 'bottom'")
+    if req.priority is not None and req.priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(PRIORITY_CLASSES)}")
+    fields = {}
+    if req.priority: fields['priority'] = req.priority
+    if req.position:
+        orders = [job_order(t) for t in JOBS.with_status('pending', 'paused') if t is not task] or [job_order(task)]
+        fields['order'] = min(orders) - 1 if req.position == 'top' else max(orders) + 1
+    JOBS.update(task, **fields)
+    # Re-queue the job's units under the new priority and order
+    for unit in SCHEDULER.queue.remove(task['id']): SCHEDULER.queue.put_nowait(unit)
+    if req.position == 'top': SCHEDULER.queue.promote(task)
+    return {"status": "reordered", "priority": job_priority(task), "order": job_order(task)}
 
 @app.post("/api/history/clear")
 async def clear_history():
-    global QUEUE
-    QUEUE = [t for t in QUEUE if t['status'] in ['pending', 'downloading']]
+    JOBS.remove([t['id'] for t in JOBS.with_status('completed', 'failed')])
     await broadcast_log("History cleared.")
     return {"status": "cleared"}
 
+@app.get("/api/admission/status")
+async def admission_status():
+    return ADMISSION.status()
+
+@app.get("/api/transcode/status")
+async def transcode_status():
+    return TRANSCODER.status()
+
+@app.get("/api/catalog/limiter")
+async def catalog_limiter_status():
+    return CATALOG_LIMITER.status()
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return CATALOG_CACHE.snapshot()
+
+@app.get("/api/artwork/stats")
+async def artwork_stats():
+    return ARTWORK.snapshot()
+
+@app.post("/api/cache/clear")
+async def clear_cache():
+    CATALOG_CACHE.clear()
+    return {"status": "cleared"}
+
 @app.get("/api/settings")
 async def get_settings():
-    return load_config()
+    return dict(load_config())
 
 @app.post("/api/settings")
 async def update_settings(req: Request):
     new_settings = await req.json()
-    current = load_config()
-    current.update(new_settings)
-    save_config(current)
+    if not isinstance(new_settings, dict): raise HTTPException(status_code=400, detail="Expected a JSON object")
+    try:
+        CONFIG.update(new_settings)
+    except ConfigError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Failed to save config: {e}")
+        raise HTTPException(status_code=500, detail="Failed to save config")
     await broadcast_log("Settings updated")
     return {"status": "updated"}
 
@@ -431,47 +2554,28 @@ async def get_login_status():
 
 @app.post("/api/login")
 async def login(req: LoginRequest):
-    global LOGIN_STATUS, LOGIN_PROCESS, WRAPPER_DAEMON_PROCESS
-    if WRAPPER_DAEMON_PROCESS:
-        WRAPPER_DAEMON_PROCESS.terminate()
-        WRAPPER_DAEMON_PROCESS.wait()
-        WRAPPER_DAEMON_PROCESS = None
+    global LOGIN_STATUS, LOGIN_PROCESS
+    # The login run needs the wrapper data dir to itself; downloads wait meanwhile
+    await WRAPPER.pause()
     if LOGIN_PROCESS and LOGIN_PROCESS.returncode is None:
         try:
             LOGIN_PROCESS.terminate()
             await asyncio.wait_for(LOGIN_PROCESS.wait(), timeout=2.0)
         except: LOGIN_PROCESS.kill()
         LOGIN_PROCESS = None
-    LOGIN_STATUS["status"] = "authenticating"
-    env = os.environ.copy()
-    env["ANDROID_DATA"] = WRAPPER_DATA
-    env["ANDROID_ROOT"] = f"{WRAPPER_DATA}/system"
+    set_login_status("authenticating")
     try:
         cmd = [WRAPPER_BIN, "-L", f"{req.username}:{req.password}"]
         LOGIN_PROCESS = await asyncio.create_subprocess_exec(
-            *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env
+            *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=wrapper_env()
         )
         asyncio.create_task(monitor_login(LOGIN_PROCESS))
         return {"status": "started"}
     except Exception as e:
-        LOGIN_STATUS["status"] = "failed"
-        restart_daemon()
+        set_login_status("failed")
+        WRAPPER.resume()
         return {"status": "failed", "error": str(e)}
 
-def restart_daemon():
-    global WRAPPER_DAEMON_PROCESS
-    env = os.environ.copy()
-    env["ANDROID_DATA"] = WRAPPER_DATA
-    env["ANDROID_ROOT"] = f"{WRAPPER_DATA}/system"
-    cmd = [WRAPPER_BIN, "-H", "0.0.0.0"]
-    WRAPPER_DAEMON_PROCESS = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, text=True
-    )
-    def log_wrapper(proc):
-        for line in iter(proc.stdout.readline, ''):
-            if line: logger.info(f"[Wrapper Daemon] {line.strip()}")
-    threading.Thread(target=log_wrapper, args=(WRAPPER_DAEMON_PROCESS,), daemon=True).start()
-
 async def monitor_login(process: asyncio.subprocess.Process):
     global LOGIN_STATUS
     while True:
@@ -482,13 +2586,13 @@ async def monitor_login(process: asyncio.subprocess.Process):
             line = line_bytes.decode('utf-8', errors='replace')
             await broadcast_log(f"[Wrapper] {line.strip()}")
             if "2FA: true" in line or "authentication code" in line.lower() or "code:" in line.lower():
-                LOGIN_STATUS["status"] = "waiting_2fa"
+                set_login_status("waiting_2fa")
             elif "success" in line.lower() or "logged in" in line.lower() or "response type 6" in line.lower():
-                LOGIN_STATUS["status"] = "success"
+                set_login_status("success")
         else: break
     await process.wait()
-    if LOGIN_STATUS["status"] != "success": LOGIN_STATUS["status"] = "failed"
-    restart_daemon()
+    if LOGIN_STATUS["status"] != "success": set_login_status("failed")
+    WRAPPER.resume()
 
 @app.post("/api/2fa")
 async def submit_2fa(req: TwoFARequest):
@@ -499,141 +2603,1643 @@ async def submit_2fa(req: TwoFARequest):
         if LOGIN_PROCESS.stdin:
             LOGIN_PROCESS.stdin.write(f"{req.code}\n".encode())
             await LOGIN_PROCESS.stdin.drain()
-            LOGIN_STATUS["status"] = "authenticating"
+            set_login_status("authenticating")
             return {"status": "submitted"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+@app.get("/api/wrapper/status")
+async def wrapper_status():
+    return WRAPPER.status()
+
+@app.post("/api/wrapper/restart")
+async def wrapper_restart():
+    await WRAPPER.restart()
+    return {"status": "restarting"}
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/ws/stats")
+async def ws_stats():
+    return BROADCASTER.stats()
+
+@app.get("/api/library/stats")
+async def library_stats():
+    return dict(LIBRARY.stats, roots=LIBRARY.roots, bytes=LIBRARY.bytes, known_tracks=len(LIBRARY.known))
+
+@app.post("/api/library/rescan")
+async def library_rescan():
+    LIBRARY.request_scan()
+    return {"status": "scanning"}
+
+def parse_topics(topics: Optional[str], default: str) -> set:
+    return {t.strip() for t in (topics or default).split(",") if t.strip()}
+
 @app.websocket("/ws/logs")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    LOG_CLIENTS.append(websocket)
+async def websocket_endpoint(websocket: WebSocket, topics: Optional[str] = None):
+    await BROADCASTER.serve(websocket, parse_topics(topics, "logs"))
+
+@app.websocket("/ws/search")
+async def search_websocket(websocket: WebSocket):
+    await SEARCH.serve(websocket)
+
+@app.websocket("/ws/queue")
+async def queue_websocket(websocket: WebSocket, topics: Optional[str] = None):
+    await BROADCASTER.serve(websocket, parse_topics(topics, "queue"))
+
+# --- WRAPPER ---
+
+def wrapper_env(data_dir: Optional[str] = None) -> Dict[str, str]:
+    data_dir = data_dir or WRAPPER_DATA
+    env = os.environ.copy()
+    env["ANDROID_DATA"] = data_dir
+    env["ANDROID_ROOT"] = f"{data_dir}/system"
+    return env
+
+def parse_host_port(value: str, default_port: int) -> Tuple[str, int]:
+    host, _, port = str(value or "").rpartition(":")
+    try:
+        return (host or "127.0.0.1"), int(port)
+    except ValueError:
+        return "127.0.0.1", default_port
+
+async def probe_port(host: str, port: int, timeout: float = 2.0) -> bool:
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try: await writer.wait_closed()
+    except Exception: pass
+    return True
+
+def port_free(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try: s.bind(("0.0.0.0", port))
+        except OSError: return False
+    return True
+
+def tree_signature(path: str) -> str:
+    """Digest of the path, size and mtime of every file under `path`."""
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            try: st = os.lstat(full)
+            except FileNotFoundError: continue
+            digest.update(f"{os.path.relpath(full, path)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def sync_sandbox(src: str, dst: str):
+    """Refresh an instance's copy of the wrapper data dir (login state lives there) if it changed since the last copy."""
+    marker = f"{dst}.synced"  # next to the copy, where the daemon doesn't see it
+    signature = tree_signature(src)
+    try:
+        with open(marker) as f:
+            if f.read() == signature and os.path.isdir(dst): return
+    except FileNotFoundError:
+        pass
+    shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+    with open(marker, 'w') as f: f.write(signature)
+
+class WrapperSupervisor:
+    """Keeps one wrapper daemon (decrypt + m3u8 service) running.
+
+    The daemon is started with create_subprocess_exec and both of its streams
+    are drained into the log. It counts as ready once its decrypt and m3u8
+    ports accept connections (for the primary instance, the ports from
+    config.yaml). A daemon that exits or fails WRAPPER_HEALTH_FAILURES probes
+    in a row is restarted with exponential backoff. `ready` is cleared
+    meanwhile, so no new downloads are routed to it. pause()/resume() take the
+    daemon down for the interactive login.
+    """
+
+    def __init__(self, name: str, args: List[str], data_dir: Optional[str] = None,
+                 ports: Optional[List[Tuple[str, int]]] = None):
+        self.name = name
+        self.args = args
+        self.data_dir = data_dir  # None: WRAPPER_DATA itself
+        self.ports = ports  # None: follow decrypt-m3u8-port / get-m3u8-port in config.yaml
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.ready = asyncio.Event()
+        self.state = "stopped"
+        self.restarts = 0
+        self.outstanding = 0  # downloads currently routed to this instance
+        self.paused = False
+        self.on_change: Callable[[], None] = lambda: None
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self._restart_now = False
+
+    @property
+    def supervised(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._terminate()
+        self.state = "stopped"
+
+    async def pause(self):
+        self.paused = True
+        self.state = "paused"
+        self._set_ready(False)
+        await self._terminate()
+
+    def resume(self):
+        self.paused = False
+        self._wake.set()
+
+    async def restart(self):
+        self.restarts += 1
+        WRAPPER_RESTARTS.inc()
+        self._restart_now = True
+        self._wake.set()  # cut short a backoff wait already in progress
+        await self._terminate()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "ready": self.ready.is_set(),
+            "pid": self.process.pid if self.process and self.process.returncode is None else None,
+            "ports": [f"{h}:{p}" for h, p in self._ports()],
+            "outstanding": self.outstanding,
+            "restarts": self.restarts,
+            "supervised": self.supervised,
+        }
+
+    def _ports(self) -> List[Tuple[str, int]]:
+        if self.ports is not None: return self.ports
+        config = load_config()
+        return [parse_host_port(config.get('decrypt-m3u8-port', '127.0.0.1:10020'), 10020),
+                parse_host_port(config.get('get-m3u8-port', '127.0.0.1:20020'), 20020)]
+
+    def _set_ready(self, ready: bool):
+        if ready == self.ready.is_set(): return
+        if ready: self.ready.set()
+        else: self.ready.clear()
+        self.on_change()
+
+    async def _healthy(self) -> bool:
+        results = await asyncio.gather(*(probe_port(h, p) for h, p in self._ports()))
+        return all(results)
+
+    async def _terminate(self):
+        proc = self.process
+        if not proc or proc.returncode is not None: return
+        logger.info(f"Stopping {self.name}...")
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+        except ProcessLookupError:
+            pass
+
+    async def _drain(self, stream: asyncio.StreamReader):
+        async for event in read_output_events(stream):
+            logger.info(f"[{self.name}] {event.line}")
+
+    async def _run(self):
+        backoff = 1.0
+        while True:
+            while self.paused:
+                self.state = "paused"
+                self._wake.clear()
+                await self._wake.wait()
+            self.state = "starting"
+            started = time.monotonic()
+            try:
+                if self.data_dir: await asyncio.to_thread(sync_sandbox, WRAPPER_DATA, self.data_dir)
+                self.process = await asyncio.create_subprocess_exec(
+                    WRAPPER_BIN, *self.args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=wrapper_env(self.data_dir)
+                )
+                logger.info(f"{self.name} started with PID {self.process.pid}")
+                drains = [asyncio.create_task(self._drain(self.process.stdout)), asyncio.create_task(self._drain(self.process.stderr))]
+                try:
+                    await self._supervise(self.process)
+                finally:
+                    self._set_ready(False)
+                    await self._terminate()
+                    await asyncio.gather(*drains, return_exceptions=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to start {self.name}: {e}")
+            if self.paused or self._restart_now:
+                self._restart_now = False
+                continue
+            # A daemon that stayed up for a while resets the backoff
+            if time.monotonic() - started > WRAPPER_BACKOFF_MAX: backoff = 1.0
+            delay = backoff * random.uniform(0.8, 1.2)
+            backoff = min(backoff * 2, WRAPPER_BACKOFF_MAX)
+            self.state = "backoff"
+            self.restarts += 1
+            WRAPPER_RESTARTS.inc()
+            logger.warning(f"{self.name} down, restarting in {delay:.1f}s")
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _supervise(self, proc: asyncio.subprocess.Process):
+        exited = asyncio.create_task(proc.wait())
+        try:
+            deadline = time.monotonic() + WRAPPER_START_TIMEOUT
+            while not await self._healthy():
+                if time.monotonic() > deadline:
+                    logger.error(f"{self.name} did not open its ports within {WRAPPER_START_TIMEOUT:.0f}s")
+                    return
+                done, _ = await asyncio.wait({exited}, timeout=0.5)
+                if done:
+                    logger.error(f"{self.name} exited during startup with code {proc.returncode}")
+                    return
+            self.state = "ready"
+            self._set_ready(True)
+            await broadcast_log(f"{self.name} ready")
+            failures = 0
+            while True:
+                done, _ = await asyncio.wait({exited}, timeout=WRAPPER_HEALTH_INTERVAL)
+                if done:
+                    planned = self.paused or self._restart_now
+                    (logger.info if planned else logger.error)(f"{self.name} exited with code {proc.returncode}")
+                    return
+                if await self._healthy():
+                    failures = 0
+                    continue
+                failures += 1
+                logger.warning(f"{self.name} health check failed ({failures}/{WRAPPER_HEALTH_FAILURES})")
+                if failures >= WRAPPER_HEALTH_FAILURES: return
+        finally:
+            exited.cancel()
+
+class WrapperPool:
+    """A set of wrapper instances that downloads are spread across.
+
+    Instance 0 is the classic daemon: ports from config.yaml and WRAPPER_DATA
+    itself. Instance i > 0 listens on the first free ports from the primary's
+    ports + i (-D/-M/-A) and runs from its own copy of WRAPPER_DATA, since
+    the daemon keeps mutable state there. The copy is refreshed before a
+    launch only when WRAPPER_DATA changed. acquire() hands out the ready instance with
+    the fewest outstanding downloads and waits while none is ready, which
+    holds the scheduler during a wrapper outage instead of failing jobs.
+    """
+
+    def __init__(self):
+        self.instances: List[WrapperSupervisor] = []
+        self._changed = asyncio.Event()
+
+    def configure(self, size: int):
+        self.instances = []
+        config = load_config()
+        bases = {"-D": parse_host_port(config.get('decrypt-m3u8-port'), WRAPPER_DECRYPT_PORT)[1],
+                 "-M": parse_host_port(config.get('get-m3u8-port'), WRAPPER_M3U8_PORT)[1], "-A": WRAPPER_ACCOUNT_PORT}
+        taken = set(bases.values())
+        for i in range(max(1, size)):
+            if i == 0:
+                inst = WrapperSupervisor("Wrapper Daemon", ["-H", "0.0.0.0"])
+            else:
+                ports = {}
+                for flag, base in bases.items():
+                    ports[flag] = next(p for p in range(base + i, 65536) if p not in taken and port_free(p))
+                    taken.add(ports[flag])
+                inst = WrapperSupervisor(f"Wrapper {i}", ["-H", "0.0.0.0", *[str(x) for kv in ports.items() for x in kv]],
+                                         data_dir=f"{WRAPPER_DATA}_{i}",
+                                         ports=[("127.0.0.1", ports["-D"]), ("127.0.0.1", ports["-M"])])
+            inst.on_change = self._changed.set
+            self.instances.append(inst)
+
+    def start(self):
+        if not os.path.exists(WRAPPER_BIN):
+            logger.warning(f"Wrapper binary {WRAPPER_BIN} not found; downloads will not wait for it")
+            return
+        if not self.instances: self.configure(1)
+        for inst in self.instances: inst.start()
+
+    async def stop(self):
+        await asyncio.gather(*(inst.stop() for inst in self.instances))
+
+    @property
+    def supervised(self) -> bool:
+        return any(inst.supervised for inst in self.instances)
+
+    async def acquire(self) -> Optional[WrapperSupervisor]:
+        """Reserve the least loaded ready instance, or None when no wrapper is supervised."""
+        while self.supervised:
+            ready = [inst for inst in self.instances if inst.ready.is_set()]
+            if ready:
+                inst = min(ready, key=lambda i: i.outstanding)
+                inst.outstanding += 1
+                return inst
+            self._changed.clear()
+            await self._changed.wait()
+        return None
+
+    def release(self, inst: Optional[WrapperSupervisor]):
+        if inst: inst.outstanding -= 1
+
+    async def pause(self):
+        await asyncio.gather(*(inst.pause() for inst in self.instances))
+
+    def resume(self):
+        for inst in self.instances: inst.resume()
+
+    async def restart(self):
+        await asyncio.gather(*(inst.restart() for inst in self.instances))
+
+    def status(self) -> Dict[str, Any]:
+        instances = [inst.status() for inst in self.instances]
+        return {
+            "ready": sum(1 for s in instances if s["ready"]),
+            "size": len(instances),
+            "supervised": self.supervised,
+            "instances": instances,
+        }
+
+WRAPPER = WrapperPool()
+
+def write_job_config(inst: Optional[WrapperSupervisor], overrides: Optional[Dict] = None) -> str:
+    """Write a config.yaml pointing the downloader at `inst`; returns the directory to run it in."""
+    config = dict(load_config())
+    if inst is not None:
+        (dh, dp), (mh, mp) = inst._ports()
+        config['decrypt-m3u8-port'] = f"{dh}:{dp}"
+        config['get-m3u8-port'] = f"{mh}:{mp}"
+    config.update(overrides or {})
+    # Relative paths in the shared config are relative to APP_DIR, not the job dir
+    for key, value in config.items():
+        if not isinstance(value, str) or not value or os.path.isabs(value): continue
+        if key.endswith('-folder') or (key.endswith('-path') and os.sep in value):
+            config[key] = os.path.join(APP_DIR, value)
+    job_dir = tempfile.mkdtemp(prefix="amd-job-")
+    with open(os.path.join(job_dir, "config.yaml"), 'w') as f:
+        yaml.dump(config, f)
+    return job_dir
+
+async def downloader_workdir(inst: Optional[WrapperSupervisor], task: Optional[Dict] = None) -> str:
+    """Working directory for one downloader run: APP_DIR when the shared config fits, a per-job config otherwise."""
+    overrides = {}
+    # Jobs the transcode stage can locate are converted by the server, off the download slot
+    if task is not None and TRANSCODER.handles(task): overrides['convert-after-download'] = False
+    if not overrides and (inst is None or inst.ports is None): return APP_DIR
+    return await asyncio.to_thread(write_job_config, inst, overrides)
+
+def release_workdir(workdir: str):
+    if workdir != APP_DIR: shutil.rmtree(workdir, ignore_errors=True)
+
+# --- ADMISSION ---
+
+def read_int(path: str) -> Optional[int]:
     try:
-        while True: await websocket.receive_text()
-    except WebSocketDisconnect:
-        LOG_CLIENTS.remove(websocket)
-
-async def process_queue():
-    # Concurrency Control
-    active_count = len([t for t in QUEUE if t['status'] == 'downloading'])
-    if active_count >= MAX_PARALLEL:
-        return
-
-    task = next((t for t in QUEUE if t['status'] == 'pending'), None)
-    if not task: return
-    task['status'] = 'downloading'
-    task['progress'] = 'Starting...'
+        with open(path) as f: value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+def memory_headroom() -> Optional[int]:
+    """Bytes the container can still allocate: cgroup v2, then v1, then the host's MemAvailable."""
+    for limit_path, usage_path in (("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                   ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")):
+        limit, usage = read_int(limit_path), read_int(usage_path)
+        # v1 reports "unlimited" as a huge page-rounded number
+        if limit is not None and usage is not None and limit < 1 << 60: return max(0, limit - usage)
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"): return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def io_pressure() -> Optional[float]:
+    """Share of the last 10s some task was stalled on I/O (PSI "some avg10"), or None without PSI."""
+    for path in ("/sys/fs/cgroup/io.pressure", "/proc/pressure/io"):
+        try:
+            with open(path) as f: first = f.readline()
+        except OSError:
+            continue
+        fields = dict(part.split("=", 1) for part in first.split()[1:] if "=" in part)
+        try: return float(fields["avg10"])
+        except (KeyError, ValueError): continue
+    return None
+
+def disk_free(path: str) -> Optional[int]:
+    """Free bytes on the volume a (possibly not yet created) folder will live on."""
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path: return None
+        path = parent
+    try: return shutil.disk_usage(path or ".").free
+    except OSError: return None
+
+class Reservation(NamedTuple):
+    root: Optional[str]  # save folder the job writes to
+    disk: int
+    memory: int
+    started: float
+
+class AdmissionController:
+    """Decides when a worker holding a slot may actually start its downloader.
+
+    Each unit's footprint is its unfinished tracks times the library's bytes
+    per track for the codec, plus one downloader's max-memory-limit. A unit
+    starts only if it fits on its save folder's volume and in the container's
+    memory after what running units have reserved; memory of units younger
+    than ADMISSION_RAMP is counted as not yet visible in the cgroup usage.
+    When nothing can start for lack of resources the queue is paused and
+    announced once; jobs stay pending and resume on their own once space or
+    memory comes back, instead of failing halfway through an album.
+
+    On top of that the effective limit moves between 1 and MAX_PARALLEL: it
+    drops by one when I/O pressure or memory headroom says the volume or the
+    container is saturated, and climbs back while units are waiting and the
+    system is idle enough. Write throughput per save folder is derived from
+    the drop in free space between samples and reported alongside.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active: Dict[int, Reservation] = {}
+        self.waiting = 0
+        self.paused: Optional[str] = None
+        self.free: Dict[str, int] = {}
+        self.throughput: Dict[str, float] = {}  # root -> bytes/s, smoothed
+        self.headroom: Optional[int] = None
+        self.pressure: Optional[float] = None
+        self._cond: Optional[asyncio.Condition] = None
+        self._sampled = 0.0
+        self._ids = itertools.count()
+
+    @property
+    def cond(self) -> asyncio.Condition:
+        if self._cond is None: self._cond = asyncio.Condition()
+        return self._cond
+
+    def footprint(self, task: Dict, track: Optional[int]) -> Reservation:
+        codec = library_codec(task.get('codec', 'alac'))
+        if track is not None: tracks = 1
+        else:
+            sub_tasks = task.get('sub_tasks') or []
+            tracks = sum(1 for st in sub_tasks if st.get('status') not in ('completed', 'skipped')) if sub_tasks else task.get('total_tracks') or 1
+        config = load_config()
+        memory = int(config.get('max-memory-limit') or 256) << 20
+        return Reservation(library_roots(config).get(codec), tracks * LIBRARY.track_bytes(codec), memory, time.monotonic())
+
+    def _blocked(self, need: Reservation) -> Optional[str]:
+        """Why the unit can't start right now, or None if it fits."""
+        if need.root:
+            free = disk_free(need.root)
+            if free is not None:
+                self.free[need.root] = free
+                reserved = sum(r.disk for r in self.active.values() if r.root == need.root)
+                if free - reserved < need.disk + ADMISSION_DISK_RESERVE:
+                    return f"low disk space on {need.root} ({free >> 20} MB free, {(need.disk + reserved + ADMISSION_DISK_RESERVE) >> 20} MB needed)"
+        # With nothing running, waiting would not free any memory
+        if self.active:
+            headroom = memory_headroom()
+            if headroom is not None:
+                self.headroom = headroom
+                now = time.monotonic()
+                ramping = sum(r.memory for r in self.active.values() if now - r.started < ADMISSION_RAMP)
+                if headroom - ramping < need.memory + ADMISSION_MEMORY_RESERVE:
+                    return f"low memory ({headroom >> 20} MB available)"
+        return None
+
+    async def admit(self, task: Dict, track: Optional[int] = None) -> int:
+        """Wait until the unit may start; returns the id to release() afterwards."""
+        need = self.footprint(task, track)
+        async with self.cond:
+            self.waiting += 1
+            try:
+                while True:
+                    if len(self.active) < self.limit:
+                        reason = self._blocked(need)
+                        if reason is None: break
+                        if reason != self.paused:
+                            self.paused = reason
+                            await broadcast_log(f"Download queue paused: {reason}")
+                    try: await asyncio.wait_for(self.cond.wait(), ADMISSION_INTERVAL)
+                    except asyncio.TimeoutError: pass
+            finally:
+                self.waiting -= 1
+            if self.paused:
+                self.paused = None
+                await broadcast_log("Download queue resumed")
+            rid = next(self._ids)
+            self.active[rid] = need._replace(started=time.monotonic())
+            return rid
+
+    async def release(self, rid: Optional[int]):
+        async with self.cond:
+            self.active.pop(rid, None)
+            self.cond.notify_all()
+
+    async def configure(self, limit: int):
+        async with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+    def sample(self):
+        now = time.monotonic()
+        elapsed = now - self._sampled if self._sampled else 0.0
+        self._sampled = now
+        for root in set(library_roots(load_config()).values()):
+            free = disk_free(root)
+            if free is None: continue
+            previous = self.free.get(root)
+            self.free[root] = free
+            if previous is None or elapsed <= 0: continue
+            rate = max(0, previous - free) / elapsed
+            self.throughput[root] = 0.7 * self.throughput.get(root, rate) + 0.3 * rate
+        self.headroom, self.pressure = memory_headroom(), io_pressure()
+
+    async def run(self):
+        low, high = ADMISSION_IO_PRESSURE
+        while True:
+            try:
+                await asyncio.to_thread(self.sample)
+                limit = self.limit
+                starved = self.headroom is not None and self.headroom < ADMISSION_MEMORY_RESERVE
+                if starved or (self.pressure is not None and self.pressure > high):
+                    limit = max(1, min(limit, len(self.active)) - 1)
+                elif self.waiting and len(self.active) >= limit and (self.pressure is None or self.pressure < low):
+                    limit += 1
+                limit = max(1, min(limit, MAX_PARALLEL))
+                if limit != self.limit:
+                    logger.info(f"Admission limit {self.limit} -> {limit} (io pressure {self.pressure}, memory headroom {self.headroom})")
+                    await self.configure(limit)
+                else:
+                    async with self.cond: self.cond.notify_all()
+            except Exception as e:
+                logger.error(f"Admission sample failed: {e}")
+            await asyncio.sleep(ADMISSION_INTERVAL)
+
+    def status(self) -> Dict:
+        roots = library_roots(load_config())
+        return {
+            'limit': self.limit, 'ceiling': MAX_PARALLEL, 'active': len(self.active), 'waiting': self.waiting,
+            'paused': self.paused, 'memory_headroom': self.headroom, 'io_pressure': self.pressure,
+            'reserved': {'disk': sum(r.disk for r in self.active.values()), 'memory': sum(r.memory for r in self.active.values())},
+            'volumes': {codec: {'path': root, 'free': self.free.get(root), 'write_bytes_per_second': round(self.throughput.get(root, 0.0)),
+                                'track_bytes': LIBRARY.track_bytes(codec)} for codec, root in roots.items()},
+        }
+
+ADMISSION = AdmissionController(MAX_PARALLEL)
+METRICS.register(Gauge("amd_admission_limit", "Effective parallel limit after resource adaptation.", collect=lambda: ADMISSION.limit))
+METRICS.register(Gauge("amd_admission_waiting", "Workers holding a slot but waiting for admission.", collect=lambda: ADMISSION.waiting))
+METRICS.register(Gauge("amd_admission_paused", "1 while the queue is paused for lack of disk or memory.", collect=lambda: int(bool(ADMISSION.paused))))
+METRICS.register(Gauge("amd_memory_headroom_bytes", "Memory the container can still allocate, as last sampled.", collect=lambda: ADMISSION.headroom or 0))
+METRICS.register(Gauge("amd_io_pressure", "I/O pressure (PSI some avg10, percent), as last sampled.", collect=lambda: ADMISSION.pressure or 0))
+METRICS.register(Gauge("amd_disk_free_bytes", "Free space on each save folder's volume.", "codec",
+                       lambda: {codec: ADMISSION.free[root] for codec, root in library_roots(load_config()).items() if root in ADMISSION.free}))
+METRICS.register(Gauge("amd_write_bytes_per_second", "Write throughput per save folder, from the drop in free space.", "codec",
+                       lambda: {codec: ADMISSION.throughput.get(root, 0.0) for codec, root in library_roots(load_config()).items()}))
+
+# --- SCHEDULER ---
+
+class ResizableSemaphore:
+    """Counting semaphore whose limit can be changed while slots are held."""
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._active = 0
+        self._cond = asyncio.Condition()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self._limit)
+            self._active += 1
+
+    async def release(self):
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    async def resize(self, limit: int):
+        async with self._cond:
+            self._limit = limit
+            self._cond.notify_all()
+
+def job_priority(task: Dict) -> str:
+    return task.get('priority') if task.get('priority') in PRIORITY_CLASSES else 'album'
+
+def job_order(task: Dict) -> float:
+    """Position of a job within its source; the id unless it was moved."""
+    return task.get('order', task['id'])
+
+class FairQueue:
+    """Work units ordered by priority class, then round-robin across sources.
+
+    Every unit lands in the lane of its job's (priority, source). get() serves
+    the highest non-empty class and, within it, takes one unit from the lane
+    at the head of the rotation and sends that lane to the back, so a 300
+    album discography paste and a single queued next to it take turns
+    instead of the single waiting behind the whole paste. Within a lane
+    units go by job_order(), then submission order.
+    """
+
+    def __init__(self):
+        self.lanes: Dict[str, OrderedDict] = {p: OrderedDict() for p in PRIORITY_CLASSES}  # priority -> source -> heap
+        self._ready = asyncio.Event()
+        self._count = itertools.count()
+        self._size = 0
+
+    def qsize(self) -> int:
+        return self._size
+
+    def sizes(self) -> Dict[str, int]:
+        return {p: sum(len(heap) for heap in lanes.values()) for p, lanes in self.lanes.items()}
+
+    def put_nowait(self, unit: Tuple):
+        task = unit[0]
+        lane = self.lanes[job_priority(task)].setdefault(task.get('source') or '', [])
+        heapq.heappush(lane, (job_order(task), next(self._count), unit))
+        self._size += 1
+        self._ready.set()
+
+    def get_nowait(self) -> Optional[Tuple]:
+        for lanes in self.lanes.values():
+            if not lanes: continue
+            source, heap = next(iter(lanes.items()))
+            unit = heapq.heappop(heap)[2]
+            if heap: lanes.move_to_end(source)
+            else: del lanes[source]
+            self._size -= 1
+            return unit
+        return None
+
+    async def get(self) -> Tuple:
+        # A cancelled waiter has not popped anything, so resizing the worker pool can't lose units
+        while True:
+            unit = self.get_nowait()
+            if unit is not None: return unit
+            self._ready.clear()
+            await self._ready.wait()
+
+    def remove(self, job_id: int) -> List[Tuple]:
+        """Take every queued unit of a job out of the queue and return them."""
+        removed = []
+        for lanes in self.lanes.values():
+            for source in list(lanes):
+                heap = lanes[source]
+                kept = [entry for entry in heap if entry[2][0]['id'] != job_id]
+                if len(kept) == len(heap): continue
+                removed.extend(entry[2] for entry in sorted(heap) if entry[2][0]['id'] == job_id)
+                if kept:
+                    heapq.heapify(kept)
+                    lanes[source] = kept
+                else:
+                    del lanes[source]
+        self._size -= len(removed)
+        return removed
+
+    def promote(self, task: Dict):
+        """Put the job's lane first in its class's rotation."""
+        lanes = self.lanes[job_priority(task)]
+        if (task.get('source') or '') in lanes: lanes.move_to_end(task.get('source') or '', last=False)
+
+    def order(self) -> List[int]:
+        """Job ids in the order get() would hand them out right now."""
+        ids, seen = [], set()
+        for lanes in self.lanes.values():
+            heaps = [sorted(heap) for heap in lanes.values()]
+            for row in itertools.zip_longest(*heaps):
+                for entry in row:
+                    if entry is None or entry[2][0]['id'] in seen: continue
+                    seen.add(entry[2][0]['id'])
+                    ids.append(entry[2][0]['id'])
+        return ids
+
+class DownloadScheduler:
+    """Pool of long-lived workers pulling work units from a FairQueue.
+
+    A unit is (task, None) for a whole-URL download or (task, track_index) for
+    a single track of a track-mode album job.
+
+    add_download() puts the task on the queue and an idle worker picks it up.
+    Concurrency is enforced by the slot semaphore, so the number of running
+    downloads never exceeds the limit even while the pool is being resized.
+    Running units register their downloader process so a job can be paused
+    or cancelled mid-download with halt().
+    """
+
+    def __init__(self, limit: int):
+        self.queue = FairQueue()
+        self.slots = ResizableSemaphore(limit)
+        self.workers: Dict[asyncio.Task, bool] = {}  # worker -> busy
+        self.processes: Dict[Tuple[int, Optional[int]], asyncio.subprocess.Process] = {}  # (job id, track) -> downloader
+        self.epochs: Dict[int, int] = {}  # job id -> halt count; units from before a halt are dropped
+        self._retire = 0
+
+    def start(self):
+        for _ in range(self.slots.limit):
+            self._spawn()
+
+    async def stop(self):
+        for worker in list(self.workers):
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+
+    def submit(self, task: Dict, track: Optional[int] = None):
+        self.queue.put_nowait((task, track, time.monotonic(), self.epochs.get(task['id'], 0)))
+
+    async def halt(self, task: Dict) -> int:
+        """Take a job out of the queue and stop its running downloaders; the caller has already moved its status.
+
+        Downloaders get SIGTERM and HALT_GRACE seconds to exit before SIGKILL.
+        Returns the number of processes stopped.
+        """
+        self.queue.remove(task['id'])
+        # Units already taken by a worker that is still waiting for admission or a wrapper
+        self.epochs[task['id']] = self.epochs.get(task['id'], 0) + 1
+        RETRIES.cancel_job(task['id'])
+        procs = [proc for (job_id, _), proc in list(self.processes.items()) if job_id == task['id'] and proc.returncode is None]
+        for proc in procs:
+            try: proc.terminate()
+            except ProcessLookupError: pass
+
+        async def reap(proc: asyncio.subprocess.Process):
+            try:
+                await asyncio.wait_for(proc.wait(), HALT_GRACE)
+            except asyncio.TimeoutError:
+                try: proc.kill()
+                except ProcessLookupError: pass
+                await proc.wait()
+
+        await asyncio.gather(*(reap(proc) for proc in procs))
+        return len(procs)
+
+    async def resize(self, limit: int):
+        await self.slots.resize(limit)
+        delta = limit - len(self.workers) + self._retire
+        if delta > 0:
+            absorbed = min(delta, self._retire)
+            self._retire -= absorbed
+            for _ in range(delta - absorbed):
+                self._spawn()
+        elif delta < 0:
+            excess = -delta
+            # Idle workers are parked in queue.get() and can be cancelled safely;
+            # busy ones retire as soon as their current download finishes.
+            for worker, busy in list(self.workers.items()):
+                if excess == 0: break
+                if not busy:
+                    worker.cancel()
+                    self.workers.pop(worker, None)
+                    excess -= 1
+            self._retire += excess
+
+    def _stale(self, task: Dict, epoch: int) -> bool:
+        """Whether the unit's job was removed, paused or cancelled since the unit was queued."""
+        return JOBS.get(task['id']) is not task or epoch != self.epochs.get(task['id'], 0)
+
+    def _spawn(self):
+        worker = asyncio.create_task(self._worker())
+        self.workers[worker] = False
+
+    async def _worker(self):
+        me = asyncio.current_task()
+        try:
+            while True:
+                if self._retire > 0:
+                    self._retire -= 1
+                    return
+                task, track, queued_at, epoch = await self.queue.get()
+                if self._stale(task, epoch): continue
+                self.workers[me] = True
+                wrapper = admitted = None
+                charged = slotted = False
+                try:
+                    # The downloader calls amp-api itself; pay for it up front so
+                    # spawns back off with everything else while Apple throttles us
+                    await CATALOG_LIMITER.acquire("bulk", DOWNLOADER_API_COST)
+                    charged = True
+                    await self.slots.acquire()
+                    slotted = True
+                    admitted = await ADMISSION.admit(task, track)
+                    wrapper = await WRAPPER.acquire()
+                    # Paused or cancelled while this unit waited for tokens or a slot
+                    if self._stale(task, epoch): continue
+                    JOB_PHASE_SECONDS.observe(time.monotonic() - queued_at, phase="queue_wait")
+                    charged = False  # spent by the downloader from here on
+                    if track is None: await run_download(task, wrapper)
+                    else: await run_track_download(task, track, wrapper)
+                except Exception as e:
+                    logger.error(f"Worker crashed on task {task.get('id')}: {e}")
+                finally:
+                    # Tokens for a unit that never reached the downloader go back, however it was dropped
+                    if charged: CATALOG_LIMITER.refund(DOWNLOADER_API_COST)
+                    WRAPPER.release(wrapper)
+                    await ADMISSION.release(admitted)
+                    if slotted: await self.slots.release()
+                    self.workers[me] = False
+        finally:
+            self.workers.pop(me, None)
+
+SCHEDULER = DownloadScheduler(MAX_PARALLEL)
+
+class RetryController:
+    """Decides what happens to a failed download unit and re-queues transient failures.
+
+    Permanent failures (unavailable, bad URL, ...) fail at once. Transient ones
+    get RETRY_MAX_ATTEMPTS retries with exponential backoff, half of each delay
+    jittered so jobs that failed together don't come back together. Every
+    retry also draws from a shared token bucket refilled at RETRY_BUDGET_RATE;
+    when it runs dry retries are pushed further out instead of storming a
+    recovering wrapper or API. Waiting units hold no worker slot.
+
+    A whole-album job that fails after some tracks landed is switched to track
+    mode, so only the remaining tracks are retried.
+    """
+
+    def __init__(self):
+        self.timers: Dict[Tuple[int, Optional[int]], asyncio.TimerHandle] = {}
+        self.tokens = float(RETRY_BUDGET_BURST)
+        self.updated = time.monotonic()
+
+    def _budget_wait(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(RETRY_BUDGET_BURST, self.tokens + (now - self.updated) * RETRY_BUDGET_RATE)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / RETRY_BUDGET_RATE
+
+    async def failed(self, task: Dict, track: Optional[int], kind: str, reason: str, detail: str):
+        """Record a failed run of `task` (or of one track of it) and retry or fail it."""
+        JOB_FAILURES.inc(reason=reason)
+        if reason == 'rate_limited': CATALOG_LIMITER.record(429)
+        detail = detail[:200]
+        attempt = (task if track is None else task['sub_tasks'][track]).get('attempts', 0) + 1
+        name = task.get('title') or task['url']
+        if track is not None: name = f"{name} track {task['sub_tasks'][track].get('track_number')}"
+        if kind == 'permanent' or attempt > RETRY_MAX_ATTEMPTS:
+            why = "permanent" if kind == 'permanent' else f"gave up after {RETRY_MAX_ATTEMPTS} retries"
+            await broadcast_log(f"Download failed ({reason}, {why}): {name} - {detail}")
+            if track is None:
+                JOBS.update(task, status='failed', error=reason, failure=kind, progress=f"Failed ({reason}): {detail}", sub_tasks=task.get('sub_tasks', []))
+            else:
+                task['sub_tasks'][track].update(status='failed', error=reason)
+                JOBS.touch(task, 'sub_tasks')
+            return
+        cap = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+        delay = max(cap / 2 + random.uniform(0, cap / 2), self._budget_wait())
+        retry_at = time.time() + delay
+        JOB_RETRIES.inc(reason=reason)
+        await broadcast_log(f"Retrying in {delay:.0f}s ({reason}, attempt {attempt}/{RETRY_MAX_ATTEMPTS}): {name} - {detail}")
+        if track is None:
+            fields = {'status': 'pending', 'attempts': attempt, 'error': reason, 'retry_at': retry_at, 'sub_tasks': task.get('sub_tasks', []),
+                      'progress': f"Retry {attempt}/{RETRY_MAX_ATTEMPTS} in {delay:.0f}s ({reason})"}
+            if self._split_tracks(task): fields['track_mode'] = True
+            JOBS.update(task, **fields)
+        else:
+            task['sub_tasks'][track].update(status='pending', attempts=attempt, error=reason, retry_at=retry_at)
+            JOBS.touch(task, 'sub_tasks')
+        self.cancel(task['id'], track)
+        self.timers[(task['id'], track)] = asyncio.get_running_loop().call_later(delay, self._fire, task, track)
+
+    def _split_tracks(self, task: Dict) -> bool:
+        sub_tasks = task.get('sub_tasks') or []
+        if task.get('track_mode') or not sub_tasks or not all(st.get('url') for st in sub_tasks): return False
+        if not any(st['status'] in ('completed', 'skipped') for st in sub_tasks): return False
+        for st in sub_tasks:
+            if st['status'] not in ('completed', 'skipped'): st['status'] = 'pending'
+        return True
+
+    def _fire(self, task: Dict, track: Optional[int]):
+        self.timers.pop((task['id'], track), None)
+        if JOBS.get(task['id']) is not task: return
+        if track is None:
+            if task['status'] == 'pending': dispatch_job(task)
+        elif task['sub_tasks'][track]['status'] == 'pending':
+            SCHEDULER.submit(task, track)
+
+    def cancel(self, job_id: int, track: Optional[int] = None):
+        handle = self.timers.pop((job_id, track), None)
+        if handle: handle.cancel()
+
+    def cancel_job(self, job_id: int):
+        for key in [k for k in self.timers if k[0] == job_id]: self.cancel(*key)
+
+RETRIES = RetryController()
+METRICS.register(Gauge("amd_retries_waiting", "Jobs and tracks waiting out a retry backoff.", collect=lambda: len(RETRIES.timers)))
+
+# --- TRANSCODE ---
+
+CONVERT_FORMATS = {
+    # convert-format: (extension, ffmpeg codec args, keeps cover art)
+    'flac': ('.flac', ['-c:a', 'flac'], True),
+    'alac': ('.m4a', ['-c:a', 'alac'], True),
+    'aac': ('.m4a', ['-c:a', 'aac', '-b:a', '256k'], True),
+    'mp3': ('.mp3', ['-c:a', 'libmp3lame', '-q:a', '0', '-id3v2_version', '3'], True),
+    'opus': ('.opus', ['-c:a', 'libopus', '-b:a', '192k'], False),
+    'wav': ('.wav', ['-c:a', 'pcm_s24le'], False),
+}
+LOSSLESS_FORMATS = {'flac', 'alac', 'wav'}
+LOSSY_CODECS = {'aac', 'atmos'}
+FFMPEG_DURATION = re.compile(r'Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)')
+
+class TranscodeItem(NamedTuple):
+    task: Dict
+    path: str
+
+class TranscodePool:
+    """Server-side conversion stage: a queue of finished files feeding a pool of ffmpeg processes.
+
+    The pool is sized to the CPU count and independent of the download slots,
+    so the next album downloads while the last one transcodes. Files are found
+    through the library index once a job, or a track-mode unit, finishes.
+    Playlists and videos can't be located that way, so they keep the
+    downloader's own conversion. The convert-* config keys decide the format
+    and the skip rules. Progress is kept on the job's 'conversion' field and
+    echoed to the log. Queued conversions do not survive a restart.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.workers: List[asyncio.Task] = []
+        self.active: Dict[str, asyncio.subprocess.Process] = {}
+        self.pending: set = set()  # paths queued or converting
+        self._locating: set = set()
+        self.stats = {'converted': 0, 'skipped': 0, 'failed': 0}
+
+    def start(self, size: int):
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(size)]
+
+    async def stop(self):
+        for proc in list(self.active.values()):
+            try: proc.kill()
+            except ProcessLookupError: pass
+        for task in self.workers + list(self._locating): task.cancel()
+        await asyncio.gather(*self.workers, *self._locating, return_exceptions=True)
+        self.workers = []
+
+    def handles(self, task: Dict) -> bool:
+        config = load_config()
+        if not config.get('convert-after-download'): return False
+        if str(config.get('convert-format') or 'flac').lower() not in CONVERT_FORMATS: return False
+        ref = parse_catalog_url(task.get('url', ''))
+        return bool(ref) and ref[1] in ('albums', 'songs')
+
+    def job_finished(self, task: Dict, indices: Optional[List[int]] = None):
+        """Queue the files of a finished job (or of some of its tracks) without holding up the caller."""
+        if not self.handles(task): return
+        locating = asyncio.create_task(self._locate(task, indices))
+        self._locating.add(locating)
+        locating.add_done_callback(self._locating.discard)
+
+    async def _locate(self, task: Dict, indices: Optional[List[int]]):
+        try:
+            await LIBRARY.refresh()
+        except Exception as e:
+            logger.error(f"Library scan before conversion failed: {e}")
+        found = LIBRARY.locate(task, indices) or {}
+        expected = len(indices) if indices is not None else len(task.get('sub_tasks') or []) or 1
+        if len(found) < expected:
+            await broadcast_log(f"[Convert] Found {len(found)} of {expected} files for {task.get('title') or task['url']}; the rest stay unconverted")
+        for path in found.values(): self.submit(task, path)
+
+    def submit(self, task: Dict, path: str):
+        if path in self.pending: return
+        self.pending.add(path)
+        conv = task.setdefault('conversion', {'format': None, 'total': 0, 'converted': 0, 'skipped': 0, 'failed': 0, 'current': None, 'percent': 0})
+        conv['format'] = str(load_config().get('convert-format') or 'flac').lower()
+        conv['total'] += 1
+        self._touch(task)
+        self.queue.put_nowait(TranscodeItem(task, path))
+
+    def _touch(self, task: Dict):
+        if JOBS.get(task['id']) is task: JOBS.touch(task, 'conversion')
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                await self._finish(item, await self._convert(item))
+            except Exception as e:
+                logger.error(f"Conversion of {item.path} failed: {e}")
+                await self._finish(item, 'failed')
+            finally:
+                self.pending.discard(item.path)
+                self.queue.task_done()
+
+    def skip_reason(self, config, fmt: str, codec: str, src: str, dst: str) -> Optional[str]:
+        if os.path.splitext(src)[1].lower() != '.m4a': return "already converted"
+        if config.get('convert-skip-if-source-matches', True) and fmt in ('alac', 'aac') and fmt == codec:
+            return f"source is already {fmt}"
+        if config.get('convert-skip-lossy-to-lossless', True) and codec in LOSSY_CODECS and fmt in LOSSLESS_FORMATS:
+            return f"lossy {codec} source, not converting to lossless {fmt}"
+        if dst != src and os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src): return "already converted"
+        return None
+
+    async def _convert(self, item: TranscodeItem) -> str:
+        config = load_config()
+        fmt = str(config.get('convert-format') or 'flac').lower()
+        ext, codec_args, cover = CONVERT_FORMATS[fmt]
+        codec = library_codec(item.task.get('codec', 'alac'))
+        src, name = item.path, os.path.basename(item.path)
+        base = os.path.splitext(src)[0]
+        keep = bool(config.get('convert-keep-original'))
+        dst = base + ext
+        if dst == src and keep: dst = f"{base}.{fmt}{ext}"  # same container: keep both side by side
+        if not os.path.exists(src): return 'skipped'
+        reason = self.skip_reason(config, fmt, codec, src, dst)
+        if reason:
+            await broadcast_log(f"[Convert] Skipping {name}: {reason}")
+            return 'skipped'
+        ffmpeg = config.get('ffmpeg-path') or 'ffmpeg'
+        if not shutil.which(ffmpeg):
+            await broadcast_log(f"[Convert] {ffmpeg} not found, cannot convert {name}")
+            return 'failed'
+        if codec in LOSSY_CODECS and fmt in LOSSLESS_FORMATS and config.get('convert-warn-lossy-to-lossless', True):
+            await broadcast_log(f"[Convert] Warning: {name} is lossy {codec}; {fmt} won't restore the lost quality")
+        tmp = os.path.join(os.path.dirname(src), f".{os.path.basename(base)}.converting{ext}")
+        cmd = [ffmpeg, '-hide_banner', '-nostdin', '-y', '-i', src, '-map', '0:a', '-map_metadata', '0']
+        if cover: cmd += ['-map', '0:v?', '-c:v', 'copy', '-disposition:v', 'attached_pic']
+        cmd += codec_args + shlex.split(config.get('convert-extra-args') or '') + ['-progress', 'pipe:1', '-nostats', tmp]
+
+        started = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        self.active[src] = proc
+        errors: deque = deque(maxlen=FAILURE_TAIL_LINES)
+        duration = 0.0
+
+        async def read_stderr():
+            nonlocal duration
+            async for raw in proc.stderr:
+                line = raw.decode('utf-8', errors='replace').strip()
+                if not duration and (m := FFMPEG_DURATION.search(line)):
+                    duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+                if line: errors.append(line)
+
+        reader = asyncio.create_task(read_stderr())
+        throttle = ProgressThrottle()
+        conv = item.task['conversion']
+        conv['current'], conv['percent'] = name, 0
+        try:
+            async for raw in proc.stdout:
+                key, _, value = raw.decode('utf-8', errors='replace').strip().partition('=')
+                if key != 'out_time_us' or not value.isdigit() or not duration: continue
+                percent = min(100, int(int(value) / 1e6 / duration * 100))
+                if throttle.offer(OutputEvent('progress', name, value=percent, phase='Converting')):
+                    conv['percent'] = percent
+                    self._touch(item.task)
+                    await broadcast_log(f"[Convert] {name} -> {fmt} {percent}%", key=f"convert:{item.task['id']}")
+            rc = await proc.wait()
+            await reader
+        finally:
+            self.active.pop(src, None)
+        JOB_PHASE_SECONDS.observe(time.monotonic() - started, phase="transcode")
+        if rc != 0:
+            if os.path.exists(tmp): os.remove(tmp)
+            await broadcast_log(f"[Convert] ffmpeg failed on {name}: {errors[-1] if errors else f'exit code {rc}'}")
+            return 'failed'
+        os.replace(tmp, dst)
+        if not keep and dst != src: os.remove(src)
+        LIBRARY.request_scan()
+        return 'converted'
+
+    async def _finish(self, item: TranscodeItem, result: str):
+        self.stats[result] += 1
+        TRANSCODES.inc(result=result)
+        conv = item.task['conversion']
+        conv[result] += 1
+        if conv['converted'] + conv['skipped'] + conv['failed'] >= conv['total']:
+            conv['current'], conv['percent'] = None, 100
+            await broadcast_log(f"[Convert] {item.task.get('title') or item.task['url']}: {conv['converted']} converted to {conv['format']}, "
+                                f"{conv['skipped']} skipped, {conv['failed']} failed")
+        self._touch(item.task)
+
+    def status(self) -> Dict:
+        return {"workers": len(self.workers), "queued": self.queue.qsize(),
+                "active": [os.path.basename(p) for p in self.active], **self.stats}
+
+TRANSCODER = TranscodePool()
+TRANSCODES = METRICS.register(Counter("amd_transcodes_total", "Files handled by the transcode stage, by result.", "result"))
+METRICS.register(Gauge("amd_transcode_queue", "Files waiting for an ffmpeg worker.", collect=lambda: TRANSCODER.queue.qsize()))
+METRICS.register(Gauge("amd_transcode_active", "ffmpeg processes running.", collect=lambda: len(TRANSCODER.active)))
+
+# --- WATCHLIST ---
+
+WatchKey = Tuple[str, str]  # (storefront, artist id)
+
+class Watchlist:
+    """Artists checked in the background for new releases, persisted to SQLite.
+
+    Each entry keeps the ids of every release seen so far and the newest
+    release date per view. A check walks the artist's views
+    WATCHLIST_PAGE_SIZE releases at a time; views list the newest releases
+    first, so the walk stops at the first page that reaches a seen release,
+    and the first page is requested with the ETag of the last answer. A
+    quiet artist therefore costs one small request per view. Unseen
+    releases that are out and not already in the library are queued as
+    bulk jobs in one fair-share lane per artist; pre-orders are picked up
+    once their release date has passed.
+
+    The first check of a view only records what is there, unless the
+    artist was added with backfill. After that each artist is checked once
+    per WATCHLIST_INTERVAL, at a random offset so artists added together
+    spread across the interval, and never less than WATCHLIST_MIN_GAP after
+    the previous check. Requests go through the limiter's background lane.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[WatchKey, Dict[str, Any]] = {}
+        self.db: Optional[sqlite3.Connection] = None
+        self.checking: Optional[WatchKey] = None
+        self.stats = {'checks': 0, 'not_modified': 0, 'failed': 0, 'queued': 0, 'pages': 0}
+        self._wake: Optional[asyncio.Event] = None
+
+    def open(self):
+        if os.path.dirname(self.path): os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS artists (storefront TEXT NOT NULL, artist_id TEXT NOT NULL, data TEXT NOT NULL, "
+                        "PRIMARY KEY (storefront, artist_id))")
+        for storefront, artist_id, data in self.db.execute("SELECT storefront, artist_id, data FROM artists"):
+            try: entry = json.loads(data)
+            except ValueError: continue
+            entry['seen'] = set(entry.get('seen') or ())
+            self.entries[(storefront, artist_id)] = entry
+        logger.info(f"Watchlist loaded {len(self.entries)} artists from {self.path}")
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def _save(self, entry: Dict[str, Any]):
+        key = (entry['storefront'], entry['artist_id'])
+        if self.entries.get(key) is not entry or not self.db: return  # removed while it was being checked
+        self.db.execute("INSERT OR REPLACE INTO artists (storefront, artist_id, data) VALUES (?, ?, ?)",
+                        (*key, json.dumps(dict(entry, seen=sorted(entry['seen'])))))
+
+    def add(self, storefront: str, artist_id: str, codec: str, views: List[str], backfill: bool = False) -> Dict[str, Any]:
+        entry = self.entries.get((storefront, artist_id))
+        if entry is None:
+            entry = {'storefront': storefront, 'artist_id': artist_id, 'name': None, 'seen': set(), 'latest': {}, 'etags': {},
+                     'added_at': time.time(), 'last_checked': None, 'last_error': None, 'queued': 0}
+            self.entries[(storefront, artist_id)] = entry
+        entry.update(codec=codec, views=list(views), backfill=backfill, next_check=0.0)
+        self._save(entry)
+        self.wake()
+        return entry
+
+    def remove(self, storefront: str, artist_id: str) -> bool:
+        if self.entries.pop((storefront, artist_id), None) is None: return False
+        if self.db: self.db.execute("DELETE FROM artists WHERE storefront = ? AND artist_id = ?", (storefront, artist_id))
+        return True
+
+    def request_check(self, storefront: str, artist_id: str) -> bool:
+        entry = self.entries.get((storefront, artist_id))
+        if entry is None: return False
+        entry['next_check'] = 0.0
+        self.wake()
+        return True
+
+    def wake(self):
+        if self._wake: self._wake.set()
+
+    async def _check_view(self, entry: Dict[str, Any], view: str) -> Tuple[List[Dict], Optional[str]]:
+        """Unseen releases of one view, newest first, and the ETag of its first page."""
+        storefront, artist_id = entry['storefront'], entry['artist_id']
+        baseline = view not in entry['latest']
+        path, params = f"artists/{artist_id}/view/{view}", {"limit": WATCHLIST_PAGE_SIZE}
+        etag = None if baseline else entry['etags'].get(view)
+        headers = {"If-None-Match": etag} if etag else None
+        prefix = f"/v1/catalog/{storefront}/"
+        found: List[Dict] = []
+        first = True
+        while path:
+            response = await catalog_get(storefront, path, params, endpoint="watchlist", headers=headers if first else None)
+            if response is None: raise RuntimeError("Developer token unavailable")
+            self.stats['pages'] += 1
+            if response.status_code == 304:
+                self.stats['not_modified'] += 1
+                return found, etag
+            response.raise_for_status()
+            if first: etag = response.headers.get('etag')
+            first = False
+            data = response.json()
+            items = [p for item in data.get('data', []) if (p := parse_api_item(item)) and p.get('url')]
+            fresh = [p for p in items if p['id'] not in entry['seen']]
+            found.extend(fresh)
+            if not baseline and len(fresh) < len(items): break
+            next_url = data.get('next')
+            if not next_url: break
+            parts = urlsplit(next_url)
+            path = parts.path[len(prefix):] if parts.path.startswith(prefix) else None
+            params = dict(parse_qsl(parts.query))
+        return found, etag
+
+    async def check(self, entry: Dict[str, Any]) -> int:
+        """Look for new releases of one artist and queue them; returns how many were queued."""
+        today = time.strftime("%Y-%m-%d")
+        items, seen, latest, etags = [], set(), dict(entry['latest']), {}
+        # Nothing is recorded until every view has been walked, so a failed check is simply redone
+        for view in entry['views']:
+            baseline = view not in entry['latest']
+            releases, etags[view] = await self._check_view(entry, view)
+            latest.setdefault(view, '')
+            for release in releases:
+                date = release.get('releaseDate') or ''
+                if date > today:
+                    etags[view] = None  # the page won't change when it comes out, so it must not be answered with a 304
+                    continue
+                if release['id'] in seen: continue
+                seen.add(release['id'])
+                entry['name'] = entry['name'] or release.get('artist')
+                latest[view] = max(latest[view], date)
+                if baseline and not entry.get('backfill'): continue
+                item = release_item(release, entry['codec'])
+                if LIBRARY.has_release(item): continue
+                items.append(item)
+        tasks = []
+        if items:
+            tasks, _ = enqueue_tasks(items, skip_existing=True, source=f"watchlist:{entry['artist_id']}", priority='bulk')
+            if tasks: await broadcast_log(f"Watchlist: queued {len(tasks)} new releases by {entry['name'] or entry['artist_id']}")
+        entry['seen'] |= seen
+        entry['latest'] = latest
+        entry['etags'] = {view: tag for view, tag in etags.items() if tag}
+        entry['queued'] += len(tasks)
+        self.stats['queued'] += len(tasks)
+        return len(tasks)
+
+    async def sync(self, entry: Dict[str, Any]):
+        key = (entry['storefront'], entry['artist_id'])
+        first = entry['last_checked'] is None
+        self.checking = key
+        now = time.time()
+        try:
+            await self.check(entry)
+            entry.update(last_checked=now, last_error=None, backfill=False)
+            # A fresh artist gets a random place in the cycle so a bulk import doesn't come due all at once
+            entry['next_check'] = now + (random.uniform(0.1, 1.0) if first else 1.0) * WATCHLIST_INTERVAL
+            WATCHLIST_CHECKS.inc(result="ok")
+        except CircuitOpenError as e:
+            entry['next_check'] = now + e.retry_after
+            WATCHLIST_CHECKS.inc(result="throttled")
+        except Exception as e:
+            self.stats['failed'] += 1
+            logger.warning(f"Watchlist check failed for artist {entry['artist_id']} ({entry['storefront']}): {e}")
+            entry.update(last_error=str(e)[:200], next_check=now + WATCHLIST_RETRY)
+            WATCHLIST_CHECKS.inc(result="error")
+        finally:
+            self.checking = None
+            self.stats['checks'] += 1
+        self._save(entry)
+
+    async def run(self):
+        self._wake = asyncio.Event()
+        while True:
+            due = min(self.entries.values(), key=lambda e: e['next_check'], default=None)
+            delay = due['next_check'] - time.time() if due else WATCHLIST_INTERVAL
+            if delay > 0:
+                try: await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError: pass
+                self._wake.clear()
+                continue
+            await self.sync(due)
+            await asyncio.sleep(WATCHLIST_MIN_GAP)
+
+    def describe(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        fields = ('storefront', 'artist_id', 'name', 'codec', 'views', 'latest', 'added_at', 'last_checked', 'last_error', 'next_check', 'queued')
+        return dict({k: entry.get(k) for k in fields}, seen=len(entry['seen']))
+
+    def status(self) -> Dict[str, Any]:
+        return {'artists': [self.describe(e) for e in sorted(self.entries.values(), key=lambda e: e['next_check'])],
+                'checking': list(self.checking) if self.checking else None, 'interval': WATCHLIST_INTERVAL, **self.stats}
+
+WATCHLIST = Watchlist(WATCHLIST_DB_PATH)
+WATCHLIST_CHECKS = METRICS.register(Counter("amd_watchlist_checks_total", "Watchlist artist checks, by result.", "result"))
+METRICS.register(Gauge("amd_watchlist_artists", "Artists on the watchlist.", collect=lambda: len(WATCHLIST.entries)))
+METRICS.register(Counter("amd_watchlist_queued_total", "Releases queued by the watchlist.", collect=lambda: WATCHLIST.stats['queued']))
+METRICS.register(Counter("amd_watchlist_pages_total", "Artist view pages fetched by the watchlist.", collect=lambda: WATCHLIST.stats['pages']))
+
+async def loop_lag_loop():
+    """Sample event-loop responsiveness: anything blocking the loop delays this sleep's wake-up."""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL))
+
+async def queue_feed_loop():
+    # Deltas accumulate in the job store and are pushed at a fixed cadence, so
+    # a task emits at most a few updates per second however fast it changes.
+    while True:
+        await asyncio.sleep(QUEUE_FEED_INTERVAL)
+        update = JOBS.drain_changes()
+        if update and BROADCASTER.subscribers("queue"): BROADCASTER.publish("queue", json.dumps(update))
+
+def downloader_command(codec: str, url: str) -> List[str]:
+    cmd = [DOWNLOADER_BIN]
+    if codec == 'aac': cmd.append('--aac')
+    elif codec == 'atmos' or codec == 'ec3': cmd.append('--atmos')
+    if "/music-video/" in url: pass 
+    elif "/song/" in url or "?i=" in url: cmd.append("--song")
+    elif "/album/" in url: cmd.append("--all-album")
+    cmd.append(url)
+    return cmd
+
+class OutputEvent(NamedTuple):
+    kind: str            # track | name | progress | skipped | failed | line
+    line: str
+    log: bool = False    # worth echoing to the log console
+    value: int = 0       # track number or percent
+    total: int = 0
+    phase: str = ""
+
+class DownloaderOutputParser:
+    """Incremental parser turning raw downloader stdout chunks into structured events.
+
+    Lines are split on both CR and LF by scanning each chunk once with offsets; only
+    the trailing partial line is carried over to the next chunk.
+    """
+    LINE_END = re.compile(rb'[\r\n]')
+    EVENT = re.compile(
+        r'Track (?P<track>\d+) of (?P<total>\d+):'
+        r'|(?P<phase>Downloading|Decrypting)\.\.\.\s+(?P<percent>\d+)%'
+        r'|(?P<skipped>Track already exists locally)'
+        r'|(?P<failed>Failed)'
+    )
+    LOG_WORDS = re.compile(r'Track|Decrypted|Queue|Failed|Downloading|Decrypting')
+
+    def __init__(self):
+        self.pending = b""
+        self.expect_name = False
+
+    def feed(self, chunk: bytes) -> List[OutputEvent]:
+        data = self.pending + chunk if self.pending else chunk
+        events, start = [], 0
+        for m in self.LINE_END.finditer(data):
+            if m.start() > start: self._parse(data[start:m.start()], events)
+            start = m.end()
+        self.pending = data[start:]
+        return events
+
+    def close(self) -> List[OutputEvent]:
+        events = []
+        if self.pending: self._parse(self.pending, events)
+        self.pending = b""
+        return events
+
+    def _parse(self, raw: bytes, events: List[OutputEvent]):
+        line = raw.decode('utf-8', errors='replace').strip()
+        if not line: return
+        log = self.LOG_WORDS.search(line) is not None
+        m = self.EVENT.search(line)
+        if m is None:
+            # The line following "Track N of M:" carries the track name
+            events.append(OutputEvent('name' if self.expect_name else 'line', line, log))
+            self.expect_name = False
+            return
+        self.expect_name = False
+        if m.group('track'):
+            self.expect_name = True
+            events.append(OutputEvent('track', line, log, int(m.group('track')), int(m.group('total'))))
+        elif m.group('phase'):
+            events.append(OutputEvent('progress', line, log, int(m.group('percent')), phase=m.group('phase')))
+        elif m.group('skipped'):
+            events.append(OutputEvent('skipped', line, log))
+        else:
+            events.append(OutputEvent('failed', line, log))
+
+class ProgressThrottle:
+    """Let at most one progress event per interval through, holding on to the latest one."""
+    def __init__(self, interval: float = PROGRESS_INTERVAL):
+        self.interval = interval
+        self.last = 0.0
+        self.held: Optional[OutputEvent] = None
+
+    def offer(self, event: OutputEvent) -> bool:
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last, self.held = now, None
+            return True
+        self.held = event
+        return False
+
+    def flush(self) -> Optional[OutputEvent]:
+        event, self.held = self.held, None
+        return event
+
+async def read_output_events(stream: asyncio.StreamReader):
+    """Yield structured events from a downloader's stdout until EOF."""
+    parser = DownloaderOutputParser()
+    while True:
+        try:
+            chunk = await stream.read(65536)
+        except: break
+        if not chunk: break
+        for event in parser.feed(chunk): yield event
+    for event in parser.close(): yield event
+
+# First match wins, so connection errors that mention a missing resource are
+# still treated as transient. Anything unmatched is retried within the budget.
+FAILURE_RULES = [
+    # Admission holds the retry back until space is freed
+    (re.compile(r'no space left on device|disk quota exceeded', re.I), 'transient', 'disk_full'),
+    (re.compile(r'127\.0\.0\.1:\d+|wrapper|decrypt(ion)? (failed|error)|failed to decrypt', re.I), 'transient', 'wrapper'),
+    (re.compile(r'\b429\b|too many requests|rate.?limit', re.I), 'transient', 'rate_limited'),
+    (re.compile(r'connection (refused|reset)|broken pipe|timed? ?out|deadline exceeded|\bEOF\b|no such host|'
+                r'network is unreachable|tls handshake|temporary failure', re.I), 'transient', 'network'),
+    (re.compile(r'\b50[0234]\b|service unavailable|bad gateway', re.I), 'transient', 'server_error'),
+    # The downloader's "... is not available in your storefront" and friends, not any line naming a region
+    (re.compile(r'(not available|unavailable) (in|for) (your|this|the current) (region|storefront|country)|not streamable|'
+                r'(album|song|track|playlist|music video) is (not available|unavailable)', re.I), 'permanent', 'unavailable'),
+    (re.compile(r'invalid (url|link|id)|url is invalid|\b404\b|not found|no such (album|song|playlist)', re.I), 'permanent', 'not_found'),
+    (re.compile(r'not supported|unsupported|no (alac|atmos|lossless)', re.I), 'permanent', 'unsupported'),
+    (re.compile(r'unauthori[sz]ed|\b401\b|\b403\b|media-user-token|not logged in|subscription', re.I), 'permanent', 'auth'),
+]
+
+def classify_failure(lines, wrapper: Optional[WrapperSupervisor] = None) -> Tuple[str, str, str]:
+    """Classify a failed downloader run from its last output lines.
+
+    Returns (kind, reason, detail): kind is 'transient' or 'permanent' and
+    detail the line that decided it.
+    """
+    for line in reversed(lines):
+        for pattern, kind, reason in FAILURE_RULES:
+            if pattern.search(line): return kind, reason, line
+    # A wrapper that went away mid-download leaves nothing useful in the output
+    if wrapper is not None and not wrapper.ready.is_set(): return 'transient', 'wrapper', 'wrapper restarted'
+    return 'transient', 'unknown', lines[-1] if lines else 'downloader exited with an error'
+
+def classify_error(e: Exception) -> Tuple[str, str, str]:
+    """Classify an exception raised around a downloader run, like classify_failure().
+
+    A downloader binary that is missing or not executable won't start on a
+    retry either, so spawn failures are permanent; anything else is transient.
+    """
+    if isinstance(e, (FileNotFoundError, PermissionError)): return 'permanent', 'spawn_failed', f"Error: {str(e)}"
+    return 'transient', 'error', f"Error: {str(e)}"
+
+async def run_download(task: Dict, wrapper: Optional[WrapperSupervisor] = None):
+    JOBS.update(task, status='downloading', progress='Starting...')
     await broadcast_log(f"Starting download: {task['url']}")
     current_track_idx = -1
+    started = time.monotonic()
+    phases = TrackPhaseTimer()
+    workdir = APP_DIR
     try:
-        cmd = [DOWNLOADER_BIN]
-        if task['codec'] == 'aac': cmd.append('--aac')
-        elif task['codec'] == 'atmos' or task['codec'] == 'ec3': cmd.append('--atmos')
-        if "/music-video/" in task['url']: pass 
-        elif "/song/" in task['url'] or "?i=" in task['url']: cmd.append("--song")
-        elif "/album/" in task['url']: cmd.append("--all-album")
-        cmd.append(task['url'])
+        workdir = await downloader_workdir(wrapper, task)
         process = await asyncio.create_subprocess_exec(
-            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, cwd="/app" 
+            *downloader_command(task['codec'], task['url']), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, cwd=workdir
         )
+        SCHEDULER.processes[(task['id'], None)] = process
         # Monitor Progress
         total_tracks = task.get('total_tracks') or 1
         completed_tracks = 0
-        next_line_is_track_name = False
-        buffer = b""
-        
-        while True:
-            if process.returncode is not None: break
-            try:
-                chunk = await process.stdout.read(4096) # Read larger chunk
-            except: break
-            if not chunk: break
-            
-            buffer += chunk
-            
-            while True:
-                # Find next newline (either \r or \n)
-                match_n = buffer.find(b'\n')
-                match_r = buffer.find(b'\r')
-                
-                if match_n == -1 and match_r == -1:
-                    break # No complete line yet
-                
-                # Find the earliest delimiter
-                if match_n != -1 and (match_r == -1 or match_n < match_r):
-                    delimiter = match_n
-                    advance = 1
-                else:
-                    delimiter = match_r
-                    advance = 1
-                
-                line_bytes = buffer[:delimiter]
-                buffer = buffer[delimiter+advance:] # Move buffer forward
-                
-                line = line_bytes.decode('utf-8', errors='replace').strip()
-                if not line: continue
-
-                # --- PARSING LOGIC ---
-                # Log significant events only to Websocket (Filtered to avoid insane spam if needed, but User requested visibility)
-                # We will broadcast everything relevant, and let Frontend handle the update-in-place.
-                if any(x in line for x in ["Track", "Decrypted", "Queue", "Failed", "Downloading", "Decrypting"]):
-                     await broadcast_log(f"[Downloader] {line}")
-
-                # Pattern: "Track 1 of 14:"
-                track_match = re.search(r'Track (\d+) of (\d+):', line)
-                if track_match:
-                    current = int(track_match.group(1))
-                    total = int(track_match.group(2))
-                    completed_tracks = current - 1
-                    task['total_tracks'] = total
-                    percent = int((completed_tracks / total) * 100)
-                    task['progress'] = f"Track {current}/{total} ({percent}%)"
-                    
-                    # Update Sub-Task Status
-                    if 'sub_tasks' in task and task['sub_tasks']:
-                        if current_track_idx >= 0 and current_track_idx < len(task['sub_tasks']):
-                             task['sub_tasks'][current_track_idx]['status'] = 'completed'
-                        current_track_idx = -1
-                        for idx, st in enumerate(task['sub_tasks']):
-                            if st.get('track_number') == current:
-                                current_track_idx = idx
-                                st['status'] = 'downloading'
-                                break
-                    next_line_is_track_name = True
-                    continue
+        throttle = ProgressThrottle()
+        tail: deque = deque(maxlen=FAILURE_TAIL_LINES)
 
-                if next_line_is_track_name and line:
-                    task['progress'] += f": {line}"
-                    next_line_is_track_name = False
-                    continue
-                
-                if "Track already exists locally" in line:
-                    if 'sub_tasks' in task and current_track_idx != -1: task['sub_tasks'][current_track_idx]['status'] = 'skipped'
-                    completed_tracks += 1
+        async def report_progress(event: OutputEvent):
+            await broadcast_log(f"[Downloader] {event.line}", key=f"progress:{task['id']}")
+            JOBS.update(task, progress=f"{event.phase} {event.value}% [{completed_tracks + 1}/{total_tracks}]")
+
+        async for event in read_output_events(process.stdout):
+            # Progress ticks arrive many times per second; coalesce them to a bounded rate
+            if event.kind == 'progress':
+                phases.mark(event.phase)
+                if throttle.offer(event): await report_progress(event)
+                continue
+            if event.kind == 'track': phases.mark(None)
+            held = throttle.flush()
+            if held: await report_progress(held)
+            if event.log: await broadcast_log(f"[Downloader] {event.line}")
+            if event.kind in ('line', 'failed'): tail.append(event.line)  # not track names
+
+            if event.kind == 'track':
+                current, total_tracks = event.value, event.total
+                completed_tracks = current - 1
+                percent = int((completed_tracks / total_tracks) * 100)
+                JOBS.update(task, total_tracks=total_tracks, progress=f"Track {current}/{total_tracks} ({percent}%)")
                 
-                # Parse Progress Bar (Update UI but don't log)
-                decrypt_match = re.search(r'Decrypting\.\.\.\s+(\d+)%', line)
-                if decrypt_match:
-                    percent = decrypt_match.group(1)
-                    task['progress'] = f"Decrypting {percent}% [{completed_tracks + 1}/{total_tracks}]"
-                    
-                download_match = re.search(r'Downloading\.\.\.\s+(\d+)%', line)
-                if download_match:
-                    percent = download_match.group(1)
-                    task['progress'] = f"Downloading {percent}% [{completed_tracks + 1}/{total_tracks}]"
-                # ---------------------
+                # Update Sub-Task Status
+                if 'sub_tasks' in task and task['sub_tasks']:
+                    if 0 <= current_track_idx < len(task['sub_tasks']) and task['sub_tasks'][current_track_idx]['status'] == 'downloading':
+                         task['sub_tasks'][current_track_idx]['status'] = 'completed'
+                    current_track_idx = -1
+                    for idx, st in enumerate(task['sub_tasks']):
+                        if st.get('track_number') == current:
+                            current_track_idx = idx
+                            st['status'] = 'downloading'
+                            break
+                    JOBS.touch(task, 'sub_tasks')
+            elif event.kind == 'name':
+                JOBS.update(task, progress=f"{task['progress']}: {event.line}")
+            elif event.kind == 'skipped':
+                if 'sub_tasks' in task and current_track_idx != -1:
+                    task['sub_tasks'][current_track_idx]['status'] = 'skipped'
+                    JOBS.touch(task, 'sub_tasks')
+                completed_tracks += 1
+        held = throttle.flush()
+        if held: await report_progress(held)
+        rc = await process.wait()
+        phases.mark(None)
+        JOB_PHASE_SECONDS.observe(time.monotonic() - started, phase="subprocess")
+        current = task['sub_tasks'][current_track_idx] if 'sub_tasks' in task and current_track_idx != -1 else None
+        if task['status'] != 'downloading':
+            # Paused or cancelled: the interrupted track is fetched again on resume
+            if current and current['status'] == 'downloading': current['status'] = 'pending'
+            JOBS.touch(task, 'sub_tasks')
+        elif rc == 0:
+            if current and current['status'] == 'downloading': current['status'] = 'completed'
+            JOBS.update(task, status='completed', progress='100% Done', sub_tasks=task['sub_tasks'])
+            LIBRARY.request_scan()
+            TRANSCODER.job_finished(task)
+        else:
+            if current: current['status'] = 'failed'
+            await RETRIES.failed(task, None, *classify_failure(tail, wrapper))
+    except Exception as e:
+        await RETRIES.failed(task, None, *classify_error(e))
+    finally:
+        SCHEDULER.processes.pop((task['id'], None), None)
+        release_workdir(workdir)
+    JOB_SECONDS.observe(time.monotonic() - started, result='retrying' if task['status'] == 'pending' else task['status'])
+
+async def run_track_download(task: Dict, idx: int, wrapper: Optional[WrapperSupervisor] = None):
+    """Download one track of a track-mode album job and fold the result into the album."""
+    st = task['sub_tasks'][idx]
+    st['status'] = 'downloading'
+    if task['status'] != 'downloading': JOBS.update(task, status='downloading', started_at=time.time(), sub_tasks=task['sub_tasks'])
+    else: JOBS.touch(task, 'sub_tasks')
+    await broadcast_log(f"Starting track {st.get('track_number')}: {st.get('title')} ({task.get('album') or task['url']})")
+    skipped = False
+    throttle = ProgressThrottle()
+    started = time.monotonic()
+    phases = TrackPhaseTimer()
+    tail: deque = deque(maxlen=FAILURE_TAIL_LINES)
+    failure = None
+    workdir = APP_DIR
+    try:
+        workdir = await downloader_workdir(wrapper, task)
+        process = await asyncio.create_subprocess_exec(
+            *downloader_command(task['codec'], st['url']), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, cwd=workdir
+        )
+        SCHEDULER.processes[(task['id'], idx)] = process
+        async for event in read_output_events(process.stdout):
+            if event.kind == 'progress':
+                phases.mark(event.phase)
+                if throttle.offer(event): await broadcast_log(f"[Downloader] {event.line}", key=f"progress:{task['id']}:{idx}")
+                continue
+            if event.log: await broadcast_log(f"[Downloader] {event.line}")
+            if event.kind in ('line', 'failed'): tail.append(event.line)  # not track names
+            if event.kind == 'skipped': skipped = True
         rc = await process.wait()
+        phases.mark(None)
+        JOB_PHASE_SECONDS.observe(time.monotonic() - started, phase="subprocess")
+        if task['status'] != 'downloading':
+            st['status'] = 'pending'
+            JOBS.touch(task, 'sub_tasks')
+            return
         if rc == 0:
-            if 'sub_tasks' in task and current_track_idx != -1: task['sub_tasks'][current_track_idx]['status'] = 'completed'
-            task['status'] = 'completed'
-            task['progress'] = '100% Done'
+            st['status'] = 'skipped' if skipped else 'completed'
+            if st['status'] == 'completed':
+                LIBRARY.request_scan()
+                TRANSCODER.job_finished(task, [idx])
         else:
-            if 'sub_tasks' in task and current_track_idx != -1: task['sub_tasks'][current_track_idx]['status'] = 'failed'
-            task['status'] = 'failed'
+            failure = classify_failure(tail, wrapper)
     except Exception as e:
-        task['status'] = 'failed'
-        task['progress'] = f"Error: {str(e)}"
-    await process_queue()
+        logger.error(f"Track download failed: {e}")
+        failure = classify_error(e)
+    finally:
+        SCHEDULER.processes.pop((task['id'], idx), None)
+        release_workdir(workdir)
+    if failure: await RETRIES.failed(task, idx, *failure)
+    finish_track_job(task)
+    if task['status'] in ('completed', 'failed'): JOB_SECONDS.observe(time.time() - task.get('started_at', time.time()), result=task['status'])
+
+def finish_track_job(task: Dict):
+    sub_tasks = task['sub_tasks']
+    done = sum(1 for st in sub_tasks if st['status'] in ('completed', 'skipped', 'failed'))
+    failed = sum(1 for st in sub_tasks if st['status'] == 'failed')
+    fields = {'sub_tasks': sub_tasks, 'progress': f"Track {done}/{len(sub_tasks)} ({int(done / len(sub_tasks) * 100)}%)"}
+    if done == len(sub_tasks):
+        fields['status'] = 'failed' if failed else 'completed'
+        fields['progress'] = f"{failed} of {len(sub_tasks)} tracks failed" if failed else '100% Done'
+    JOBS.update(task, **fields)
 
 if __name__ == "__main__":
     import uvicorn